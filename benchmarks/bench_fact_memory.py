@@ -0,0 +1,65 @@
+import argparse
+import gc
+import sys
+import os
+import tracemalloc
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from search_pipeline import searcher
+from search_pipeline import text_parser
+from benchmarks import bench_utils
+
+
+class _LegacyFact:
+    # reproduces the layout of facts before compaction: instance dictionary, props dictionary and raw yargy trees
+
+    def __init__(self, fact):
+        self.class_name = fact.class_name
+        self.parsed_name = fact.parsed_name.encode("utf-8").decode("utf-8")  # token copies were not shared between ads
+        self.size_info = fact.size_info
+        self.props = fact.props
+        self.parsed_size_info = fact.parsed_size_info
+
+
+def _encode_legacy(ads):
+    return [
+        [
+            _LegacyFact(fact)
+            for fact in text_parser.extract_facts(ad, searcher.ONT_STAT, searcher.LEMMATIZER, searcher.SIZE_RULE, keep_size_info=True)
+        ]
+        for ad in ads
+    ]
+
+
+def _encode_compact(ads):
+    return searcher.encode_strings(ads)
+
+
+def _measure_resident_bytes(encode_func, ads):
+    # memory, which is released with the encoded ads, so allocations, retained by yargy itself, are not counted
+    gc.collect()
+    tracemalloc.start()
+    enc_ads = encode_func(ads)
+    fact_cnt = sum(len(facts) for facts in enc_ads)
+    gc.collect()
+    size_with_ads, _ = tracemalloc.get_traced_memory()
+    del enc_ads
+    gc.collect()
+    size_without_ads, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size_with_ads - size_without_ads, fact_cnt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", help="Max amount of ads to encode", default=2000, type=int)
+    args = parser.parse_args()
+
+    ads = bench_utils.load_ads(args.limit)
+    _encode_compact(ads)  # lemmas and size parsers are cached, so they are not counted below
+
+    legacy_size, fact_cnt = _measure_resident_bytes(_encode_legacy, ads)
+    compact_size, _ = _measure_resident_bytes(_encode_compact, ads)
+    print(f"{len(ads)} ads, {fact_cnt} facts")
+    print(f"Legacy facts:  {legacy_size / len(ads):.0f} bytes per ad")
+    print(f"Compact facts: {compact_size / len(ads):.0f} bytes per ad ({legacy_size / max(compact_size, 1):.1f}x less)")
@@ -0,0 +1,56 @@
+import argparse
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import razdel
+
+from search_pipeline import searcher
+from search_pipeline import text_parser
+from benchmarks import bench_utils
+
+
+ITEM_PHRASES = [
+    "куртку зимнюю 44",
+    "штаны 50-52",
+    "ботинки 42",
+    "шапку",
+    "кожаный ремень",
+    "платье летнее размер M",
+    "джинсы женские 46",
+    "свитер шерстяной",
+    "кроссовки 38",
+    "пуховик на мальчика 5 лет",
+]
+
+
+def make_long_ad(min_tok_count):
+    """
+    Builds multi-item ad like "продам куртку зимнюю 44, штаны 50-52, ..." with at least the given amount of tokens.
+    Every 5th item starts a new sentence.
+    """
+    parts = ["Продам"]
+    item_idx = 0
+    while len(list(razdel.tokenize(" ".join(parts)))) < min_tok_count:
+        sep = ". Также" if item_idx > 0 and item_idx % 5 == 0 else ","
+        parts.append((sep + " " if item_idx > 0 else "") + ITEM_PHRASES[item_idx % len(ITEM_PHRASES)])
+        item_idx += 1
+    return " ".join(parts).replace(" ,", ",").replace(" .", ".")
+
+
+def _encode(text):
+    return text_parser.extract_facts(text, searcher.ONT_STAT, searcher.MORPH_AN, searcher.SIZE_RULE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="Comma-separated token counts of ads", default="10,50,100,200,500")
+    args = parser.parse_args()
+
+    _encode(make_long_ad(10))  # warm-up of lazy initializations
+    print(f"{'tokens':>7} {'facts':>6} {'encoding, ms':>13} {'per token, ms':>14}")
+    for tok_count in [int(v) for v in args.sizes.split(",")]:
+        text = make_long_ad(tok_count)
+        real_tok_count = len(list(razdel.tokenize(text)))
+        enc_time, facts = bench_utils.measure(_encode, text, repeat=3)
+        print(f"{real_tok_count:>7} {len(facts):>6} {enc_time * 1000:>13.1f} {enc_time / real_tok_count * 1000:>14.3f}")
@@ -0,0 +1,74 @@
+import argparse
+import random
+import sys
+import os
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "test")))
+
+import rdflib
+
+from search_pipeline import text_parser
+import ontology_stat_reference
+
+
+ONTOLOGY_PATH = "search_pipeline/ontology.ttl"
+
+
+def make_grown_ontology(n_synsets, seed=0):
+    """
+    Loads the real ontology and adds synthetic synsets: each one has two names and is a subclass
+    of a random parsed object (including previously added synsets), so the hierarchy becomes deeper.
+    """
+    ont = rdflib.Graph()
+    ont.parse(source=ONTOLOGY_PATH, format="turtle")
+    nsm = ont.namespace_manager
+    pred_subclass = nsm.expand_curie("local:is_subclass")
+    pred_included = nsm.expand_curie("local:is_included")
+    pred_name = nsm.expand_curie("local:has_name")
+    parsed_objects = nsm.expand_curie("local:parsed_objects")
+
+    rnd = random.Random(seed)
+    parent_list = list(ont.subjects(pred_included, parsed_objects))
+    for idx in range(n_synsets):
+        node = rdflib.URIRef(f"http://localhost/synth{idx}N")
+        ont.add((node, pred_name, rdflib.Literal(f"синтетика{idx}")))
+        ont.add((node, pred_name, rdflib.Literal(f"синт{idx}")))
+        ont.add((node, pred_subclass, rnd.choice(parent_list)))
+        ont.add((node, pred_included, parsed_objects))
+        parent_list.append(node)
+    return ont
+
+
+def _measure(func, ont):
+    beg_time = time.perf_counter()
+    stat = func(ont)
+    return time.perf_counter() - beg_time, stat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        help="Comma-separated amounts of synthetic synsets to add to the ontology",
+        default="0,500,1000,2000,5000",
+    )
+    parser.add_argument(
+        "--max-query-size",
+        help="Max amount of added synsets to measure the query-based implementation (it is very slow)",
+        default=500,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    print(f"{'synsets':>8} {'triples':>8} {'single pass, s':>15} {'per-name queries, s':>20}")
+    for n_synsets in [int(v) for v in args.sizes.split(",")]:
+        ont = make_grown_ontology(n_synsets)
+        pass_time, pass_stat = _measure(text_parser.calc_ontology_stat, ont)
+        if n_synsets <= args.max_query_size:
+            query_time, query_stat = _measure(ontology_stat_reference.calc_ontology_stat_by_queries, ont)
+            assert all(query_stat[k] == pass_stat[k] for k in query_stat.keys())
+            query_time_str = f"{query_time:.3f}"
+        else:
+            query_time_str = "(skipped)"
+        print(f"{n_synsets:>8} {len(ont):>8} {pass_time:>15.3f} {query_time_str:>20}")
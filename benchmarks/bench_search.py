@@ -0,0 +1,69 @@
+import argparse
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from search_pipeline import searcher
+from search_pipeline import index_snapshots
+from benchmarks import bench_utils
+
+
+def _search_linear(enc_requests, enc_ads):
+    return [searcher.search(enc_req, enc_ads) for enc_req in enc_requests]
+
+
+def _search_indexed(enc_requests, index):
+    return [searcher.search_index(enc_req, index) for enc_req in enc_requests]
+
+
+def _update_and_search(enc_ads, enc_requests, index):
+    # every update is followed by a search, so lazily updated structures are counted too
+    for ad_idx, ad_facts in enumerate(enc_ads):
+        index.add_ad(ad_facts)
+        searcher.search_index(enc_requests[ad_idx % len(enc_requests)], index)
+        index.replace_ad(ad_idx, ad_facts)
+        searcher.search_index(enc_requests[ad_idx % len(enc_requests)], index)
+        index.remove_ad(ad_idx)
+        searcher.search_index(enc_requests[ad_idx % len(enc_requests)], index)
+
+
+def _update_versioned(enc_ads, versioned_index):
+    # every change is published as a new snapshot
+    for ad_facts in enc_ads:
+        ad_idx = versioned_index.add_ad(ad_facts)
+        versioned_index.remove_ad(ad_idx)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", help="Max amount of ads to encode", default=2000, type=int)
+    parser.add_argument("--copies", help="Amount of copies of encoded ads in the searched corpus", default=100, type=int)
+    args = parser.parse_args()
+
+    # encoded ads are repeated, so the corpus size can be increased without long encoding
+    enc_ads = searcher.encode_strings(bench_utils.load_ads(args.limit)) * args.copies
+    enc_requests = searcher.encode_strings(bench_utils.load_requests())
+    print(f"{len(enc_ads)} ads, {len(enc_requests)} requests")
+
+    linear_time, linear_res = bench_utils.measure(_search_linear, enc_requests, enc_ads)
+    print(f"Per-request linear search: {linear_time / len(enc_requests) * 1000:.2f} ms")
+    for backend in searcher.AD_INDEX_BACKENDS:
+        build_time, index = bench_utils.measure(searcher.build_ad_index, enc_ads, backend)
+        # the first search builds lazy structures of the index, so it is measured separately
+        first_time, _ = bench_utils.measure(_search_indexed, enc_requests[:1], index)
+        indexed_time, indexed_res = bench_utils.measure(_search_indexed, enc_requests, index, repeat=3)
+        batch_time, match_matrix = bench_utils.measure(searcher.search_many, enc_requests, index, repeat=3)
+        assert linear_res == indexed_res
+        assert [match_matrix.get_row(req_idx) for req_idx in range(len(enc_requests))] == linear_res
+        update_ads = enc_ads[:100]
+        update_time, _ = bench_utils.measure(_update_and_search, update_ads, enc_requests, index)
+        print(
+            f"Backend \"{backend}\": construction {(build_time + first_time) * 1000:.1f} ms, "
+            f"per-request search {indexed_time / len(enc_requests) * 1000:.2f} ms, "
+            f"batched search {batch_time / len(enc_requests) * 1000:.2f} ms, "
+            f"add + replace + remove with searches {update_time / len(update_ads) * 1000:.2f} ms "
+            f"({index.get_stats()})"
+        )
+        versioned_index = index_snapshots.VersionedAdIndex(index)
+        publish_time, _ = bench_utils.measure(_update_versioned, update_ads, versioned_index)
+        print(f"Backend \"{backend}\": published snapshot {publish_time / (2 * len(update_ads)) * 1000:.2f} ms per change")
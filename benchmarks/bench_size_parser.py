@@ -0,0 +1,40 @@
+import argparse
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from yargy import Parser as YrgParser
+
+from search_pipeline import searcher
+from search_pipeline import text_parser
+from benchmarks import bench_utils
+
+
+def _encode_with_fresh_parsers(ads):
+    # reproduces the behavior without parser reuse: new parsers are compiled for every text
+    res = []
+    for ad in ads:
+        text_parser._SIZE_PARSER_CACHE.clear()
+        res.append(text_parser.extract_facts(ad, searcher.ONT_STAT, searcher.MORPH_AN, searcher.SIZE_RULE))
+    return res
+
+
+def _encode_with_shared_parsers(ads):
+    return [text_parser.extract_facts(ad, searcher.ONT_STAT, searcher.MORPH_AN, searcher.SIZE_RULE) for ad in ads]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", help="Max amount of ads to encode", default=200, type=int)
+    args = parser.parse_args()
+
+    ads = bench_utils.load_ads(args.limit)
+    construct_time, _ = bench_utils.measure(YrgParser, searcher.SIZE_RULE, repeat=5)
+    print(f"Parser construction: {construct_time * 1000:.1f} ms")
+
+    _encode_with_shared_parsers(ads[:1])  # warm-up of lazy initializations
+    fresh_time, fresh_facts = bench_utils.measure(_encode_with_fresh_parsers, ads)
+    shared_time, shared_facts = bench_utils.measure(_encode_with_shared_parsers, ads)
+    assert [[str(f) for f in facts] for facts in fresh_facts] == [[str(f) for f in facts] for facts in shared_facts]
+    print(f"Per-ad encoding with fresh parsers:  {fresh_time / len(ads) * 1000:.1f} ms")
+    print(f"Per-ad encoding with shared parsers: {shared_time / len(ads) * 1000:.1f} ms")
@@ -0,0 +1,73 @@
+import os
+import time
+
+
+AD_DB_PATH = "data/ads_db.txt"
+REQUEST_DB_PATH = "data/request_db.txt"
+
+# used when dataset is not pulled from DVC storage
+SAMPLE_ADS = [
+    "Отдам вещи на девочку р 80-92. Большая юбка, зелёные осенние джинсы и красные кофты",
+    "Продам куртку зимнюю мужскую размер 52, штаны 50-52, ботинки 42, шапку",
+    "продам куртку, штаны, ботинки 42, шапку, шарф, варежки, перчатки размер L",
+    "Пуховик женский XL, состояние отличное",
+    "Платье шёлковое 44 р., туфли 37",
+    "Детская куртка на мальчика 5-6 лет, демисезонная",
+    "Комбинезон на ребёнка 6 мес",
+    "Отдам коляску и кроватку",
+    "Продаю велосипед, самовывоз",
+    "Пальто кашемировое женское 46-48 размер, сапоги зимние 38",
+    "Шуба натуральная M, шапка меховая",
+    "Футболки 3XL 2 шт, рубашка мужская 54",
+    "Куртка кожаная мужская 50. Ботинки 43. Кроссовки 44",
+    "Вещи для школьницы 10 лет: юбка, блузка, пиджак",
+    "Обувь детская 25-27, сандали, кеды",
+    "Продам свитер шерстяной унисекс размер S-M",
+    "Сапоги кожаные женские 39 размер. Куртка демисезонная 46",
+    "Продаю телевизор и холодильник",
+    "Шорты джинсовые на девочку 8-9 лет, футболка хлопковая",
+    "Трикотажный костюм 44.5, кардиган",
+]
+SAMPLE_REQUESTS = [
+    "ищу куртку 44",
+    "нужна обувь",
+    "ищу одежду для девочки",
+    "куплю зимние ботинки 42",
+    "ищу женскую куртку",
+    "ищу пуховик XL",
+]
+
+
+def _load_lines(path, sample_lines, limit):
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    else:
+        print(f"(\"{path}\" is not found, sample texts are used)")
+        lines = sample_lines
+    if limit is not None:
+        lines = lines[:limit]
+    return lines
+
+
+def load_ads(limit=None):
+    return _load_lines(AD_DB_PATH, SAMPLE_ADS, limit)
+
+
+def load_requests(limit=None):
+    return _load_lines(REQUEST_DB_PATH, SAMPLE_REQUESTS, limit)
+
+
+def measure(func, *args, repeat=1):
+    """
+    Returns the best wall time of several runs (in seconds) and the result of the last run.
+    """
+    best_time = None
+    res = None
+    for _ in range(repeat):
+        beg_time = time.perf_counter()
+        res = func(*args)
+        cur_time = time.perf_counter() - beg_time
+        if best_time is None or cur_time < best_time:
+            best_time = cur_time
+    return best_time, res
@@ -1,45 +1,55 @@
 import readline  # modifies behavior of input(), adding history and handling arrows and backspase
 import argparse
+import bisect
 import json
 
-import rdflib
-
 from search_pipeline import searcher
+from search_pipeline import ontology_snapshot
+from search_pipeline import result_cache
 
 
 AD_DB_PATH = "data/ads_db.txt"
 
 METRICS_PATH = "metrics.json"
 ONTOLOGY_PATH = "search_pipeline/ontology.ttl"
+DEFAULT_OPTIONS_OBJ = "local:obj1256N"
 
-ONT_G = rdflib.Graph()
-ONT_G.parse(source=ONTOLOGY_PATH, format="turtle")
+ONT_SNAPSHOT = ontology_snapshot.load_snapshot(ONTOLOGY_PATH)
 
 global_cache = {"text": "", "opts": [], "def_opts": [], "def_attrs": []}
 
 
+def _decode_line(raw_line):
+    # the same text as of the file opened in text mode (see metrics_generator), so keys of encoded store are shared
+    return raw_line.decode("utf-8").replace("\r\n", "\n")
+
+
+def iter_lines_with_offsets(f, offset_list):
+    """
+    Yields decoded lines of the binary file, saving byte offset of every line to the list,
+    so the ad text can be read from the file when it is shown, instead of keeping all texts in memory.
+    """
+    offset = 0
+    for raw_line in f:
+        offset_list.append(offset)
+        offset += len(raw_line)
+        yield _decode_line(raw_line)
+
+
+def read_line_at(path, offset):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return _decode_line(f.readline())
+
+
 def input_completer_func(text, state):
+    completion = ONT_SNAPSHOT["completion"]
     if len(global_cache["def_attrs"]) == 0:
-        res = ONT_G.query(
-            "SELECT DISTINCT (MIN(?name) AS ?minName) "
-            "WHERE { "
-            "    ?attr_obj local:is_included local:parsed_attributes . "
-            "    ?attr_obj local:has_name ?name . "
-            "} GROUP BY ?attr_obj"
-        )
-        global_cache["def_attrs"] += [row[0].toPython() for row in res]
+        global_cache["def_attrs"] += completion["attr_names"]
 
     if len(text.strip()) == 0:
         if len(global_cache["def_opts"]) == 0:
-            res = ONT_G.query(
-                "SELECT DISTINCT ?name "
-                "WHERE { "
-                "    ?main_obj local:is_included local:parsed_objects . "
-                "    ?main_obj local:is_subclass local:obj1256N . "
-                "    ?main_obj local:has_name ?name . "
-                "}"
-            )
-            global_cache["def_opts"] = [row[0].toPython() for row in res]
+            global_cache["def_opts"] = completion["obj_child_names"].get(DEFAULT_OPTIONS_OBJ, [])
         options = global_cache["def_opts"]
         return options[state]
     else:
@@ -60,45 +70,25 @@ def input_completer_func(text, state):
 
             obj_name = text.rstrip()
 
-            res = ONT_G.query(
-                "SELECT DISTINCT ?main_obj_name "
-                "WHERE { "
-                "    ?main_obj local:is_included local:parsed_objects . "
-                "    ?main_obj local:has_name ?main_obj_name . "
-                f"    FILTER strStarts(?main_obj_name, \"{obj_name}\") "
-                "}"
-            )
-            found_obj_list = list(sorted(set([row[0].toPython() for row in res])))
-            options += [row[0].toPython() for row in res if row[0].toPython() != obj_name]
+            # names are sorted, so all names with the same prefix are located in a single range
+            all_obj_names = completion["obj_names"]
+            found_obj_list = []
+            for name in all_obj_names[bisect.bisect_left(all_obj_names, obj_name):]:
+                if not name.startswith(obj_name):
+                    break
+                found_obj_list.append(name)
+            options += [name for name in found_obj_list if name != obj_name]
 
             if len(found_obj_list) >= 1:
                 if instance_req_flag:
-                    res = ONT_G.query(
-                        "SELECT DISTINCT ?name "
-                        "WHERE { "
-                        "    ?main_obj local:is_included local:parsed_objects . "
-                        f"    ?main_obj local:has_name \"{found_obj_list[0]}\" . "
-                        "    ?inst_obj local:is_subclass+ ?main_obj . "
-                        "    ?inst_obj local:is_included local:parsed_objects . "
-                        "    ?inst_obj local:has_name ?name . "
-                        "}"
-                    )
-                    options = [obj_name + ": " + row[0].toPython() + " [inst]" for row in res]
+                    inst_names = sorted(ONT_SNAPSHOT["ont_stat"]["obj_name_descendants"].get(found_obj_list[0], set()))
+                    options = [obj_name + ": " + name + " [inst]" for name in inst_names]
                     if len(options) == 0:
                         options = [obj_name + ": [no instances found]"]
 
                 if part_req_flag:
-                    res = ONT_G.query(
-                        "SELECT DISTINCT ?name "
-                        "WHERE { "
-                        "    ?main_obj local:is_included local:parsed_objects . "
-                        f"    ?main_obj local:has_name \"{found_obj_list[0]}\" . "
-                        "    ?main_obj local:has_part+ ?part_obj . "
-                        "    ?part_obj local:is_included local:parsed_objects . "
-                        "    ?part_obj local:has_name ?name . "
-                        "}"
-                    )
-                    options = [obj_name + ", " + row[0].toPython() + " [part]" for row in res]
+                    part_names = sorted(completion["obj_name_parts"].get(found_obj_list[0], set()))
+                    options = [obj_name + ", " + name + " [part]" for name in part_names]
                     if len(options) == 0:
                         options = [obj_name + ": [no parts found]"]
 
@@ -124,11 +114,30 @@ if __name__ == "__main__":
         default=-1,  # magic number to detect absence
         type=float,
     )
+    parser.add_argument(
+        "--top-k",
+        help="Max amount of shown advertisements with the largest matching scores",
+        default=20,
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Amount of processes to encode advertisements",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--index-backend",
+        help="Implementation of advertisement search",
+        choices=sorted(searcher.AD_INDEX_BACKENDS),
+        default=searcher.DEFAULT_AD_INDEX_BACKEND,
+    )
     args = parser.parse_args()
     if args.thr == -1:  # not specified
         with open(METRICS_PATH, "r", encoding="utf-8") as f:
             metrics_dict = json.load(f)
-        opt_thr = metrics_dict["threshold"]
+        # threshold of binary matching is not applicable to graded scores
+        opt_thr = metrics_dict["threshold"] if metrics_dict.get("scoring") == "graded" else 0
     else:
         opt_thr = args.thr
     if opt_thr < 0:
@@ -140,9 +149,24 @@ if __name__ == "__main__":
     print(f"Match probability threshold: {opt_thr}")
 
     print("Encoding ads...")
-    with open(AD_DB_PATH, "r", encoding="utf-8") as f:
-        ads = f.readlines()
-    enc_ads = searcher.encode_strings(ads)
+    searcher.load_lemma_cache()
+    store = searcher.load_encoded_store()
+    ad_offsets = []
+    enc_ads = []
+    ad_stats = {}
+    with open(AD_DB_PATH, "rb") as f:
+        for _, facts in searcher.iter_encoded_strings(
+            iter_lines_with_offsets(f, ad_offsets), workers=args.workers, store=store, stats=ad_stats
+        ):
+            enc_ads.append(facts)
+    ad_index = searcher.build_ad_index(enc_ads, args.index_backend)
+    print(f"{ad_stats['unique_texts']} unique ads of {ad_stats['texts']} ({ad_stats['dedup_ratio']:.1%} are duplicates)")
+    searcher.save_lemma_cache()
+    # only ads are encoded here, so entries are not evicted (requests of metrics_generator are kept in the store)
+    store.save(evict=False)
+
+    # differently worded requests with the same facts are not searched again
+    search_cache = result_cache.SearchResultCache()
 
     readline.parse_and_bind("tab: complete")
     readline.set_completer_delims("")
@@ -158,15 +182,16 @@ if __name__ == "__main__":
 
         enc_req = searcher.encode_strings([request])[0]
         print(f"dbg req: {[str(fact) for fact in enc_req]}")
-        found_ad_idx_list = searcher.search(enc_req, enc_ads)
-        if len(found_ad_idx_list) == 0:
+        found_ad_list = searcher.search_top_k(enc_req, ad_index, args.top_k, min_score=opt_thr, cache=search_cache)
+        if len(found_ad_list) == 0:
             print("(no matches found)")
             continue
 
-        for pt_idx, ad_idx in enumerate(found_ad_idx_list, start=1):
-            print(f"\t{pt_idx}. {ads[ad_idx]}")
+        for pt_idx, (ad_idx, score) in enumerate(found_ad_list, start=1):
+            print(f"\t{pt_idx}. [{score:.3f}] {read_line_at(AD_DB_PATH, ad_offsets[ad_idx])}")
             print(f"dbg ad: {[str(fact) for fact in enc_ads[ad_idx]]}\n\n")
-        print(f"({len(found_ad_idx_list)} advertisements found, {len(ads)} scanned)")
+        print(f"({len(found_ad_list)} best advertisements are shown among {len(enc_ads)})")
 
+    print(f"Search result cache: {search_cache.get_stats()}")
     print("Goodbye!")
 
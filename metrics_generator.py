@@ -8,6 +8,7 @@ import numpy as np
 from utils import dataset_utils
 from utils import metrics
 from search_pipeline import searcher
+from search_pipeline import profiling
 
 
 REQUEST_DB_PATH = "data/request_db.txt"
@@ -17,51 +18,84 @@ MARKUP_PATH = "data/matching_db.txt"
 METRICS_PATH = "metrics.json"
 
 
-def calc_dataset_metrics(overwrite_flag):
+def calc_dataset_metrics(
+    overwrite_flag,
+    workers=1,
+    profile_flag=False,
+    profile_json_path=None,
+    index_backend=searcher.DEFAULT_AD_INDEX_BACKEND,
+    graded_flag=False,
+):
     with open(REQUEST_DB_PATH, "r", encoding="utf-8") as f:
         requests = f.readlines()
-    with open(AD_DB_PATH, "r", encoding="utf-8") as f:
-        ads = f.readlines()
     true_markup = dataset_utils.load_matching_data(MARKUP_PATH)
 
+    if profile_flag or profile_json_path is not None:
+        profiling.enable()
+        profiling.reset()
     beg_load_time = time.time()
+    if searcher.load_lemma_cache():
+        print(f"Loaded lemma cache from {searcher.LEMMA_CACHE_PATH}")
+    else:
+        print(f"Lemmatizing request vocabulary ({searcher.LEMMATIZER.warm_up(requests)} unique tokens)...")
+    # facts of unchanged lines are taken from the store, so only new or edited lines are encoded
+    store = searcher.load_encoded_store()
+    print(f"Loaded {len(store)} encoded texts from {searcher.ENCODED_STORE_PATH}")
     print("Encoding requests...")
-    enc_requests = searcher.encode_strings(requests)
+    request_stats = {}
+    enc_requests = searcher.encode_strings(requests, workers=workers, store=store, stats=request_stats)
     assert len(enc_requests) == len(requests)
     print("Encoding advertisements...")
-    enc_ads = searcher.encode_strings(ads)
-    assert len(enc_ads) == len(ads)
+    # ads are streamed from file, so their texts are not kept in memory together with the facts
+    enc_ads = []
+    ad_stats = {}
+    with open(AD_DB_PATH, "r", encoding="utf-8") as f:
+        for ad_id, facts in searcher.iter_encoded_strings(f, workers=workers, store=store, stats=ad_stats):
+            assert ad_id == len(enc_ads) + 1
+            enc_ads.append(facts)
+    ad_index = searcher.build_ad_index(enc_ads, index_backend)
     end_load_time = time.time()
-    print(f"(encoding took {int(end_load_time - beg_load_time)} seconds)")
-
-    # print("Calculating match probabilities...")
-    # matching_probs = []
-    # for req_id, enc_req in enumerate(enc_requests, start=1):
-    #     matching_probs.append(searcher.get_probs(enc_req, enc_ads))
-    # matching_probs = np.asarray(matching_probs)
-    # assert np.max(matching_probs) <= 1
-    # assert np.min(matching_probs) >= 0
-
-    # print("Calculating optimal threshold...")
-    # opt_threshold = metrics.calc_optimal_threshold(matching_probs, true_markup, len(requests), len(ads))
-    # direct_markup = metrics.convert_probs_to_markup(matching_probs, opt_threshold, len(requests), len(ads))
+    print(f"(encoding took {int(end_load_time - beg_load_time)} seconds, lemma cache: {searcher.LEMMATIZER.get_stats()})")
+    print(f"Duplicates: {request_stats['dedup_ratio']:.1%} of requests, {ad_stats['dedup_ratio']:.1%} of advertisements")
+    if profiling.is_enabled():
+        print("Encoding stages (texts from the store and duplicates are not encoded):")
+        print(profiling.format_stats())
+        if profile_json_path is not None:
+            profiling.save_stats(profile_json_path)
+            print(f"Stage timings are saved to {profile_json_path}")
+    searcher.save_lemma_cache()
+    store.save()
+    print(f"Encoded text store: {store.get_stats()}")
 
     print("Searching...")
-    pred_markup = {}
-    for req_id, enc_req in enumerate(enc_requests, start=1):
-        pred_ad_idx_list = searcher.search(enc_req, enc_ads)
-        if len(pred_ad_idx_list) > 0:
-            # searcher.search() returns 0-based list indices (the list contains all lines from input file),
-            # but advertisement id is 1-based line number
-            pred_markup[str(req_id)] = [str(idx + 1) for idx in pred_ad_idx_list]
-    # searcher returns matches, sorted by matching probability, so we re-sort the arrays for this comparison
-    # assert {k: list(sorted(v)) for k, v in pred_markup.items()} == {k: list(sorted(v)) for k, v in direct_markup.items()}
-
-    print("Calculating stats...")
-    confusion_matrix = metrics.calc_confusion_matrix(true_markup, pred_markup, n_ads=len(ads), n_requests=len(requests))
+    # all requests are searched together, so request facts of the same class are evaluated at once;
+    # rows of the match matrix are requests and columns are 0-based indices of ads (ad id is 1-based line number)
+    match_matrix = searcher.search_many(enc_requests, ad_index)
+    assert match_matrix.shape == (len(requests), len(enc_ads))
+
+    if graded_flag:
+        print("Calculating optimal threshold of graded scores...")
+        # not matched ads have zero scores, so only matched pairs are scored
+        matching_probs = np.zeros(match_matrix.shape)
+        for req_idx, enc_req in enumerate(enc_requests):
+            ad_idx_list = match_matrix.get_row(req_idx)
+            matching_probs[req_idx, ad_idx_list] = searcher.get_probs(
+                enc_req, [enc_ads[ad_idx] for ad_idx in ad_idx_list], graded=True
+            )
+        opt_threshold = metrics.calc_optimal_threshold(matching_probs, true_markup, len(requests), len(enc_ads))
+        pred_markup = metrics.convert_probs_to_markup(matching_probs, opt_threshold, len(requests), len(enc_ads))
+
+        print("Calculating stats...")
+        confusion_matrix = metrics.calc_confusion_matrix(true_markup, pred_markup, n_ads=len(enc_ads), n_requests=len(requests))
+    else:
+        opt_threshold = 1  # all matches are used
+
+        print("Calculating stats...")
+        confusion_matrix = metrics.calc_sparse_confusion_matrix(true_markup, match_matrix)
     all_stats = metrics.calc_all_stats(confusion_matrix)
     all_stats["conf_matr"] = confusion_matrix
-    all_stats["threshold"] = 1  # not used for ontology approach
+    all_stats["threshold"] = opt_threshold
+    all_stats["scoring"] = "graded" if graded_flag else "binary"
 
     metrics.compare_with_saved_stats(all_stats, confusion_matrix)
 
@@ -95,6 +129,36 @@ if __name__ == "__main__":
         help=f"Don't overwrite {METRICS_PATH} file",
         action="store_true",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Amount of processes to encode requests and advertisements",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="Print wall time of text encoding stages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-json",
+        help="Path to save wall time of text encoding stages as JSON (implies --profile)",
+        default=None,
+    )
+    parser.add_argument(
+        "--index-backend",
+        help="Implementation of advertisement search",
+        choices=sorted(searcher.AD_INDEX_BACKENDS),
+        default=searcher.DEFAULT_AD_INDEX_BACKEND,
+    )
+    parser.add_argument(
+        "-g",
+        "--graded",
+        help="Use graded matching scores with optimal threshold instead of binary matching",
+        action="store_true",
+    )
     args = parser.parse_args()
-    calc_dataset_metrics(not args.test)
+    calc_dataset_metrics(not args.test, args.workers, args.profile, args.profile_json, args.index_backend, args.graded)
 
@@ -0,0 +1,504 @@
+import bisect
+import copy
+
+import numpy as np
+
+
+# fact attributes (with integer codes), which are checked on search
+_ATTR_NAMES = ("gender", "season", "material_id")
+
+
+def is_fact_size_match(req_fact, ad_fact):
+    if req_fact.size_from is not None and ad_fact.size_from is not None:
+        if req_fact.size_to < ad_fact.size_from or req_fact.size_from > ad_fact.size_to:
+            # any intersection of sized is a match, but no intersection means no match
+            return False
+    return True
+
+
+def is_fact_attrs_match(req_fact, ad_fact):
+    # different attributes are not match, but if this attribute is omitted in request or ad, this is still match
+    if req_fact.gender is not None and ad_fact.gender is not None and req_fact.gender != ad_fact.gender:
+        return False
+    if req_fact.season is not None and ad_fact.season is not None and req_fact.season != ad_fact.season:
+        return False
+    if req_fact.material_id is not None and ad_fact.material_id is not None and req_fact.material_id != ad_fact.material_id:
+        return False
+    return True
+
+
+def is_fact_props_match(req_fact, ad_fact):
+    """
+    Checks sizes and attributes of two facts, which have matching classes.
+    """
+    return is_fact_size_match(req_fact, ad_fact) and is_fact_attrs_match(req_fact, ad_fact)
+
+
+# weights of components of graded score of matched facts (their sum is 1)
+SCORE_CLASS_WEIGHT = 0.4
+SCORE_SIZE_WEIGHT = 0.3
+SCORE_ATTR_WEIGHT = 0.3
+# class component of ad fact of descendant class (it is 1 for the same class)
+DESCENDANT_CLASS_SCORE = 0.5
+# size component of ad fact without size, when size is requested (it is almost the same as for the widest size range)
+UNKNOWN_SIZE_SCORE = 0.0
+# max score of ad, which facts match request facts only by descendant classes
+MAX_DESCENDANT_SCORE = SCORE_CLASS_WEIGHT * DESCENDANT_CLASS_SCORE + SCORE_SIZE_WEIGHT + SCORE_ATTR_WEIGHT
+
+
+def calc_fact_score(req_fact, ad_fact, is_same_class):
+    """
+    Returns graded score in (0, 1] of facts, which match (see is_fact_props_match()):
+    the same class is better than descendant class, larger share of overlap in union of sizes is better than smaller one,
+    and more agreeing attributes are better than omitted ones.
+    """
+    class_score = 1.0 if is_same_class else DESCENDANT_CLASS_SCORE
+    if req_fact.size_from is None:
+        size_score = 1.0
+    elif ad_fact.size_from is None:
+        size_score = UNKNOWN_SIZE_SCORE
+    else:
+        # ranges are inclusive, so a single size is a range of length 1
+        overlap_len = min(req_fact.size_to, ad_fact.size_to) - max(req_fact.size_from, ad_fact.size_from) + 1
+        union_len = max(req_fact.size_to, ad_fact.size_to) - min(req_fact.size_from, ad_fact.size_from) + 1
+        size_score = overlap_len / union_len
+    req_attr_cnt = 0
+    same_attr_cnt = 0
+    for attr_name in _ATTR_NAMES:
+        req_value = getattr(req_fact, attr_name)
+        if req_value is not None:
+            req_attr_cnt += 1
+            if getattr(ad_fact, attr_name) == req_value:
+                same_attr_cnt += 1
+    attr_score = same_attr_cnt / req_attr_cnt if req_attr_cnt > 0 else 1.0
+    return SCORE_CLASS_WEIGHT * class_score + SCORE_SIZE_WEIGHT * size_score + SCORE_ATTR_WEIGHT * attr_score
+
+
+def get_fact_key(fact):
+    """
+    Returns hashable key of all fact fields, which are used on search, so equal request facts can be evaluated once.
+    """
+    return (fact.class_id, fact.parsed_name, fact.size_from, fact.size_to, fact.gender, fact.season, fact.material_id)
+
+
+def group_request_facts(encoded_requests):
+    """
+    Output - dictionary {(class id, parsed name): {fact key: fact}} of unique facts of all requests, grouped by
+    class and name, as these facts are compared with the same ad facts.
+    """
+    fact_groups = {}
+    for encoded_request in encoded_requests:
+        for req_fact in encoded_request:
+            fact_group = fact_groups.setdefault((req_fact.class_id, req_fact.parsed_name), {})
+            fact_group.setdefault(get_fact_key(req_fact), req_fact)
+    return fact_groups
+
+
+class MatchMatrix:
+    """
+    Sparse request × ad matrix of matches in CSR form (attributes are the same as of scipy.sparse.csr_matrix):
+    sorted indices of ads, which match request i, are indices[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, indptr, indices, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = shape
+
+    @classmethod
+    def from_fact_matches(cls, encoded_requests, fact_matches, ad_count):
+        """
+        Builds the matrix from the found ads of every request fact: {fact key: array of ad indices}.
+        """
+        row_list = []
+        for encoded_request in encoded_requests:
+            # even one matched fact is complete match between request and ad
+            fact_rows = [fact_matches[get_fact_key(req_fact)] for req_fact in encoded_request]
+            if len(fact_rows) == 0:
+                row_list.append(np.zeros(0, dtype=np.int64))
+            elif len(fact_rows) == 1:
+                row_list.append(fact_rows[0])
+            else:
+                row_list.append(np.unique(np.concatenate(fact_rows)))
+        indptr = np.zeros(len(row_list) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in row_list], out=indptr[1:])
+        indices = np.concatenate(row_list).astype(np.int64) if len(row_list) > 0 else np.zeros(0, dtype=np.int64)
+        return cls(indptr, indices, (len(row_list), ad_count))
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def get_row(self, req_idx):
+        return self.indices[self.indptr[req_idx]:self.indptr[req_idx + 1]].tolist()
+
+    def to_dense(self):
+        probs = np.zeros(self.shape)
+        for req_idx in range(self.shape[0]):
+            probs[req_idx, self.indices[self.indptr[req_idx]:self.indptr[req_idx + 1]]] = 1
+        return probs
+
+
+def _iter_set_bits(bitmap):
+    # binary string is made in C, so only set bits are visited in Python
+    bits = bin(bitmap)[:1:-1]
+    pos = bits.find("1")
+    while pos != -1:
+        yield pos
+        pos = bits.find("1", pos + 1)
+
+
+# removed postings are dropped from the posting list, when their share is above this value
+COMPACTION_REMOVED_SHARE = 0.25
+
+
+class _PostingList:
+    """
+    Postings (ad index, fact) of one class or name, with structures for filtering of facts:
+        * sized facts are ordered by the start of size range, so facts with overlapping sizes are found
+          by binary search: only facts, which start not earlier than (request start - max range length), can overlap;
+          facts without size match any size, so they are kept apart
+        * bitmaps of posting positions (Python int) for every value of every attribute and for unspecified values,
+          so attribute filter is an intersection of (value | unspecified) bitmaps
+        * bitmap of positions of not removed postings
+    The structures are built on the first search and then updated in place on additions and removals.
+    Removed postings are replaced by None, until they are dropped by compaction (structures are built again then).
+    """
+
+    def __init__(self):
+        self.postings = []
+        self.removed_cnt = 0
+        self._ad_positions = None  # {ad index: tuple of positions of its postings}, is made on the first removal
+        self._is_built = False
+        self._unsized_positions = []
+        self._sized_positions = []  # sorted by size start
+        self._sized_starts = []
+        self._max_size_len = 0
+        self._attr_bitmaps = {}  # {attribute name: {value or None: bitmap of positions}}
+        self._live_bitmap = 0
+
+    def append(self, posting):
+        pos = len(self.postings)
+        self.postings.append(posting)
+        if self._ad_positions is not None:
+            self._ad_positions[posting[0]] = self._ad_positions.get(posting[0], ()) + (pos,)
+        if self._is_built:
+            self._add_to_structures(pos, posting[1])
+
+    def remove_ad(self, ad_idx):
+        if self._ad_positions is None:
+            self._ad_positions = {}
+            for pos, posting in enumerate(self.postings):
+                if posting is not None:
+                    self._ad_positions[posting[0]] = self._ad_positions.get(posting[0], ()) + (pos,)
+        for pos in self._ad_positions.pop(ad_idx, ()):
+            self.postings[pos] = None
+            self.removed_cnt += 1
+            self._live_bitmap &= ~(1 << pos)
+        if self.removed_cnt > COMPACTION_REMOVED_SHARE * len(self.postings):
+            self.compact()
+
+    def compact(self):
+        if self.removed_cnt == 0:
+            return
+        self.postings = [posting for posting in self.postings if posting is not None]
+        self.removed_cnt = 0
+        self._ad_positions = None
+        self._is_built = False
+
+    def __len__(self):
+        return len(self.postings) - self.removed_cnt
+
+    def copy(self):
+        posting_list = _PostingList()
+        posting_list.postings = list(self.postings)
+        posting_list.removed_cnt = self.removed_cnt
+        # positions are immutable tuples, so they are shared
+        posting_list._ad_positions = dict(self._ad_positions) if self._ad_positions is not None else None
+        posting_list._is_built = self._is_built
+        # the lists are changed in place, while bitmaps are immutable ints
+        posting_list._unsized_positions = list(self._unsized_positions)
+        posting_list._sized_positions = list(self._sized_positions)
+        posting_list._sized_starts = list(self._sized_starts)
+        posting_list._max_size_len = self._max_size_len
+        posting_list._attr_bitmaps = {name: dict(value_bitmaps) for name, value_bitmaps in self._attr_bitmaps.items()}
+        posting_list._live_bitmap = self._live_bitmap
+        return posting_list
+
+    def prepare(self):
+        """
+        Builds structures for search, so search does not change the posting list.
+        """
+        if not self._is_built:
+            self._build()
+
+    def _add_to_structures(self, pos, fact):
+        if fact.size_from is None:
+            self._unsized_positions.append(pos)
+        else:
+            insert_pos = bisect.bisect_right(self._sized_starts, fact.size_from)
+            self._sized_starts.insert(insert_pos, fact.size_from)
+            self._sized_positions.insert(insert_pos, pos)
+            self._max_size_len = max(self._max_size_len, fact.size_to - fact.size_from)
+        pos_bit = 1 << pos
+        for attr_name in _ATTR_NAMES:
+            value_bitmaps = self._attr_bitmaps[attr_name]
+            value = getattr(fact, attr_name)
+            value_bitmaps[value] = value_bitmaps.get(value, 0) | pos_bit
+        self._live_bitmap |= pos_bit
+
+    def _build(self):
+        # structures of many postings are built at once, as big int bitmaps are slow to update bit by bit
+        live_positions = [pos for pos, posting in enumerate(self.postings) if posting is not None]
+        facts = [posting[1] if posting is not None else None for posting in self.postings]
+        self._unsized_positions = [pos for pos in live_positions if facts[pos].size_from is None]
+        self._sized_positions = sorted(
+            (pos for pos in live_positions if facts[pos].size_from is not None), key=lambda pos: facts[pos].size_from
+        )
+        self._sized_starts = [facts[pos].size_from for pos in self._sized_positions]
+        self._max_size_len = max((facts[pos].size_to - facts[pos].size_from for pos in self._sized_positions), default=0)
+
+        byte_cnt = (len(facts) + 7) // 8
+        attr_bitmaps = {}
+        for attr_name in _ATTR_NAMES:
+            value_bits = {}
+            for pos in live_positions:
+                value = getattr(facts[pos], attr_name)
+                bits = value_bits.get(value)
+                if bits is None:
+                    bits = value_bits[value] = bytearray(byte_cnt)
+                bits[pos >> 3] |= 1 << (pos & 7)
+            attr_bitmaps[attr_name] = {value: int.from_bytes(bits, "little") for value, bits in value_bits.items()}
+        self._attr_bitmaps = attr_bitmaps
+        live_bits = bytearray(byte_cnt)
+        for pos in live_positions:
+            live_bits[pos >> 3] |= 1 << (pos & 7)
+        self._live_bitmap = int.from_bytes(live_bits, "little")
+        self._is_built = True
+
+    def _get_filter_bitmap(self, req_fact):
+        res_bitmap = self._live_bitmap
+        for attr_name in _ATTR_NAMES:
+            value = getattr(req_fact, attr_name)
+            if value is None:
+                continue
+            value_bitmaps = self._attr_bitmaps[attr_name]
+            # different attributes are not match, but if this attribute is omitted in ad, this is still match
+            res_bitmap &= value_bitmaps.get(value, 0) | value_bitmaps.get(None, 0)
+        return res_bitmap
+
+    def _iter_size_positions(self, size_from, size_to):
+        # positions of removed postings are filtered by the caller
+        yield from self._unsized_positions
+        beg_pos = bisect.bisect_left(self._sized_starts, size_from - self._max_size_len)
+        end_pos = bisect.bisect_right(self._sized_starts, size_to)
+        for sized_pos in range(beg_pos, end_pos):
+            pos = self._sized_positions[sized_pos]
+            posting = self.postings[pos]
+            if posting is not None and posting[1].size_to >= size_from:
+                yield pos
+
+    def iter_matches(self, req_fact):
+        """
+        Yields postings, which facts match request fact by size and attributes.
+        """
+        self.prepare()
+        filter_bitmap = self._get_filter_bitmap(req_fact)
+        if req_fact.size_from is None:
+            positions = _iter_set_bits(filter_bitmap)
+        else:
+            filter_bytes = filter_bitmap.to_bytes((len(self.postings) + 7) // 8, "little")
+            positions = (
+                pos for pos in self._iter_size_positions(req_fact.size_from, req_fact.size_to)
+                if filter_bytes[pos >> 3] >> (pos & 7) & 1
+            )
+        for pos in positions:
+            yield self.postings[pos]
+
+
+class AdIndex:
+    """
+    Inverted index of encoded ads by classes of their facts, so only ads with facts of matching classes are checked
+    on search. Request fact matches ad fact of the same class, or ad fact, whose parsed name is a descendant
+    of the request fact parsed name (see searcher._are_facts_close()), so postings are kept both by class
+    and by parsed name, and the request name is expanded to its descendants on search.
+    Ads without facts are not present in postings at all. Ad indices are 0-based positions in the list of added ads.
+    Ads can be replaced and removed in place: indices of removed ads are not reused and are never found.
+    Copies of the index share posting lists, until they are changed (see index_snapshots.VersionedAdIndex).
+    """
+
+    def __init__(self, ont_stat, encoded_ad_list=()):
+        self.ont_stat = ont_stat
+        self.ad_count = 0
+        self.version = 0  # is changed by every modification of the index (see result_cache.SearchResultCache)
+        self._class_postings = {}  # {class id: posting list}
+        self._name_postings = {}  # {parsed name: posting list}
+        self._ad_facts = []  # facts by ad index, None for removed ads
+        # posting lists, which are created by this index after its last copy, are changed in place,
+        # while posting lists, shared with copies, are copied on change
+        self._own_posting_list_ids = set()
+        for ad_facts in encoded_ad_list:
+            self.add_ad(ad_facts)
+
+    def add_ad(self, ad_facts):
+        """
+        Appends encoded ad to the index and returns its index.
+        """
+        ad_idx = self.ad_count
+        self.ad_count += 1
+        self._ad_facts.append(None)
+        self._insert_ad(ad_idx, ad_facts)
+        return ad_idx
+
+    def _insert_ad(self, ad_idx, ad_facts):
+        self.version += 1
+        self._ad_facts[ad_idx] = list(ad_facts)
+        for fact in ad_facts:
+            posting = (ad_idx, fact)
+            self._get_own_posting_list(self._class_postings, fact.class_id).append(posting)
+            self._get_own_posting_list(self._name_postings, fact.parsed_name).append(posting)
+
+    def remove_ad(self, ad_idx):
+        """
+        Removes ad from the search results (the index of removed ad is not reused).
+        Returns False if the ad was already removed.
+        """
+        ad_facts = self._ad_facts[ad_idx]
+        if ad_facts is None:
+            return False
+        self.version += 1
+        self._ad_facts[ad_idx] = None
+        for fact in ad_facts:
+            self._get_own_posting_list(self._class_postings, fact.class_id).remove_ad(ad_idx)
+            self._get_own_posting_list(self._name_postings, fact.parsed_name).remove_ad(ad_idx)
+        return True
+
+    def replace_ad(self, ad_idx, ad_facts):
+        """
+        Replaces facts of the ad (e.g. after its text is edited), the ad can be removed before.
+        """
+        self.remove_ad(ad_idx)
+        self._insert_ad(ad_idx, ad_facts)
+
+    def get_ad_facts(self, ad_idx):
+        """
+        Returns facts of the ad or None if it is removed.
+        """
+        return self._ad_facts[ad_idx]
+
+    def compact(self):
+        """
+        Drops all removed postings (it is also done automatically for posting lists with many removed postings).
+        """
+        for posting_lists in (self._class_postings, self._name_postings):
+            for key, posting_list in posting_lists.items():
+                if posting_list.removed_cnt > 0:
+                    self._get_own_posting_list(posting_lists, key).compact()
+
+    def copy(self):
+        """
+        Returns a copy of the index, which can be changed without changes of this index.
+        Posting lists are shared by both indices and are copied only when one of the indices changes them.
+        """
+        index_copy = copy.copy(self)
+        index_copy._class_postings = dict(self._class_postings)
+        index_copy._name_postings = dict(self._name_postings)
+        index_copy._ad_facts = list(self._ad_facts)
+        index_copy._own_posting_list_ids = set()
+        self._own_posting_list_ids = set()
+        return index_copy
+
+    def prepare(self):
+        """
+        Builds lazy structures of all posting lists, so search does not change the index.
+        """
+        for posting_lists in (self._class_postings, self._name_postings):
+            for posting_list in posting_lists.values():
+                posting_list.prepare()
+
+    def _get_own_posting_list(self, posting_lists, key):
+        # posting list to be changed
+        posting_list = posting_lists.get(key)
+        if posting_list is None:
+            posting_list = posting_lists[key] = _PostingList()
+        elif id(posting_list) not in self._own_posting_list_ids:
+            posting_list = posting_lists[key] = posting_list.copy()
+        else:
+            return posting_list
+        self._own_posting_list_ids.add(id(posting_list))
+        return posting_list
+
+    def _iter_descendant_names(self, name):
+        # descendant names of upper classes can be numerous, so the smaller of two sets is scanned
+        descendant_names = self.ont_stat["obj_name_descendants"].get(name, ())
+        if len(descendant_names) < len(self._name_postings):
+            return (d_name for d_name in descendant_names if d_name in self._name_postings and d_name != name)
+        return (d_name for d_name in self._name_postings if d_name in descendant_names and d_name != name)
+
+    def _iter_posting_lists(self, req_fact):
+        class_posting_list = self._class_postings.get(req_fact.class_id)
+        if class_posting_list is not None:
+            yield class_posting_list
+        for d_name in self._iter_descendant_names(req_fact.parsed_name):
+            yield self._name_postings[d_name]
+
+    def _iter_matches(self, req_fact):
+        for posting_list in self._iter_posting_lists(req_fact):
+            yield from posting_list.iter_matches(req_fact)
+
+    def iter_candidate_tiers(self, encoded_request):
+        """
+        Yields sets of indices of ads, which match the request: at first ads with matched facts of the same classes,
+        then the rest ads, whose facts match only by descendant classes (their score is not above MAX_DESCENDANT_SCORE).
+        The second set is not searched, if the caller stops before it.
+        """
+        same_class_idx_set = set()
+        for req_fact in encoded_request:
+            class_posting_list = self._class_postings.get(req_fact.class_id)
+            if class_posting_list is not None:
+                for ad_idx, _ in class_posting_list.iter_matches(req_fact):
+                    same_class_idx_set.add(ad_idx)
+        yield same_class_idx_set
+        descendant_idx_set = set()
+        for req_fact in encoded_request:
+            for d_name in self._iter_descendant_names(req_fact.parsed_name):
+                for ad_idx, _ in self._name_postings[d_name].iter_matches(req_fact):
+                    if ad_idx not in same_class_idx_set:
+                        descendant_idx_set.add(ad_idx)
+        yield descendant_idx_set
+
+    def search(self, encoded_request):
+        """
+        Returns sorted indices of ads, which match the request (the same as searcher.search() over all added ads).
+        """
+        found_idx_set = set()
+        for req_fact in encoded_request:
+            for ad_idx, _ in self._iter_matches(req_fact):
+                found_idx_set.add(ad_idx)
+        return sorted(found_idx_set)
+
+    def search_many(self, encoded_requests):
+        """
+        Searches ads for all requests at once and returns MatchMatrix (rows are requests).
+        Posting lists are found once for all request facts of the same class and name,
+        and equal facts of different requests are evaluated once.
+        """
+        fact_matches = {}
+        for fact_group in group_request_facts(encoded_requests).values():
+            posting_lists = list(self._iter_posting_lists(next(iter(fact_group.values()))))
+            for fact_key, req_fact in fact_group.items():
+                found_idx_set = set()
+                for posting_list in posting_lists:
+                    for ad_idx, _ in posting_list.iter_matches(req_fact):
+                        found_idx_set.add(ad_idx)
+                fact_matches[fact_key] = np.array(sorted(found_idx_set), dtype=np.int64)
+        return MatchMatrix.from_fact_matches(encoded_requests, fact_matches, self.ad_count)
+
+    def get_stats(self):
+        return {
+            "ads": self.ad_count,
+            "removed_ads": sum(1 for ad_facts in self._ad_facts if ad_facts is None),
+            "classes": len(self._class_postings),
+            "class_postings": sum(len(posting_list) for posting_list in self._class_postings.values()),
+            "names": len(self._name_postings),
+        }
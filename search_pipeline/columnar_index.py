@@ -0,0 +1,276 @@
+import copy
+import itertools
+
+import numpy as np
+
+from search_pipeline import ad_index
+
+
+# code of unspecified attribute in attribute columns
+_NO_VALUE = -1
+# fact attributes (with integer codes), which are checked on search
+_ATTR_NAMES = ("gender", "season", "material_id")
+
+
+# removed rows are dropped from columns, when their share is above this value
+COMPACTION_REMOVED_SHARE = 0.25
+# initial length of descendant masks, which is doubled, when name ids don't fit into masks
+_MIN_MASK_CAPACITY = 64
+
+
+class ColumnarAdIndex:
+    """
+    Alternative to ad_index.AdIndex: all ad facts are flattened into NumPy columns (ad index, class id, parsed name id,
+    size range with NaN for absent size, attribute codes with -1 for unspecified values, flag of not removed row),
+    and facts of a request are evaluated by vectorized boolean masks over the whole corpus.
+    Search results are the same as of AdIndex. Rows of new ads are appended to columns on the first search
+    after additions, and rows of removed ads are only flagged, until they are dropped by compaction.
+    Descendant masks of all ontology names are updated for new names together with appending of new rows,
+    so search only reads the index after prepare().
+    """
+
+    def __init__(self, ont_stat, encoded_ad_list=()):
+        self.ont_stat = ont_stat
+        self.ad_count = 0
+        self.version = 0  # is changed by every modification of the index (see result_cache.SearchResultCache)
+        self._name_ids = {}  # {parsed name: id in name column}
+        self._owns_name_ids = True  # False, while name ids are shared with a copy of the index
+        self._ad_facts = []  # facts by ad index, None for removed ads
+        self._new_rows = []  # (ad index, class id, name id, size from, size to, *attribute codes) of not added facts
+        self._columns = self._make_columns([])
+        self._removed_row_cnt = 0
+        # {request parsed name: boolean array by name id, which is True for descendant names}
+        # masks are longer than the amount of names, so new names are set in place (see _update_descendant_masks())
+        self._descendant_masks = {}
+        self._empty_descendant_mask = np.zeros(0, dtype=bool)  # mask of names without descendants
+        self._mask_name_cnt = 0  # amount of names, which are set in masks
+        self._owns_descendant_masks = True  # only one of index copies can set new names in shared masks
+        for ad_facts in encoded_ad_list:
+            self.add_ad(ad_facts)
+
+    def add_ad(self, ad_facts):
+        """
+        Appends encoded ad to the index and returns its index.
+        """
+        ad_idx = self.ad_count
+        self.ad_count += 1
+        self._ad_facts.append(None)
+        self._insert_ad(ad_idx, ad_facts)
+        return ad_idx
+
+    def _insert_ad(self, ad_idx, ad_facts):
+        self.version += 1
+        self._ad_facts[ad_idx] = list(ad_facts)
+        for fact in ad_facts:
+            name_id = self._name_ids.get(fact.parsed_name)
+            if name_id is None:
+                if not self._owns_name_ids:
+                    self._name_ids = dict(self._name_ids)
+                    self._owns_name_ids = True
+                name_id = self._name_ids[fact.parsed_name] = len(self._name_ids)
+            row = [ad_idx, fact.class_id, name_id]
+            if fact.size_from is None:
+                row += [np.nan, np.nan]
+            else:
+                row += [fact.size_from, fact.size_to]
+            for attr_name in _ATTR_NAMES:
+                value = getattr(fact, attr_name)
+                row.append(_NO_VALUE if value is None else value)
+            self._new_rows.append(row)
+
+    def remove_ad(self, ad_idx):
+        """
+        The same as ad_index.AdIndex.remove_ad().
+        """
+        if self._ad_facts[ad_idx] is None:
+            return False
+        self.version += 1
+        self._ad_facts[ad_idx] = None
+        self._append_new_rows()
+        is_live = self._columns["is_live"]
+        removed_mask = is_live & (self._columns["ad_idx"] == ad_idx)
+        # flags are replaced instead of changed in place, as columns are shared with copies of the index
+        self._columns["is_live"] = is_live & ~removed_mask
+        self._removed_row_cnt += int(np.count_nonzero(removed_mask))
+        if self._removed_row_cnt > COMPACTION_REMOVED_SHARE * len(self._columns["ad_idx"]):
+            self.compact()
+        return True
+
+    def replace_ad(self, ad_idx, ad_facts):
+        """
+        The same as ad_index.AdIndex.replace_ad().
+        """
+        self.remove_ad(ad_idx)
+        self._insert_ad(ad_idx, ad_facts)
+
+    def get_ad_facts(self, ad_idx):
+        return self._ad_facts[ad_idx]
+
+    def copy(self):
+        """
+        Returns a copy of the index, which can be changed without changes of this index.
+        Columns are shared, as they are replaced on changes, and name ids are copied only on addition of a new name.
+        Descendant masks are shared too, and the copy sets its new names in them, while this index copies masks
+        on addition of a new name. The list of ad facts is copied, so copying takes O(ads) time
+        (like AdIndex.copy()), and changes of the copy are O(facts) vectorized operations over whole columns
+        (new rows are concatenated to columns by prepare(), removal scans the ad index column).
+        """
+        index_copy = copy.copy(self)
+        index_copy._ad_facts = list(self._ad_facts)
+        # rows are not added yet only to not prepared indices
+        index_copy._new_rows = list(self._new_rows)
+        index_copy._columns = dict(self._columns)
+        index_copy._owns_name_ids = False
+        self._owns_name_ids = False
+        # this index can be a published snapshot, which is not changed, so the copy gets the right to extend masks
+        index_copy._owns_descendant_masks = self._owns_descendant_masks
+        self._owns_descendant_masks = False
+        return index_copy
+
+    def prepare(self):
+        """
+        Appends rows of new ads to columns and calculates descendant masks of new names, so search does not change
+        the index.
+        """
+        self._append_new_rows()
+        self._update_descendant_masks()
+
+    def compact(self):
+        """
+        Drops rows of removed ads from columns.
+        """
+        if self._removed_row_cnt == 0:
+            return
+        is_live = self._columns["is_live"]
+        self._columns = {name: column[is_live] for name, column in self._columns.items()}
+        self._removed_row_cnt = 0
+
+    @staticmethod
+    def _make_columns(row_list):
+        rows = np.array(row_list, dtype=np.float64).reshape(len(row_list), 5 + len(_ATTR_NAMES))
+        columns = {
+            "ad_idx": rows[:, 0].astype(np.int64),
+            "class_id": rows[:, 1].astype(np.int32),
+            "name_id": rows[:, 2].astype(np.int32),
+            "size_from": rows[:, 3],
+            "size_to": rows[:, 4],
+            "is_unsized": np.isnan(rows[:, 3]),
+            "is_live": np.ones(len(row_list), dtype=bool),
+        }
+        for col_idx, attr_name in enumerate(_ATTR_NAMES, start=5):
+            columns[attr_name] = rows[:, col_idx].astype(np.int32)
+        return columns
+
+    def _append_new_rows(self):
+        if len(self._new_rows) == 0:
+            return
+        new_columns = self._make_columns(self._new_rows)
+        self._columns = {name: np.concatenate([column, new_columns[name]]) for name, column in self._columns.items()}
+        self._new_rows = []
+
+    def _update_descendant_masks(self):
+        # name ids are only appended, so only new names are set in masks;
+        # other copies of the index, which share masks, never read ids of names, which they don't have
+        name_cnt = len(self._name_ids)
+        if name_cnt == self._mask_name_cnt:
+            return
+        capacity = len(self._empty_descendant_mask)
+        if not self._owns_descendant_masks or name_cnt > capacity:
+            if name_cnt > capacity:
+                capacity = max(2 * capacity, name_cnt, _MIN_MASK_CAPACITY)
+            descendant_masks = {}
+            for name in self.ont_stat["obj_name_descendants"]:
+                descendant_mask = np.zeros(capacity, dtype=bool)
+                old_mask = self._descendant_masks.get(name)
+                if old_mask is not None:
+                    descendant_mask[:self._mask_name_cnt] = old_mask[:self._mask_name_cnt]
+                descendant_masks[name] = descendant_mask
+            self._descendant_masks = descendant_masks
+            self._empty_descendant_mask = np.zeros(capacity, dtype=bool)
+            self._owns_descendant_masks = True
+        name_ancestors = self.ont_stat["obj_name_ancestors"]
+        for name_id, name in enumerate(itertools.islice(self._name_ids, self._mask_name_cnt, None), self._mask_name_cnt):
+            for ancestor_name in name_ancestors.get(name, ()):
+                if ancestor_name != name:
+                    self._descendant_masks[ancestor_name][name_id] = True
+        self._mask_name_cnt = name_cnt
+
+    def _get_descendant_mask(self, name):
+        # request fact matches ad fact with descendant name (see searcher._are_facts_close())
+        return self._descendant_masks.get(name, self._empty_descendant_mask)
+
+    def _calc_class_mask(self, req_fact):
+        columns = self._columns
+        class_mask = columns["class_id"] == req_fact.class_id
+        class_mask |= self._get_descendant_mask(req_fact.parsed_name)[columns["name_id"]]
+        return class_mask
+
+    @staticmethod
+    def _calc_props_mask(req_fact, columns):
+        # columns can be a subset of rows (facts of matching classes only)
+        props_mask = columns["is_live"].copy()
+        if req_fact.size_from is not None:
+            # comparisons with NaN are False, so unsized facts are added separately
+            props_mask &= columns["is_unsized"] | (
+                (columns["size_from"] <= req_fact.size_to) & (columns["size_to"] >= req_fact.size_from)
+            )
+        for attr_name in _ATTR_NAMES:
+            value = getattr(req_fact, attr_name)
+            if value is not None:
+                attr_column = columns[attr_name]
+                props_mask &= (attr_column == value) | (attr_column == _NO_VALUE)
+        return props_mask
+
+    def search(self, encoded_request):
+        """
+        Returns sorted indices of ads, which match the request (the same as searcher.search() over all added ads).
+        """
+        self.prepare()
+        if len(encoded_request) == 0:
+            return []
+        found_mask = np.zeros(len(self._columns["ad_idx"]), dtype=bool)
+        for req_fact in encoded_request:
+            found_mask |= self._calc_class_mask(req_fact) & self._calc_props_mask(req_fact, self._columns)
+        return np.unique(self._columns["ad_idx"][found_mask]).tolist()
+
+    def iter_candidate_tiers(self, encoded_request):
+        """
+        The same as ad_index.AdIndex.iter_candidate_tiers(): yields sets of indices of matched ads
+        with facts of the same classes and then with facts of descendant classes only.
+        """
+        self.prepare()
+        columns = self._columns
+        props_masks = [self._calc_props_mask(req_fact, columns) for req_fact in encoded_request]
+        same_class_mask = np.zeros(len(columns["ad_idx"]), dtype=bool)
+        for req_fact, props_mask in zip(encoded_request, props_masks):
+            same_class_mask |= (columns["class_id"] == req_fact.class_id) & props_mask
+        same_class_idx_set = set(columns["ad_idx"][same_class_mask].tolist())
+        yield same_class_idx_set
+        descendant_mask = np.zeros(len(columns["ad_idx"]), dtype=bool)
+        for req_fact, props_mask in zip(encoded_request, props_masks):
+            descendant_mask |= self._get_descendant_mask(req_fact.parsed_name)[columns["name_id"]] & props_mask
+        yield set(columns["ad_idx"][descendant_mask].tolist()) - same_class_idx_set
+
+    def search_many(self, encoded_requests):
+        """
+        Searches ads for all requests at once and returns ad_index.MatchMatrix (rows are requests).
+        Class mask is calculated once for all request facts of the same class and name, and sizes and attributes
+        are checked only for the facts of matching classes. Equal facts of different requests are evaluated once.
+        """
+        self.prepare()
+        fact_matches = {}
+        for fact_group in ad_index.group_request_facts(encoded_requests).values():
+            class_rows = np.flatnonzero(self._calc_class_mask(next(iter(fact_group.values()))))
+            class_columns = {name: column[class_rows] for name, column in self._columns.items()}
+            for fact_key, req_fact in fact_group.items():
+                props_mask = self._calc_props_mask(req_fact, class_columns)
+                fact_matches[fact_key] = np.unique(class_columns["ad_idx"][props_mask])
+        return ad_index.MatchMatrix.from_fact_matches(encoded_requests, fact_matches, self.ad_count)
+
+    def get_stats(self):
+        return {
+            "ads": self.ad_count,
+            "removed_ads": sum(1 for ad_facts in self._ad_facts if ad_facts is None),
+            "facts": len(self._columns["ad_idx"]) + len(self._new_rows) - self._removed_row_cnt,
+            "names": len(self._name_ids),
+        }
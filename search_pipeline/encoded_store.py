@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+
+from search_pipeline import cloth_handler
+
+
+# must be increased on any change of the stored fact format
+STORE_FORMAT_VERSION = 1
+
+
+def calc_text_hash(text):
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+class EncodedStore:
+    """
+    Persistent storage of encoded texts (lists of facts), keyed by MD5 of the text,
+    so only new or changed lines of a database are encoded again.
+    All stored facts become stale on the change of the encoder version (ontology, grammar, parser code),
+    in this case the store is loaded empty.
+    Entries, which were not requested since loading, are evicted on saving (lines, removed from the database).
+    """
+
+    def __init__(self, path, encoder_version):
+        self.path = path
+        self.encoder_version = encoder_version
+        self._entries = {}
+        self._used_keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def load(self):
+        """
+        Loads stored facts, saved by save() with the same encoder version.
+        Returns True if the store was loaded.
+        """
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format_version") != STORE_FORMAT_VERSION or data.get("encoder_version") != self.encoder_version:
+            return False
+        self._entries = data["entries"]
+        return True
+
+    def get(self, text):
+        """
+        Returns the list of stored facts for the text or None if the text was not encoded yet.
+        """
+        key = calc_text_hash(text)
+        fact_dicts = self._entries.get(key)
+        if fact_dicts is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used_keys.add(key)
+        return [cloth_handler.ClothFact.from_dict(fact_dict) for fact_dict in fact_dicts]
+
+    def put(self, text, facts):
+        key = calc_text_hash(text)
+        self._entries[key] = [fact.to_dict() for fact in facts]
+        self._used_keys.add(key)
+
+    def evict_unused(self):
+        """
+        Removes entries, which were neither requested nor added since loading. Returns the amount of removed entries.
+        """
+        stale_keys = [key for key in self._entries if key not in self._used_keys]
+        for key in stale_keys:
+            del self._entries[key]
+        self.evicted += len(stale_keys)
+        return len(stale_keys)
+
+    def save(self, evict=True):
+        if evict:
+            self.evict_unused()
+        # write to a temporary file first, so an interrupted save does not break the stored data
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "format_version": STORE_FORMAT_VERSION,
+                    "encoder_version": self.encoder_version,
+                    "entries": self._entries,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.path)
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
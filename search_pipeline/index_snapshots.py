@@ -0,0 +1,53 @@
+import threading
+
+
+class VersionedAdIndex:
+    """
+    Ad index for searches from many threads while ads are changed. Searches use a published snapshot
+    (ad_index.AdIndex or columnar_index.ColumnarAdIndex), which is never changed after publication:
+        snapshot = versioned_index.get_snapshot()
+        searcher.search_index(encoded_request, snapshot)
+    Writers change a copy of the current snapshot (unchanged parts are shared with it), prepare it for search
+    and publish it by replacement of the reference, which is atomic, so there are no locks on the read path.
+    The old snapshot is freed by the garbage collector, when its last reader drops the reference.
+    Writers are serialized by a lock, so every change is applied to the latest snapshot.
+    """
+
+    def __init__(self, index):
+        index.prepare()
+        self._snapshot = index
+        self._write_lock = threading.Lock()
+        self.published_cnt = 1
+
+    def get_snapshot(self):
+        """
+        Returns the latest published snapshot, which must not be changed by the caller.
+        """
+        return self._snapshot
+
+    def update(self, update_func):
+        """
+        Calls update_func(index) for a copy of the latest snapshot and publishes the changed copy.
+        Several changes can be applied in one call, so they are published together.
+        Returns the result of update_func.
+        """
+        with self._write_lock:
+            next_index = self._snapshot.copy()
+            res = update_func(next_index)
+            next_index.prepare()
+            self._snapshot = next_index
+            self.published_cnt += 1
+        return res
+
+    def add_ad(self, ad_facts):
+        return self.update(lambda index: index.add_ad(ad_facts))
+
+    def replace_ad(self, ad_idx, ad_facts):
+        return self.update(lambda index: index.replace_ad(ad_idx, ad_facts))
+
+    def remove_ad(self, ad_idx):
+        return self.update(lambda index: index.remove_ad(ad_idx))
+
+    def get_stats(self):
+        snapshot = self._snapshot
+        return {"version": snapshot.version, "published": self.published_cnt, **snapshot.get_stats()}
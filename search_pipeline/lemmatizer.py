@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import json
+
+import pymorphy3
+import razdel
+
+
+DEFAULT_MAX_CACHE_SIZE = 200000
+
+
+def get_morph_version(morph_an):
+    """
+    Returns version of pymorphy3 and of its dictionary (dictionaries are versioned apart from pymorphy3),
+    as both of them define normal forms.
+    """
+    meta = morph_an.dictionary.meta
+    return f"{pymorphy3.__version__}/{meta.get('source_revision')}/{meta.get('compiled_at')}"
+
+
+def _is_trivial_token(tok):
+    # pymorphy3 returns lowercased token as normal form for tokens without letters (numbers, punctuation)
+    # and for Latin tokens (including size letters like "XL")
+    return tok.isascii() or not any(c.isalpha() for c in tok)
+
+
+class CachedLemmatizer:
+    """
+    Bounded LRU cache of pymorphy3 normal forms (the first parse is used, as in text_parser).
+    Tokens, which are cheap to reject (numbers, punctuation, Latin), are not passed to the analyzer at all.
+    """
+
+    def __init__(self, morph_an, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.morph_an = morph_an
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+
+    def normal_form(self, tok):
+        if _is_trivial_token(tok):
+            self.skips += 1
+            return tok.lower()
+        norm_form = self._cache.get(tok)
+        if norm_form is not None:
+            self.hits += 1
+            self._cache.move_to_end(tok)
+            return norm_form
+        self.misses += 1
+        norm_form = self.morph_an.parse(tok)[0].normal_form
+        self._put(tok, norm_form)
+        return norm_form
+
+    def _put(self, tok, norm_form):
+        self._cache[tok] = norm_form
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def warm_up(self, texts):
+        """
+        Lemmatizes the unique vocabulary of the whole corpus once, so encoding of the texts only hits the cache.
+        Returns the amount of newly lemmatized tokens.
+        """
+        vocab = set()
+        for text in texts:
+            vocab.update(tok.text for tok in razdel.tokenize(text))
+        new_cnt = 0
+        for tok in vocab:
+            if not _is_trivial_token(tok) and tok not in self._cache:
+                self._put(tok, self.morph_an.parse(tok)[0].normal_form)
+                new_cnt += 1
+        return new_cnt
+
+    def get_stats(self):
+        calls = self.hits + self.misses + self.skips
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skips": self.skips,
+            "hit_rate": (self.hits + self.skips) / calls if calls > 0 else 0.0,
+        }
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"morph_version": get_morph_version(self.morph_an), "normal_forms": self._cache}, f, ensure_ascii=False)
+
+    def load(self, path):
+        """
+        Loads normal forms, saved by save(). The file is ignored if it was made by another version of pymorphy3
+        or of its dictionary.
+        Returns True if the cache was loaded.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("morph_version") != get_morph_version(self.morph_an):
+            return False
+        self.update(data["normal_forms"])
+        return True
+
+    def get_normal_form_map(self):
+        return dict(self._cache)
+
+    def update(self, normal_form_map):
+        for tok, norm_form in normal_form_map.items():
+            self._put(tok, norm_form)
+
+
+def get_normal_forms(morph_an, toks):
+    """
+    Lemmatizes tokens either with plain pymorphy3 analyzer or with CachedLemmatizer.
+    """
+    if isinstance(morph_an, CachedLemmatizer):
+        return [morph_an.normal_form(tok) for tok in toks]
+    return [morph_an.parse(tok)[0].normal_form for tok in toks]
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import pickle
+
+from search_pipeline import cloth_handler
+from search_pipeline import text_parser
+
+
+# modules, whose code defines snapshot content (including ClothFact attribute codes)
+_SNAPSHOT_MODULE_PATHS = tuple(module.__file__ for module in (text_parser, cloth_handler)) + (__file__,)
+
+
+def _default_snapshot_path(ttl_path):
+    return os.path.splitext(ttl_path)[0] + ".snapshot.pkl"
+
+
+def calc_ttl_hash(ttl_path):
+    with open(ttl_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def calc_code_hash(module_paths=_SNAPSHOT_MODULE_PATHS):
+    # any change of the code, which builds the snapshot, leads to rebuild of old snapshots
+    code_hash = hashlib.md5()
+    for path in module_paths:
+        with open(path, "rb") as f:
+            code_hash.update(f.read())
+    return code_hash.hexdigest()
+
+
+def calc_completion_vocabulary(ont):
+    """
+    Collects all ontology names, which are used for completion of user input in interactive search.
+    Output - dictionary with the following keys:
+        * "attr_names" - sorted list with one (minimal) name for every parsed attribute
+        * "obj_names" - sorted list of names of all parsed objects (for prefix search)
+        * "obj_child_names" - {node in N3 notation: sorted names of parsed objects, which are its direct subclasses}
+        * "obj_name_parts" - {name: set of names of parsed objects, which are its parts (has_part+)}
+    """
+    res = ont.query(
+        "SELECT DISTINCT (MIN(?name) AS ?minName) "
+        "WHERE { "
+        "    ?attr_obj local:is_included local:parsed_attributes . "
+        "    ?attr_obj local:has_name ?name . "
+        "} GROUP BY ?attr_obj"
+    )
+    attr_names = sorted(row[0].toPython() for row in res)
+
+    res = ont.query(
+        "SELECT DISTINCT ?name "
+        "WHERE { "
+        "    ?main_obj local:is_included local:parsed_objects . "
+        "    ?main_obj local:has_name ?name . "
+        "}"
+    )
+    obj_names = sorted(row[0].toPython() for row in res)
+
+    res = ont.query(
+        "SELECT DISTINCT ?parent_obj ?name "
+        "WHERE { "
+        "    ?main_obj local:is_included local:parsed_objects . "
+        "    ?main_obj local:is_subclass ?parent_obj . "
+        "    ?main_obj local:has_name ?name . "
+        "}"
+    )
+    obj_child_names = {}
+    for row in res:
+        obj_child_names.setdefault(row[0].n3(ont.namespace_manager), []).append(row[1].toPython())
+    obj_child_names = {k: sorted(v) for k, v in obj_child_names.items()}
+
+    res = ont.query(
+        "SELECT DISTINCT ?main_name ?part_name "
+        "WHERE { "
+        "    ?main_obj local:is_included local:parsed_objects . "
+        "    ?main_obj local:has_part+ ?part_obj . "
+        "    ?part_obj local:is_included local:parsed_objects . "
+        "    ?main_obj local:has_name ?main_name . "
+        "    ?part_obj local:has_name ?part_name . "
+        "}"
+    )
+    obj_name_parts = {}
+    for row in res:
+        obj_name_parts.setdefault(row[0].toPython(), set()).add(row[1].toPython())
+
+    return {
+        "attr_names": attr_names,
+        "obj_names": obj_names,
+        "obj_child_names": obj_child_names,
+        "obj_name_parts": obj_name_parts,
+    }
+
+
+def build_snapshot(ttl_path, ttl_hash=None):
+    import rdflib  # parsing is needed only on rebuild, so import time is not spent on the hot path
+
+    if ttl_hash is None:
+        ttl_hash = calc_ttl_hash(ttl_path)
+    ont = rdflib.Graph()
+    ont.parse(source=ttl_path, format="turtle")
+    return {
+        "code_hash": calc_code_hash(),
+        "ttl_hash": ttl_hash,
+        "ont_stat": text_parser.calc_ontology_stat(ont),
+        "completion": calc_completion_vocabulary(ont),
+    }
+
+
+def load_snapshot(ttl_path, snapshot_path=None):
+    """
+    Loads compiled ontology data (see build_snapshot()) from the snapshot file near the TTL file.
+    Snapshot is rebuilt and saved automatically if it is absent or TTL content or code of building has changed.
+    """
+    if snapshot_path is None:
+        snapshot_path = _default_snapshot_path(ttl_path)
+    ttl_hash = calc_ttl_hash(ttl_path)
+
+    snapshot = None
+    if os.path.isfile(snapshot_path):
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            snapshot = None  # broken or incompatible file is just rebuilt
+    if (
+        not isinstance(snapshot, dict) or
+        snapshot.get("code_hash") != calc_code_hash() or
+        snapshot.get("ttl_hash") != ttl_hash
+    ):
+        snapshot = build_snapshot(ttl_path, ttl_hash)
+        # write to a temporary file first, so parallel processes never read a partially written snapshot
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+
+    return snapshot
+
+
+def load_ontology_stat(ttl_path, snapshot_path=None):
+    return load_snapshot(ttl_path, snapshot_path)["ont_stat"]
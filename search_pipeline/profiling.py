@@ -0,0 +1,110 @@
+import json
+import time
+
+
+_enabled = False
+# {stage name: [total wall time in seconds, amount of calls]}
+_stage_stats = {}
+
+
+class _StageTimer:
+
+    __slots__ = ("name", "beg_time")
+
+    def __init__(self, name):
+        self.name = name
+        self.beg_time = None
+
+    def __enter__(self):
+        self.beg_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stage_stat = _stage_stats.get(self.name)
+        if stage_stat is None:
+            stage_stat = _stage_stats[self.name] = [0.0, 0]
+        stage_stat[0] += time.perf_counter() - self.beg_time
+        stage_stat[1] += 1
+        return False
+
+
+class _NullTimer:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def is_enabled():
+    return _enabled
+
+
+def stage(name):
+    """
+    Context manager, which adds wall time of its block to the stage stats, if profiling is enabled:
+        with profiling.stage("tokenization"):
+            ...
+    When profiling is disabled, the shared no-op object is returned, so the overhead is a function call.
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _StageTimer(name)
+
+
+def reset():
+    _stage_stats.clear()
+
+
+def pop_raw_stats():
+    """
+    Returns accumulated stats in the form, which is accepted by merge_raw_stats(), and resets them
+    (used to collect stats from worker processes).
+    """
+    raw_stats = {name: list(stage_stat) for name, stage_stat in _stage_stats.items()}
+    reset()
+    return raw_stats
+
+
+def merge_raw_stats(raw_stats):
+    for name, (total_time, call_cnt) in raw_stats.items():
+        stage_stat = _stage_stats.setdefault(name, [0.0, 0])
+        stage_stat[0] += total_time
+        stage_stat[1] += call_cnt
+
+
+def get_stats():
+    """
+    Output - dictionary {stage name: {"total_sec": ..., "calls": ..., "avg_ms": ...}}, sorted by total time.
+    """
+    stats = {}
+    for name, (total_time, call_cnt) in sorted(_stage_stats.items(), key=lambda x: x[1][0], reverse=True):
+        stats[name] = {
+            "total_sec": total_time,
+            "calls": call_cnt,
+            "avg_ms": total_time / call_cnt * 1000 if call_cnt > 0 else 0.0,
+        }
+    return stats
+
+
+def format_stats():
+    lines = [f"{'stage':<24}{'total, s':>12}{'calls':>10}{'avg, ms':>12}"]
+    for name, stage_stat in get_stats().items():
+        lines.append(f"{name:<24}{stage_stat['total_sec']:>12.3f}{stage_stat['calls']:>10}{stage_stat['avg_ms']:>12.3f}")
+    return "\n".join(lines)
+
+
+def save_stats(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(get_stats(), f, indent=4)
@@ -0,0 +1,90 @@
+from collections import Counter, OrderedDict
+import threading
+import weakref
+
+from search_pipeline import ad_index
+
+
+DEFAULT_MAX_CACHE_SIZE = 10000
+
+
+def calc_request_fingerprint(encoded_request):
+    """
+    Returns canonical key of request facts, which does not depend on the order of facts and on the request wording,
+    so requests like "ищу куртку 44" and "куплю куртку размер 44" have the same key.
+    Repeated facts are counted, as they change graded scores.
+    """
+    return frozenset(Counter(ad_index.get_fact_key(fact) for fact in encoded_request).items())
+
+
+class SearchResultCache:
+    """
+    Bounded LRU cache of search results by request fingerprint and search parameters.
+    Results are valid only for the same version of the same ad index, so the cache is cleared,
+    when another index is searched or the index is changed. The index is referenced weakly, so the cache does not
+    keep superseded snapshots (see index_snapshots.VersionedAdIndex) in memory.
+    The cache can be shared by threads: its state is guarded by a lock, while searches on cache misses run unlocked.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._index_ref = None
+        self._index_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _is_current_index(self, index):
+        # reference of a freed index returns None
+        return self._index_ref is not None and self._index_ref() is index and index.version == self._index_version
+
+    def _check_index(self, index):
+        if self._is_current_index(index):
+            return
+        if len(self._cache) > 0:
+            self.invalidations += 1
+            self._cache.clear()
+        self._index_ref = weakref.ref(index)
+        self._index_version = index.version
+
+    def get_or_search(self, index, encoded_request, search_func, *args):
+        """
+        Returns cached result of search_func(encoded_request, *args) over the index or calls it on cache miss.
+        """
+        key = (calc_request_fingerprint(encoded_request), args)
+        with self._lock:
+            self._check_index(index)
+            res = self._cache.get(key)
+            if res is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return list(res)
+            self.misses += 1
+        res = search_func(encoded_request, *args)
+        with self._lock:
+            # another thread can switch the cache to another index during the search
+            if self._is_current_index(index):
+                # results are stored as tuples, so callers can't change them
+                self._cache[key] = tuple(res)
+                if len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        return list(res)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+        }
@@ -1,53 +1,340 @@
-from typing import List, Any
+from typing import List, Any, Iterable, Iterator, Optional, Tuple
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
 
-import rdflib
 import pymorphy3
 
 from search_pipeline import text_parser
+from search_pipeline import ontology_snapshot
+from search_pipeline import lemmatizer
+from search_pipeline import cloth_handler
+from search_pipeline import size_decoder
+from search_pipeline import encoded_store
+from search_pipeline import profiling
+from search_pipeline import ad_index
+from search_pipeline import columnar_index
+from search_pipeline import result_cache
+from search_pipeline import index_snapshots
 
 
-ONTOLOGY = rdflib.Graph()
-ONTOLOGY.parse(source="search_pipeline/ontology.ttl", format="turtle")
+ONTOLOGY_PATH = "search_pipeline/ontology.ttl"
+LEMMA_CACHE_PATH = "search_pipeline/lemmas.cache.json"
+ENCODED_STORE_PATH = "search_pipeline/encoded.cache.json"
+ENCODING_CHUNK_SIZE = 64
+# amount of the last unique texts, whose facts are kept to deduplicate the stream of texts
+DEDUP_CACHE_SIZE = 20000
+
+# implementations of ad index with the same interface, which can be selected by name
+AD_INDEX_BACKENDS = {
+    "python": ad_index.AdIndex,
+    "numpy": columnar_index.ColumnarAdIndex,
+}
+DEFAULT_AD_INDEX_BACKEND = "python"
+
+_SPACE_RUN_RE = re.compile(r"[^\S\r\n]+")
+
 MORPH_AN = pymorphy3.MorphAnalyzer()
+LEMMATIZER = lemmatizer.CachedLemmatizer(MORPH_AN)
 SIZE_RULE = text_parser.create_size_info_rule()
-ONT_STAT = text_parser.calc_ontology_stat(ONTOLOGY)
+_ONT_SNAPSHOT = ontology_snapshot.load_snapshot(ONTOLOGY_PATH)
+ONT_STAT = _ONT_SNAPSHOT["ont_stat"]
+
+
+# modules, whose code (including size tables) defines encoded facts
+_ENCODER_MODULE_PATHS = tuple(
+    module.__file__ for module in (text_parser, cloth_handler, size_decoder, lemmatizer)
+)
+
+
+def _calc_encoder_version(module_paths=_ENCODER_MODULE_PATHS) -> str:
+    # facts depend on the ontology, the size grammar and the parsing code, so any change of them invalidates stored facts
+    version_hash = hashlib.md5()
+    version_hash.update(_ONT_SNAPSHOT["ttl_hash"].encode("utf-8"))
+    version_hash.update(lemmatizer.get_morph_version(MORPH_AN).encode("utf-8"))
+    for path in module_paths:
+        with open(path, "rb") as f:
+            version_hash.update(f.read())
+    return version_hash.hexdigest()
+
+
+ENCODER_VERSION = _calc_encoder_version()
+
+
+def load_lemma_cache() -> bool:
+    if not os.path.isfile(LEMMA_CACHE_PATH):
+        return False
+    return LEMMATIZER.load(LEMMA_CACHE_PATH)
+
+
+def save_lemma_cache() -> None:
+    LEMMATIZER.save(LEMMA_CACHE_PATH)
+
+
+def load_encoded_store(path: str = ENCODED_STORE_PATH) -> encoded_store.EncodedStore:
+    """
+    Creates the store of encoded texts for the current encoder version and loads saved facts into it (if they are valid).
+    """
+    store = encoded_store.EncodedStore(path, ENCODER_VERSION)
+    store.load()
+    return store
+
+
+def _init_encoding_worker(normal_form_map: dict, is_profiling: bool) -> None:
+    # ontology stats, morph analyzer and size rule are module globals, which are created on import (or inherited on fork),
+    # so the worker only gets lemmas, known to the main process, and compiles size parsers once
+    LEMMATIZER.update(normal_form_map)
+    text_parser._get_size_parsers(SIZE_RULE)
+    profiling.enable(is_profiling)
+    profiling.reset()
+
+
+def _encode_texts(string_list: List[str]) -> List[Any]:
+    # raw yargy trees are not kept by default (they can't be pickled to be returned from worker processes anyway)
+    encoded_list = []
+    for string in string_list:
+        with profiling.stage("extract_facts"):
+            encoded_list.append(text_parser.extract_facts(string, ONT_STAT, LEMMATIZER, SIZE_RULE))
+    return encoded_list
+
+
+def _encode_texts_in_worker(string_list: List[str]) -> Tuple[List[Any], dict]:
+    # stage timings of the worker are returned with every chunk, so they are summed up in the main process
+    return _encode_texts(string_list), profiling.pop_raw_stats()
+
+
+def _make_encoding_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_encoding_worker,
+        initargs=(LEMMATIZER.get_normal_form_map(), profiling.is_enabled()),
+    )
+
+
+def _iter_chunks(line_iter: Iterator[str], chunk_size: int) -> Iterator[List[str]]:
+    while True:
+        chunk = list(itertools.islice(line_iter, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+def _get_worker_result(future: concurrent.futures.Future) -> List[Any]:
+    encoded_list, raw_stats = future.result()
+    profiling.merge_raw_stats(raw_stats)
+    return encoded_list
+
+
+def _iter_pool_encoded_chunks(chunk_iter: Iterator[List[str]], workers: int) -> Iterator[List[Any]]:
+    # only a few chunks are submitted ahead, so memory does not depend on the input size
+    with _make_encoding_pool(workers) as executor:
+        pending = collections.deque()
+        try:
+            for chunk in chunk_iter:
+                pending.append(executor.submit(_encode_texts_in_worker, chunk))
+                if len(pending) >= 2 * workers:
+                    yield _get_worker_result(pending.popleft())
+            while len(pending) > 0:
+                yield _get_worker_result(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
 
 
-def encode_strings(string_list: List[str]) -> List[Any]:
-    encoded_list = [text_parser.extract_facts(string, ONTOLOGY, ONT_STAT, MORPH_AN, SIZE_RULE) for string in string_list]
+def _calc_dedup_key(text: str) -> bytes:
+    # runs of spaces and tabs do not change tokens of both razdel and yargy, while line breaks are tokens for yargy
+    return hashlib.md5(_SPACE_RUN_RE.sub(" ", text).strip().encode("utf-8")).digest()
+
+
+def _load_checkpoint(checkpoint_path: Optional[str]) -> int:
+    if checkpoint_path is None or not os.path.isfile(checkpoint_path):
+        return 0
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return json.load(f)["last_id"]
+
+
+def _save_checkpoint(checkpoint_path: Optional[str], last_id: int) -> None:
+    if checkpoint_path is None:
+        return
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"last_id": last_id}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def iter_encoded_strings(
+    lines: Iterable[str],
+    workers: int = 1,
+    chunk_size: int = ENCODING_CHUNK_SIZE,
+    checkpoint_path: Optional[str] = None,
+    store: Optional[encoded_store.EncodedStore] = None,
+    stats: Optional[dict] = None,
+    dedup_cache_size: int = DEDUP_CACHE_SIZE,
+) -> Iterator[Tuple[int, List[Any]]]:
+    """
+    Lazily encodes texts from any iterable (e.g. opened file) and yields (ID, facts) pairs in the input order,
+    where ID is 1-based line number. Only a few chunks of texts are held in memory at the same time.
+    Texts, which are equal up to spaces to one of the last dedup_cache_size unique texts, are not encoded again
+    and get the same list of facts.
+    If checkpoint path is given, ID of the last consumed line is saved there after every chunk,
+    and the next call with the same checkpoint skips already consumed lines without encoding.
+    If store is given, facts of already known texts are taken from it and only the rest texts are encoded
+    (and added to the store).
+    If stats dictionary is given, it is updated with amounts of all and unique texts and the share of duplicates
+    (texts, which are equal to a text, evicted from the dedup cache, are counted as unique).
+    """
+    last_id = _load_checkpoint(checkpoint_path)
+    line_iter = iter(lines)
+    for _ in itertools.islice(line_iter, last_id):
+        pass
+
+    # facts of the last unique texts by dedup key
+    recent_facts = collections.OrderedDict()
+    # texts, which are sent to encoding, but are not merged back yet: {dedup key: [facts or None, amount of uses]},
+    # its size is bounded by the amount of texts in chunks, which are taken ahead
+    pending = {}
+    text_cnt = 0
+    unique_cnt = 0
+    if stats is not None:
+        stats.update({"texts": 0, "unique_texts": 0, "dedup_ratio": 0.0})
+    # chunks with their known facts wait here, while their new texts are encoded (the pool takes chunks ahead)
+    split_chunks = collections.deque()
+
+    def _put_recent_facts(key, facts):
+        recent_facts[key] = facts
+        if len(recent_facts) > dedup_cache_size:
+            recent_facts.popitem(last=False)
+
+    def _iter_new_texts():
+        for chunk in _iter_chunks(line_iter, chunk_size):
+            # facts of every text or dedup key of the pending text
+            sources = []
+            chunk_unique_cnt = 0
+            new_flags = []
+            new_texts = []
+            for text in chunk:
+                key = _calc_dedup_key(text)
+                is_new = False
+                pending_entry = pending.get(key)
+                if pending_entry is not None:
+                    pending_entry[1] += 1
+                    sources.append(key)
+                elif key in recent_facts:
+                    recent_facts.move_to_end(key)
+                    sources.append(recent_facts[key])
+                else:
+                    chunk_unique_cnt += 1
+                    facts = store.get(text) if store is not None else None
+                    if facts is None:
+                        is_new = True
+                        pending[key] = [None, 1]
+                        new_texts.append(text)
+                        sources.append(key)
+                    else:
+                        _put_recent_facts(key, facts)
+                        sources.append(facts)
+                new_flags.append(is_new)
+            split_chunks.append((chunk, sources, new_flags, chunk_unique_cnt))
+            yield new_texts
+
+    if workers <= 1:
+        encoded_chunk_iter = (_encode_texts(chunk) for chunk in _iter_new_texts())
+    else:
+        encoded_chunk_iter = _iter_pool_encoded_chunks(_iter_new_texts(), workers)
+    for encoded_new in encoded_chunk_iter:
+        chunk, sources, new_flags, chunk_unique_cnt = split_chunks.popleft()
+        encoded_iter = iter(encoded_new)
+        encoded_chunk = []
+        for text, source, is_new in zip(chunk, sources, new_flags):
+            if is_new:
+                pending[source][0] = next(encoded_iter)
+                if store is not None:
+                    store.put(text, pending[source][0])
+            if isinstance(source, bytes):
+                # the first occurrence of the text is always merged before its duplicates
+                pending_entry = pending[source]
+                encoded_chunk.append(pending_entry[0])
+                pending_entry[1] -= 1
+                if pending_entry[1] == 0:
+                    del pending[source]
+                    _put_recent_facts(source, pending_entry[0])
+            else:
+                encoded_chunk.append(source)
+        text_cnt += len(chunk)
+        unique_cnt += chunk_unique_cnt
+        if stats is not None:
+            stats["texts"] = text_cnt
+            stats["unique_texts"] = unique_cnt
+            stats["dedup_ratio"] = 1 - unique_cnt / text_cnt
+        for facts in encoded_chunk:
+            last_id += 1
+            yield last_id, facts
+        # generator is resumed only after the consumer has taken all facts of the chunk
+        _save_checkpoint(checkpoint_path, last_id)
+
+
+def encode_strings(
+    string_list: List[str],
+    workers: int = 1,
+    chunk_size: int = ENCODING_CHUNK_SIZE,
+    store: Optional[encoded_store.EncodedStore] = None,
+    stats: Optional[dict] = None,
+) -> List[Any]:
+    """
+    Encodes texts to lists of facts (see iter_encoded_strings() for deduplication of texts and stats).
+    With workers > 1, texts are split into chunks, which are encoded by a process pool,
+    and the results are returned in the input order (raw yargy parse trees are not returned from worker processes).
+    If store is given, only texts, which are absent in it, are encoded (stored facts have no raw parse trees too).
+    """
+    if workers > 1 and len(string_list) <= chunk_size:
+        workers = 1  # pool start is slower than encoding of a single chunk
+    encoded_list = [
+        facts for _, facts in iter_encoded_strings(string_list, workers, chunk_size, store=store, stats=stats)
+    ]
     return encoded_list
 
 
-def _are_facts_close(ont: Any, req_facts: List[Any], ad_facts: List[Any]):
+def _are_facts_close(ont_stat: Any, req_facts: List[Any], ad_facts: List[Any]):
     for req_fact in req_facts:
         for ad_fact in ad_facts:
-            if req_fact.class_name != ad_fact.class_name:
-                if text_parser._get_relation(ont, req_fact.parsed_name, ad_fact.parsed_name, is_attr=False) != 1:
+            if req_fact.class_id != ad_fact.class_id:
+                if text_parser._get_relation(ont_stat, req_fact.parsed_name, ad_fact.parsed_name, is_attr=False) != 1:
                     continue
-            ad_size = ad_fact.parsed_size_info
-            req_size = req_fact.parsed_size_info
-            if req_size is not None and ad_size is not None:
-                if max(req_size) < min(ad_size) or min(req_size) > max(ad_size):
-                    # any intersection of sized is a match, but no intersection means no match
-                    continue
-            is_match = True
-            for attr_name in req_fact.props.keys():
-                ad_attr = ad_fact.props.get(attr_name, None)
-                req_attr = req_fact.props.get(attr_name, None)
-                if req_attr is not None and ad_attr is not None:
-                    # different attributes are not match, but if this attribute is omitted in request or ad, this is still match
-                    if req_attr != ad_attr:
-                        is_match = False
-                        break
-            if not is_match:
-                continue
-            # even one matched fact is complete match between request and ad
-            return True
+            if ad_index.is_fact_props_match(req_fact, ad_fact):
+                # even one matched fact is complete match between request and ad
+                return True
     return False
 
 
-def get_probs(encoded_request: Any, encoded_ad_list: List[Any]) -> List[int]:
-    probs = [1 if _are_facts_close(ONTOLOGY, encoded_request, enc_ad) else 0 for enc_ad in encoded_ad_list]
+def _calc_facts_score(ont_stat: Any, req_facts: List[Any], ad_facts: List[Any]) -> float:
+    # the best matched ad fact is taken for every request fact, so ads, which match more request facts, are better
+    score_sum = 0.0
+    for req_fact in req_facts:
+        best_score = 0.0
+        for ad_fact in ad_facts:
+            is_same_class = req_fact.class_id == ad_fact.class_id
+            if not is_same_class:
+                if text_parser._get_relation(ont_stat, req_fact.parsed_name, ad_fact.parsed_name, is_attr=False) != 1:
+                    continue
+            if ad_index.is_fact_props_match(req_fact, ad_fact):
+                best_score = max(best_score, ad_index.calc_fact_score(req_fact, ad_fact, is_same_class))
+        score_sum += best_score
+    return score_sum / len(req_facts) if len(req_facts) > 0 else 0.0
+
+
+def get_probs(encoded_request: Any, encoded_ad_list: List[Any], graded: bool = False) -> List[float]:
+    """
+    Returns 1 for matched ads and 0 for the rest ones. If graded flag is set, matched ads get scores in (0, 1]
+    instead (see ad_index.calc_fact_score()), which are averaged over request facts.
+    """
+    if graded:
+        return [_calc_facts_score(ONT_STAT, encoded_request, enc_ad) for enc_ad in encoded_ad_list]
+    probs = [1 if _are_facts_close(ONT_STAT, encoded_request, enc_ad) else 0 for enc_ad in encoded_ad_list]
     return probs
 
 
@@ -58,5 +345,84 @@ def search(encoded_request: Any, encoded_ad_list: List[Any]) -> List[int]:
         if prob == 1:
             found_idx_list.append(idx)
 
-    # return indexes sorted by largest probability
+    # indexes are in the order of ads (see search_top_k() for order by score)
     return found_idx_list
+
+
+def build_ad_index(encoded_ad_list: Iterable[Any], backend: str = DEFAULT_AD_INDEX_BACKEND) -> Any:
+    """
+    Builds ad index of the backend from AD_INDEX_BACKENDS: "python" (inverted index by classes)
+    or "numpy" (vectorized scan of fact columns).
+    """
+    index_class = AD_INDEX_BACKENDS.get(backend)
+    if index_class is None:
+        raise ValueError(f"Unknown ad index backend: {backend}")
+    return index_class(ONT_STAT, encoded_ad_list)
+
+
+def build_versioned_ad_index(
+    encoded_ad_list: Iterable[Any], backend: str = DEFAULT_AD_INDEX_BACKEND
+) -> index_snapshots.VersionedAdIndex:
+    """
+    Builds ad index (see build_ad_index()), which can be searched from many threads, while ads are changed.
+    """
+    return index_snapshots.VersionedAdIndex(build_ad_index(encoded_ad_list, backend))
+
+
+def search_index(
+    encoded_request: Any, index: Any, cache: Optional[result_cache.SearchResultCache] = None
+) -> List[int]:
+    """
+    The same as search(), but only ads with facts of matching classes are checked.
+    If cache is given, requests with the same facts as already searched ones are not searched again.
+    """
+    if cache is not None:
+        return cache.get_or_search(index, encoded_request, index.search)
+    return index.search(encoded_request)
+
+
+def search_many(encoded_requests: List[Any], index: Any) -> ad_index.MatchMatrix:
+    """
+    Searches ads for all requests at once. Output - sparse request × ad match matrix (ad_index.MatchMatrix),
+    whose row i contains the same 0-based ad indices as search_index() for request i.
+    """
+    return index.search_many(encoded_requests)
+
+
+def search_top_k(
+    encoded_request: Any,
+    index: Any,
+    k: int,
+    min_score: float = 0.0,
+    cache: Optional[result_cache.SearchResultCache] = None,
+) -> List[Tuple[int, float]]:
+    """
+    Returns up to k (ad index, graded score) pairs of matched ads with the largest scores (see get_probs()),
+    sorted by score (and by index for equal scores). Ads with scores below min_score are skipped.
+    Ads with facts of the same classes are scored first, and ads, which match only by descendant classes,
+    are not scored at all, if k found ads already have scores above ad_index.MAX_DESCENDANT_SCORE.
+    If cache is given, requests with the same facts as already searched ones are not searched again.
+    """
+    if cache is not None:
+        def _search_uncached(enc_req, *args):
+            return search_top_k(enc_req, index, *args)
+
+        return cache.get_or_search(index, encoded_request, _search_uncached, k, min_score)
+    if k <= 0:
+        return []
+    top_heap = []  # (score, -index) of the best found ads, the worst one is on top
+    # the next tier is searched only if its ads can get into the result
+    tier_iter = index.iter_candidate_tiers(encoded_request)
+    for tier_max_score in [1.0, ad_index.MAX_DESCENDANT_SCORE]:
+        # scores are averaged, so the max score is compared with a margin for rounding errors
+        if tier_max_score < min_score or (len(top_heap) >= k and top_heap[0][0] > tier_max_score + 1e-9):
+            break
+        for ad_idx in next(tier_iter):
+            score = _calc_facts_score(ONT_STAT, encoded_request, index.get_ad_facts(ad_idx))
+            if score < min_score:
+                continue
+            if len(top_heap) < k:
+                heapq.heappush(top_heap, (score, -ad_idx))
+            elif (score, -ad_idx) > top_heap[0]:
+                heapq.heapreplace(top_heap, (score, -ad_idx))
+    return [(-neg_idx, score) for score, neg_idx in sorted(top_heap, reverse=True)]
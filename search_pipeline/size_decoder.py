@@ -0,0 +1,226 @@
+import re
+
+
+MIN_CLOTHES_SIZE_INT = 18
+MAX_CLOTHES_SIZE_INT = 82
+MIN_CHILD_CLOTHES_SIZE_INT = MIN_CLOTHES_SIZE_INT
+MAX_CHILD_CLOTHES_SIZE_INT = 43
+MIN_W_SCHOOL_CLOTHES_SIZE_INT = 26
+MAX_W_SCHOOL_CLOTHES_SIZE_INT = 48
+MIN_M_SCHOOL_CLOTHES_SIZE_INT = 28
+MAX_M_SCHOOL_CLOTHES_SIZE_INT = 50
+MAX_CLOTHES_SIZE_X_COUNT = 12
+
+# gender codes of ClothFact
+GENDER_MAN = 1
+GENDER_WOMAN = 2
+GENDER_UNISEX = 3
+
+_M_LETTERS_TO_SIZE_MAP = {
+    "xs": (40, 44),
+    "s": (42, 48),
+    "m": (44, 50),
+    "l": (48, 52),
+    "xl": (50, 56),
+    "xxl": (52, 60),
+    "xxxl": (54, 64),
+    "xxxxl": (56, 66),
+    "xxxxxl": (58, 70),
+    "xxxxxxl": (60, 72),
+    "xxxxxxxl": (62, 74),
+    "xxxxxxxxl": (64, 76),
+    "xxxxxxxxxl": (66, 78),
+    "xxxxxxxxxxl": (68, 80),
+}
+_W_LETTERS_TO_SIZE_MAP = {
+    "xxxs": (36, 36),
+    "xxs": (38, 38),
+    "xs": (38, 44),
+    "s": (42, 46),
+    "m": (44, 48),
+    "l": (46, 50),
+    "xl": (48, 54),
+    "xxl": (50, 58),
+    "xxxl": (52, 64),
+    "xxxxl": (54, 66),
+    "xxxxxl": (56, 70),
+    "xxxxxxl": (58, 74),
+    "xxxxxxxl": (56, 78),
+    "xxxxxxxxl": (58, 82),
+}
+
+_YEAR_TO_SIZE_MAP = {
+    0: (18, 26),
+    1: (26, 28),
+    2: (28, 30),
+    3: (28, 30),
+    4: (30, 30),
+    5: (30, 32),
+    6: (32, 34),
+    7: (34, 36),
+    8: (34, 36),
+    9: (36, 36),
+    10: (36, 36),
+    11: (36, 38),
+    12: (36, 38),
+    13: (38, 40),
+    14: (38, 40),
+}
+_MONTH_TO_SIZE_MAP = {
+    0: (18, 18),
+    1: (18, 20),
+    2: (18, 20),
+    3: (18, 22),
+    4: (20, 22),
+    5: (20, 22),
+    6: (20, 24),
+    7: (22, 24),
+    8: (22, 24),
+    9: (22, 26),
+    10: (24, 26),
+    11: (24, 26),
+    12: (24, 26),
+}
+
+# {keyword of indirect size info: (gender code, whether gender is set only if it is not known yet, size range)}
+INDIRECT_KEYWORD_MAP = {
+    "мальчик": (GENDER_MAN, False, (MIN_CHILD_CLOTHES_SIZE_INT, MAX_CHILD_CLOTHES_SIZE_INT)),
+    "девочка": (GENDER_WOMAN, False, (MIN_CHILD_CLOTHES_SIZE_INT, MAX_CHILD_CLOTHES_SIZE_INT)),
+    "мужчина": (GENDER_MAN, False, (MAX_CHILD_CLOTHES_SIZE_INT, MAX_CLOTHES_SIZE_INT)),
+    "женщина": (GENDER_WOMAN, False, (MAX_CHILD_CLOTHES_SIZE_INT, MAX_CLOTHES_SIZE_INT)),
+    "ребёнок": (None, False, (MIN_CLOTHES_SIZE_INT, MAX_CHILD_CLOTHES_SIZE_INT)),
+    "взрослый": (None, False, (MAX_CHILD_CLOTHES_SIZE_INT, MAX_CLOTHES_SIZE_INT)),
+    # in some cases this word can also be applicable to women
+    "школьник": (GENDER_MAN, True, (MIN_M_SCHOOL_CLOTHES_SIZE_INT, MAX_M_SCHOOL_CLOTHES_SIZE_INT)),
+    "школьница": (GENDER_WOMAN, False, (MIN_W_SCHOOL_CLOTHES_SIZE_INT, MAX_W_SCHOOL_CLOTHES_SIZE_INT)),
+}
+
+# optional number of "x" (it must be followed by "x"), then up to MAX_CLOTHES_SIZE_X_COUNT + 1 "x" and the end letter
+_SIZE_LETTERS_RE = re.compile(r"(?:(\d+)(?=[xX]))?[xX]{0,%d}[sSmMlL]" % (MAX_CLOTHES_SIZE_X_COUNT + 1))
+
+
+def is_size_letters(token):
+    """
+    Checks that token is letter size like "M", "xxl" or "3XL".
+    """
+    match = _SIZE_LETTERS_RE.fullmatch(token)
+    if match is None:
+        return False
+    x_count_digits = match.group(1)
+    return x_count_digits is None or 1 <= int(x_count_digits) <= MAX_CLOTHES_SIZE_X_COUNT
+
+
+def _letters_to_range(letters, mapper):
+    if letters not in mapper:
+        if letters[-1] == "l":
+            res_range = (max(max(v) for v in mapper.values()), MAX_CLOTHES_SIZE_INT)
+        else:
+            res_range = (MIN_CLOTHES_SIZE_INT, min(min(v) for v in mapper.values()))
+    else:
+        res_range = mapper[letters]
+    assert res_range[0] <= res_range[1]
+    return res_range
+
+
+def _calc_gender_letters_table(letters_list, gender):
+    table = {}
+    for letters in letters_list:
+        if gender is None:
+            m_range = _letters_to_range(letters, _M_LETTERS_TO_SIZE_MAP)
+            w_range = _letters_to_range(letters, _W_LETTERS_TO_SIZE_MAP)
+            table[letters] = (min(m_range[0], w_range[0]), max(m_range[1], w_range[1]))
+        elif gender == GENDER_MAN:
+            table[letters] = _letters_to_range(letters, _M_LETTERS_TO_SIZE_MAP)
+        else:
+            table[letters] = _letters_to_range(letters, _W_LETTERS_TO_SIZE_MAP)
+    return table
+
+
+# letters, which are unknown for both maps, are decoded by their last letter only, so they are represented by these keys
+_UNKNOWN_LARGE_LETTERS = "?l"
+_UNKNOWN_SMALL_LETTERS = "?"
+_LETTERS_TABLE = {
+    gender: _calc_gender_letters_table(
+        sorted(set(_M_LETTERS_TO_SIZE_MAP) | set(_W_LETTERS_TO_SIZE_MAP)) + [_UNKNOWN_LARGE_LETTERS, _UNKNOWN_SMALL_LETTERS],
+        gender,
+    )
+    for gender in [None, GENDER_MAN, GENDER_WOMAN]
+}
+_LETTERS_TABLE[GENDER_UNISEX] = _LETTERS_TABLE[None]
+
+_AGE_TABLE = {
+    **{(age, "y"): size_range for age, size_range in _YEAR_TO_SIZE_MAP.items()},
+    **{(age, "m"): size_range for age, size_range in _MONTH_TO_SIZE_MAP.items()},
+}
+
+
+def _lead_number_to_x(size_letters):
+    # "3XL" and "3L" become "xxxl"
+    first_digits = []
+    res = []
+    for pos, c in enumerate(size_letters):
+        if c.isdigit():
+            first_digits.append(c)
+            continue
+        if len(first_digits) > 0:
+            digit_val = max(1, min(int("".join(first_digits)), MAX_CLOTHES_SIZE_X_COUNT))
+            res = "".join(["x"] * digit_val)
+            if c.lower() != "x":
+                res += size_letters[pos:]
+            else:
+                res += size_letters[pos + 1:]
+        else:
+            res = size_letters
+        break
+    return res.lower()
+
+
+def _decode_letters(size_letters, gender_table):
+    letters = _lead_number_to_x(size_letters)
+    size_range = gender_table.get(letters)
+    if size_range is None:
+        size_range = gender_table[_UNKNOWN_LARGE_LETTERS if letters[-1] == "l" else _UNKNOWN_SMALL_LETTERS]
+    return size_range
+
+
+def _iter_raw_letters():
+    # lowercase spellings, which are accepted by is_size_letters() (numbers are without leading zeros)
+    for x_count in range(MAX_CLOTHES_SIZE_X_COUNT + 2):
+        for last_letter in "sml":
+            letters = "x" * x_count + last_letter
+            yield letters
+            if x_count > 0:
+                for number in range(1, MAX_CLOTHES_SIZE_X_COUNT + 1):
+                    yield f"{number}{letters}"
+
+
+# {gender: {parsed letters in lowercase (e.g. "3xl" and "xxxl"): size range}}
+_RAW_LETTERS_TABLE = {
+    gender: {letters: _decode_letters(letters, gender_table) for letters in _iter_raw_letters()}
+    for gender, gender_table in _LETTERS_TABLE.items()
+}
+
+
+def letters_to_size_range(size_letters, gender):
+    """
+    Decodes letter size (as it is parsed, e.g. "XL" or "3xl") to the range of numeric sizes for the gender code
+    (None is treated as unisex).
+    """
+    raw_table = _RAW_LETTERS_TABLE.get(gender)
+    if raw_table is None:
+        raise ValueError(f"Unknown gender value: {gender}")
+    size_range = raw_table.get(size_letters.lower())
+    if size_range is None:
+        # rare spellings, like letters with the joined number token ("10 XL") or with leading zeros ("03XL")
+        size_range = _decode_letters(size_letters, _LETTERS_TABLE[gender])
+    return size_range
+
+
+def age_to_size_range(from_age, to_age, unit, keyword_range):
+    """
+    Decodes age range in years (unit "y") or months (unit "m") to the range of numeric sizes.
+    Ages out of the tables are bounded by the size range of the keyword (e.g. "мальчик").
+    """
+    size_from = _AGE_TABLE.get((from_age, unit), (MAX_CHILD_CLOTHES_SIZE_INT, keyword_range[1]))
+    size_to = _AGE_TABLE.get((to_age, unit), (keyword_range[0], MAX_CLOTHES_SIZE_INT))
+    return (min(size_from), max(size_to))
@@ -1,4 +1,6 @@
-from yargy.tokenizer import Tokenizer as YrgTokenizer
+import bisect
+
+from yargy.tokenizer import Tokenizer as YrgTokenizer, INT as YRG_INT, LATIN as YRG_LATIN, RUSSIAN as YRG_RUSSIAN
 from yargy.interpretation import fact as yrg_fact, attribute as yrg_attr
 from yargy.pipelines import morph_pipeline as yrg_morph_pipeline
 from yargy import rule as yrg_rule, or_ as yrg_r_or, and_ as yrg_r_and
@@ -9,219 +11,411 @@ from yargy import Parser as YrgParser
 import razdel
 
 from search_pipeline import cloth_handler
+from search_pipeline import size_decoder
+from search_pipeline import lemmatizer
+from search_pipeline import profiling
+
+
+def _calc_parsed_class_stat(ont, parsed_node_list, parent_map, node_names_map, name_nodes_map):
+    """
+    Calculates statistics for nodes of one parsed class (objects or attributes).
+    Output - tuple of:
+        * set of names, which belong to roots of the class or to their descendants
+        * dictionary {name: list of nodes in N3 notation}
+        * two dictionaries {name: set of names}, with ancestor and descendant names respectively,
+          so "name1 is_subclass+ name2" check becomes a set lookup instead of SPARQL query with property path
+    """
+    parsed_node_set = set(parsed_node_list)
+    root_node_set = set(node for node in parsed_node_list if node not in parent_map)
+
+    all_name_set = set()
+    name_ancestors = {}
+    for node in parsed_node_list:
+        names = node_names_map.get(node, set())
+
+        # intermediate nodes of the path are not required to be in the parsed class, so all nodes are traversed
+        ancestor_nodes = set()
+        nodes_to_process = list(parent_map.get(node, ()))
+        while len(nodes_to_process) > 0:
+            parent_node = nodes_to_process.pop()
+            if parent_node in ancestor_nodes:
+                continue
+            ancestor_nodes.add(parent_node)
+            nodes_to_process += parent_map.get(parent_node, ())
+
+        if node in root_node_set or not ancestor_nodes.isdisjoint(root_node_set):
+            all_name_set.update(names)
+
+        ancestor_names = set()
+        for ancestor_node in ancestor_nodes:
+            if ancestor_node in parsed_node_set:
+                ancestor_names |= node_names_map.get(ancestor_node, set())
+        if len(ancestor_names) > 0:
+            for name in names:
+                name_ancestors.setdefault(name, set()).update(ancestor_names)
+
+    name_node_map = {}
+    for name in all_name_set:
+        name_node_map[name] = [
+            node.n3(ont.namespace_manager) for node in name_nodes_map[name] if node in parsed_node_set
+        ]
+
+    name_descendants = {}
+    for name, ancestor_names in name_ancestors.items():
+        for ancestor_name in ancestor_names:
+            name_descendants.setdefault(ancestor_name, set()).add(name)
+
+    return all_name_set, name_node_map, name_ancestors, name_descendants
+
+
+def _attr_node_to_value(attr_obj, attr_type):
+    if attr_type == "local:gender":
+        key = "gender"
+        if attr_obj == "local:Man":
+            val = cloth_handler.ClothFact.Gender.MAN
+        elif attr_obj == "local:Woman":
+            val = cloth_handler.ClothFact.Gender.WOMAN
+        elif attr_obj == "local:Unisex":
+            val = cloth_handler.ClothFact.Gender.UNISEX
+        else:
+            raise ValueError(f"Unknown gender object: {attr_obj}")
+    elif attr_type == "local:season":
+        key = "season"
+        if attr_obj == "local:DemiSeason":
+            val = cloth_handler.ClothFact.Season.DEMI_SEASON
+        elif attr_obj == "local:Winter":
+            val = cloth_handler.ClothFact.Season.WINTER
+        elif attr_obj == "local:Summer":
+            val = cloth_handler.ClothFact.Season.SUMMER
+        else:
+            raise ValueError(f"Unknown season object: {attr_obj}")
+    elif attr_type == "local:material":
+        key = "material"
+        val = attr_obj
+    else:
+        raise ValueError(f"Unknown attribute type: {attr_type}")
+    return key, val
 
 
 def calc_ontology_stat(ont):
-    res = ont.query(
-        "SELECT DISTINCT ?main_obj "
-        "WHERE { "
-        "    ?main_obj local:is_included local:parsed_objects . "
-        "    FILTER (NOT EXISTS {?main_obj local:is_subclass ?parent_obj .}) "
-        "}"
+    """
+    Collects names of parsed objects and attributes with their ontology nodes and relations.
+    All triples are read in a single pass over the graph, the rest is calculated in memory.
+    """
+    nsm = ont.namespace_manager
+    pred_subclass = nsm.expand_curie("local:is_subclass")
+    pred_included = nsm.expand_curie("local:is_included")
+    pred_name = nsm.expand_curie("local:has_name")
+    parsed_objects = nsm.expand_curie("local:parsed_objects")
+    parsed_attributes = nsm.expand_curie("local:parsed_attributes")
+
+    # triples are read by predicate, because name triples are returned grouped by name in insertion order,
+    # which keeps the order of nodes in "name_obj_map" the same as in SPARQL query results
+    parent_map = {}
+    for subj, _, obj in ont.triples((None, pred_subclass, None)):
+        parent_map.setdefault(subj, set()).add(obj)
+    parsed_node_lists = {parsed_objects: [], parsed_attributes: []}
+    node_included_map = {}
+    for subj, _, obj in ont.triples((None, pred_included, None)):
+        if obj in parsed_node_lists:
+            parsed_node_lists[obj].append(subj)
+        node_included_map.setdefault(subj, set()).add(obj)
+    node_names_map = {}
+    name_nodes_map = {}
+    for subj, _, obj in ont.triples((None, pred_name, None)):
+        name = obj.toPython()
+        node_names_map.setdefault(subj, set()).add(name)
+        name_nodes_map.setdefault(name, []).append(subj)
+
+    all_obj_name_set, name_obj_map, obj_name_ancestors, obj_name_descendants = _calc_parsed_class_stat(
+        ont, parsed_node_lists[parsed_objects], parent_map, node_names_map, name_nodes_map
     )
-    obj_root_name_list = [row[0].n3(ont.namespace_manager) for row in res]
-    all_obj_name_set = set()
-    for root_obj_name in obj_root_name_list:
-        res = ont.query(
-            "SELECT DISTINCT ?name "
-            "WHERE { "
-            f"    {root_obj_name} local:has_name ?name . "
-            "}"
-        )
-        all_obj_name_set |= set(row[0].toPython() for row in res)
-        res = ont.query(
-            "SELECT DISTINCT ?name "
-            "WHERE { "
-            "    ?main_obj local:is_included local:parsed_objects . "
-            f"    ?main_obj local:is_subclass+ {root_obj_name} . "
-            "    ?main_obj local:has_name ?name . "
-            "}"
-        )
-        all_obj_name_set |= set(row[0].toPython() for row in res)
-
-    name_obj_map = {}
-    for obj_name in all_obj_name_set:
-        res = ont.query(
-            "SELECT ?main_obj "
-            "WHERE { "
-            "    ?main_obj local:is_included local:parsed_objects . "
-            f"    ?main_obj local:has_name \"{obj_name}\" . "
-            "}"
-        )
-        out_list = [row[0].n3(ont.namespace_manager) for row in res]
-        name_obj_map[obj_name] = out_list
-
-    res = ont.query(
-        "SELECT DISTINCT ?main_obj "
-        "WHERE { "
-        "    ?main_obj local:is_included local:parsed_attributes . "
-        "    FILTER (NOT EXISTS {?main_obj local:is_subclass ?parent_obj .}) "
-        "}"
+    all_attr_name_set, name_attr_list_map, attr_name_ancestors, attr_name_descendants = _calc_parsed_class_stat(
+        ont, parsed_node_lists[parsed_attributes], parent_map, node_names_map, name_nodes_map
     )
-    attr_root_name_list = [row[0].n3(ont.namespace_manager) for row in res]
-    all_attr_name_set = set()
-    for root_attr_name in attr_root_name_list:
-        res = ont.query(
-            "SELECT DISTINCT ?name "
-            "WHERE { "
-            f"    {root_attr_name} local:has_name ?name . "
-            "}"
-        )
-        all_attr_name_set |= set(row[0].toPython() for row in res)
-        res = ont.query(
-            "SELECT DISTINCT ?name "
-            "WHERE { "
-            "    ?main_obj local:is_included local:parsed_attributes . "
-            f"    ?main_obj local:is_subclass+ {root_attr_name} . "
-            "    ?main_obj local:has_name ?name . "
-            "}"
-        )
-        all_attr_name_set |= set(row[0].toPython() for row in res)
-
     name_attr_map = {}
-    for attr_name in all_attr_name_set:
-        res = ont.query(
-            "SELECT ?main_obj "
-            "WHERE { "
-            "    ?main_obj local:is_included local:parsed_attributes . "
-            f"    ?main_obj local:has_name \"{attr_name}\" . "
-            "}"
-        )
-        out_list = [row[0].n3(ont.namespace_manager) for row in res]
+    for attr_name, out_list in name_attr_list_map.items():
         assert len(out_list) == 1
         name_attr_map[attr_name] = out_list[0]
 
+    # attribute table for normalization: name -> (ClothFact property, value), only unambiguous names are kept
+    attr_type_set = set(nsm.expand_curie(type_name) for type_name in ["local:gender", "local:season", "local:material"])
+    parsed_attr_set = set(parsed_node_lists[parsed_attributes])
+    attr_value_map = {}
+    for name, node_list in name_nodes_map.items():
+        attr_rows = set(
+            (node.n3(nsm), attr_type.n3(nsm))
+            for node in node_list if node in parsed_attr_set
+            for attr_type in node_included_map[node] & attr_type_set
+        )
+        if len(attr_rows) == 1:
+            attr_value_map[name] = _attr_node_to_value(*attr_rows.pop())
+
     return {
         "obj_name_set": all_obj_name_set,
         "name_obj_map": name_obj_map,
         "attr_name_set": all_attr_name_set,
         "name_attr_map": name_attr_map,
+        "obj_name_ancestors": obj_name_ancestors,
+        "obj_name_descendants": obj_name_descendants,
+        "attr_name_ancestors": attr_name_ancestors,
+        "attr_name_descendants": attr_name_descendants,
+        "attr_value_map": attr_value_map,
     }
 
 
-def _tokenize_and_split_by_sentence(text):
-    s_toks = []
-    for sentence in razdel.sentenize(text):
-        s_toks.append(list(tok.text for tok in razdel.tokenize(sentence.text)))
+# rule object id -> (rule, parser for full texts, parser for size snippets), see _get_size_parsers()
+_SIZE_PARSER_CACHE = {}
+
+
+def _get_size_parsers(size_rule):
+    """
+    Returns a pair of compiled parsers for the size rule: one is for scanning of full texts and one is for re-parsing
+    of found size snippets. Parsers are created only once per rule object, as the construction of a parser
+    (with its own morph analyzer) is much slower than parsing of a single text.
+    """
+    cached = _SIZE_PARSER_CACHE.get(id(size_rule))
+    if cached is None or cached[0] is not size_rule:  # rule is stored to ensure that its id was not reused
+        cached = (size_rule, YrgParser(size_rule), YrgParser(size_rule))
+        _SIZE_PARSER_CACHE[id(size_rule)] = cached
+    return cached[1], cached[2]
+
+
+# keywords of indirect size information (they are matched by any of their normal forms)
+SIZE_KEYWORDS = [
+    "мальчик",
+    "девочка",
+    "мужчина",
+    "женщина",
+    "ребёнок",
+    "взрослый",
+    "школьник",
+    "школьница",
+]
+
+
+class _SizeScreen:
+    """
+    Cheap lexical check of texts before the size grammar (see create_size_info_rule()).
+    Every match of the grammar contains at least one anchor token: an integer in the range of clothes sizes,
+    size letters or a form of a size keyword, so texts without anchors are not passed to the parser.
+    Texts are split by the same (regex only) tokenizer as in the parser, but no morphology is calculated:
+    keywords are recognized by the set of all forms of their lexemes.
+    """
+
+    def __init__(self, morph):
+        self.tokenizer = YrgTokenizer()
+        keyword_norms = set()
+        for keyword in SIZE_KEYWORDS:
+            keyword_norms.update(morph.normalized(keyword))
+        self.keyword_forms = set()
+        for norm in keyword_norms:
+            for parse in morph.raw.parse(norm):
+                if parse.normal_form in keyword_norms:
+                    self.keyword_forms.update(self._norm_form(form.word) for form in parse.lexeme)
+        self._anchor_cache = {}
+
+    @staticmethod
+    def _norm_form(word):
+        # analyzer accepts "е" in place of "ё", so such spellings are treated as the same form
+        return word.lower().replace("ё", "е")
+
+    def _is_anchor(self, tok):
+        if tok.type == YRG_INT:
+            return cloth_handler.MIN_CLOTHES_SIZE_INT <= int(tok.value) <= cloth_handler.MAX_CLOTHES_SIZE_INT
+        if tok.type == YRG_LATIN:
+            # size letters consist of Latin letters, other tokens can't pass the check
+            return size_decoder.is_size_letters(tok.value)
+        if tok.type == YRG_RUSSIAN:
+            return self._norm_form(tok.value) in self.keyword_forms
+        return False
+
+    def may_contain_size(self, text):
+        for tok in self.tokenizer(text):
+            is_anchor = self._anchor_cache.get(tok.value)
+            if is_anchor is None:
+                is_anchor = self._is_anchor(tok)
+                if len(self._anchor_cache) < _SIZE_SCREEN_CACHE_SIZE:
+                    self._anchor_cache[tok.value] = is_anchor
+            if is_anchor:
+                return True
+        return False
+
+
+_SIZE_SCREEN_CACHE_SIZE = 100000
+_SIZE_SCREEN_CACHE = {}
+
+
+def _get_size_screen(size_rule):
+    """
+    Returns the pre-screen of texts for the size rule, which is created by create_size_info_rule().
+    Morph analyzer of the full text parser is reused to find keyword forms.
+    """
+    cached = _SIZE_SCREEN_CACHE.get(id(size_rule))
+    if cached is None or cached[0] is not size_rule:
+        size_parser, _ = _get_size_parsers(size_rule)
+        cached = (size_rule, _SizeScreen(size_parser.tokenizer.morph))
+        _SIZE_SCREEN_CACHE[id(size_rule)] = cached
+    return cached[1]
+
 
+def _tokenize_and_split_by_sentence(text):
     all_toks = []
+    tok_spans = []
     sentence_ranges = []
-    sent_offset = 0
-    for toks in s_toks:
-        all_toks += toks
-        sentence_ranges.append((sent_offset, sent_offset + len(toks)))
-        sent_offset += len(toks)
+    for sentence in razdel.sentenize(text):
+        sent_offset = len(all_toks)
+        for tok in razdel.tokenize(sentence.text):
+            all_toks.append(tok.text)
+            # token offsets are relative to the sentence, so they are shifted to be text offsets
+            tok_spans.append((sentence.start + tok.start, sentence.start + tok.stop))
+        sentence_ranges.append((sent_offset, len(all_toks)))
 
-    return all_toks, sentence_ranges
+    return all_toks, tok_spans, sentence_ranges
 
 
-def _get_relation(ont, name1, name2, is_attr):
+def _get_relation(ont_stat, name1, name2, is_attr):
     if name1 == name2:
         return 0
-    parsed_class_str = "local:parsed_objects" if not is_attr else "local:parsed_attributes"
-    res = ont.query(
-        "SELECT DISTINCT ?main_obj "
-        "WHERE { "
-        "    ?main_obj local:is_subclass+ ?parent_obj ."
-        f"    ?main_obj local:is_included {parsed_class_str} . "
-        f"    ?parent_obj local:is_included {parsed_class_str} . "
-        f"    ?parent_obj local:has_name \"{name1}\" . "
-        f"    ?main_obj local:has_name \"{name2}\" . "
-        "}"
-    )
-    if len(res) > 0:
+    name_ancestors = ont_stat["attr_name_ancestors"] if is_attr else ont_stat["obj_name_ancestors"]
+    if name1 in name_ancestors.get(name2, ()):
         return 1
-    res = ont.query(
-        "SELECT DISTINCT ?main_obj "
-        "WHERE { "
-        "    ?main_obj local:is_subclass+ ?parent_obj ."
-        f"    ?main_obj local:is_included {parsed_class_str} . "
-        f"    ?parent_obj local:is_included {parsed_class_str} . "
-        f"    ?parent_obj local:has_name \"{name2}\" . "
-        f"    ?main_obj local:has_name \"{name1}\" . "
-        "}"
-    )
-    if len(res) > 0:
+    if name2 in name_ancestors.get(name1, ()):
         return -1
     return None
 
 
-def _get_all_word_relations(text, ont, ont_stat, morph_an, size_rule):
-    SEPARATOR_TOKS = [",", ";", ":", "и", "с", "со", "+"]
+class _TokenRelations:
+    """
+    Relations of text tokens, indexed by target ("to") token. Flags of relation kinds are precomputed,
+    so checks like "token has size relation" take O(1) instead of a scan through all relations of the text.
+    """
+
+    def __init__(self, tok_count):
+        self.tok_count = tok_count
+        self.rels = [[] for _ in range(tok_count)]  # (relation, "from" token) pairs in order of addition
+        self.is_sep = [False] * tok_count
+        self.is_size = [False] * tok_count
+        self.is_obj = [False] * tok_count
+        self.is_attr = [False] * tok_count
+
+    def add(self, rel, from_idx, to_idx):
+        self.rels[to_idx].append((rel, from_idx))
+        if rel == "syntax:sep":
+            self.is_sep[to_idx] = True
+        elif rel == "ont:size":
+            self.is_size[to_idx] = True
+        elif rel.startswith("ont:obj:"):
+            self.is_obj[to_idx] = True
+        elif rel.startswith("ont:attr:"):
+            self.is_attr[to_idx] = True
+
+    def get_obj_rels(self, to_idx):
+        return [rel for rel, _ in self.rels[to_idx] if rel.startswith("ont:obj:")]
+
+
+class _MacroRelations:
+    """
+    Macro relations ("prop" and "size") from attribute and size tokens to object tokens, indexed by object token.
+    """
+
+    def __init__(self):
+        self.from_by_to = {"prop": {}, "size": {}}
+        self.prop_from_set = set()
+        self.size_to_set = set()
+
+    def add(self, rel, from_idx, to_idx):
+        self.from_by_to[rel].setdefault(to_idx, []).append(from_idx)
+        if rel == "prop":
+            self.prop_from_set.add(from_idx)
+        else:
+            self.size_to_set.add(to_idx)
 
-    toks, sentence_ranges = _tokenize_and_split_by_sentence(text)
-    relation_list = []
+    def get_from_list(self, rel, to_idx):
+        return self.from_by_to[rel].get(to_idx, [])
 
-    for tok_idx, tok in enumerate(toks):
-        if tok in SEPARATOR_TOKS:
-            relation_list.append({"rel": "syntax:sep", "from": tok_idx, "to": tok_idx})
 
-    size_parser = YrgParser(size_rule)
-    matches = size_parser.findall(text)
+def _get_all_word_relations(text, ont_stat, morph_an, size_rule):
+    SEPARATOR_TOKS = [",", ";", ":", "и", "с", "со", "+"]
+
+    with profiling.stage("tokenization"):
+        toks, tok_spans, sentence_ranges = _tokenize_and_split_by_sentence(text)
+        tok_rels = _TokenRelations(len(toks))
+
+        for tok_idx, tok in enumerate(toks):
+            if tok in SEPARATOR_TOKS:
+                tok_rels.add("syntax:sep", tok_idx, tok_idx)
+
+    # tokens do not overlap, so both their starts and ends are sorted
+    tok_starts = [span[0] for span in tok_spans]
+    tok_ends = [span[1] for span in tok_spans]
+    size_parser, _ = _get_size_parsers(size_rule)
+    with profiling.stage("size_screen"):
+        may_contain_size = _get_size_screen(size_rule).may_contain_size(text)
+    with profiling.stage("size_scan"):
+        # most texts without clothes have no size anchors, so the grammar is skipped for them
+        matches = list(size_parser.findall(text)) if may_contain_size else []
     for m in matches:
-        pos = 0
-        is_size_found = False
-        tok_idx = 0
-        while tok_idx < len(toks):
-            tok = toks[tok_idx]
-            pos = text.find(tok, pos)
-            assert pos >= 0
-            if (pos >= m.span.start and pos < m.span.stop) or (pos + len(tok) >= m.span.stop and not is_size_found):
-                relation_list.append({"rel": "ont:size", "from": tok_idx, "to": tok_idx})
-                is_size_found = True
-            else:
-                if is_size_found:
-                    # workaround for size ranges, because rule always selects shortest match span and ranges like "80-90" become "80"
-                    if tok == "-":
-                        relation_list.append({"rel": "ont:size", "from": tok_idx, "to": tok_idx})
-                        tok_idx += 1
-                        if tok_idx < len(toks) and toks[tok_idx].isdigit():
-                            relation_list.append({"rel": "ont:size", "from": tok_idx, "to": tok_idx})
-                            tok_idx += 1
-                    break
+        # size tokens are the ones, which start inside the match span, or the first token, which ends after it
+        first_inner_idx = bisect.bisect_left(tok_starts, m.span.start)
+        if first_inner_idx < len(toks) and tok_starts[first_inner_idx] >= m.span.stop:
+            first_inner_idx = len(toks)
+        first_size_idx = min(first_inner_idx, bisect.bisect_left(tok_ends, m.span.stop))
+        assert first_size_idx < len(toks)
+        end_size_idx = max(first_size_idx + 1, bisect.bisect_left(tok_starts, m.span.stop))
+        for tok_idx in range(first_size_idx, end_size_idx):
+            tok_rels.add("ont:size", tok_idx, tok_idx)
+
+        # workaround for size ranges, because rule always selects shortest match span and ranges like "80-90" become "80"
+        tok_idx = end_size_idx
+        if tok_idx < len(toks) and toks[tok_idx] == "-":
+            tok_rels.add("ont:size", tok_idx, tok_idx)
             tok_idx += 1
-        assert is_size_found
-
-    normed_toks = [morph_an.parse(tok)[0].normal_form for tok in toks]
-    obj_toks = [(idx, tok) for idx, tok in enumerate(normed_toks) if tok in ont_stat["obj_name_set"]]
-    for (tok_idx, tok) in obj_toks:
-        relation_list.append({"rel": f"ont:obj:{ont_stat['name_obj_map'][tok][0]}", "from": tok_idx, "to": tok_idx})
-        for (dep_tok_idx, dep_tok) in obj_toks:
-            if dep_tok == tok:
-                continue
-            dep_code = _get_relation(ont, tok, dep_tok, is_attr=False)
-            if dep_code is None:
-                continue
-            elif dep_code == 1:
-                relation_list.append({"rel": "ont:rel:obj_inst", "from": tok_idx, "to": dep_tok_idx})
-            elif dep_code == -1:
-                relation_list.append({"rel": "ont:rel:obj_inst", "from": dep_tok_idx, "to": tok_idx})
-            else:
-                raise ValueError(f"Unknown dependency: {dep_code} for {tok} and {dep_tok}")
-
-    attr_toks = [(idx, tok) for idx, tok in enumerate(normed_toks) if tok in ont_stat["attr_name_set"]]
-    for (tok_idx, tok) in attr_toks:
-        relation_list.append({"rel": f"ont:attr:{ont_stat['name_attr_map'][tok]}", "from": tok_idx, "to": tok_idx})
-        for (dep_tok_idx, dep_tok) in obj_toks:
-            if dep_tok == tok:
-                continue
-            dep_code = _get_relation(ont, tok, dep_tok, is_attr=True)
-            if dep_code is None:
-                continue
-            elif dep_code == 1:
-                relation_list.append({"rel": "ont:rel:attr_inst", "from": tok_idx, "to": dep_tok_idx})
-            elif dep_code == -1:
-                relation_list.append({"rel": "ont:rel:attr_inst", "from": dep_tok_idx, "to": tok_idx})
-            else:
-                raise ValueError(f"Unknown dependency: {dep_code} for {tok} and {dep_tok}")
+            if tok_idx < len(toks) and toks[tok_idx].isdigit():
+                tok_rels.add("ont:size", tok_idx, tok_idx)
+
+    with profiling.stage("lemmatization"):
+        normed_toks = lemmatizer.get_normal_forms(morph_an, toks)
+    with profiling.stage("ontology_relations"):
+        obj_toks = [(idx, tok) for idx, tok in enumerate(normed_toks) if tok in ont_stat["obj_name_set"]]
+        for (tok_idx, tok) in obj_toks:
+            tok_rels.add(f"ont:obj:{ont_stat['name_obj_map'][tok][0]}", tok_idx, tok_idx)
+            for (dep_tok_idx, dep_tok) in obj_toks:
+                if dep_tok == tok:
+                    continue
+                dep_code = _get_relation(ont_stat, tok, dep_tok, is_attr=False)
+                if dep_code is None:
+                    continue
+                elif dep_code == 1:
+                    tok_rels.add("ont:rel:obj_inst", tok_idx, dep_tok_idx)
+                elif dep_code == -1:
+                    tok_rels.add("ont:rel:obj_inst", dep_tok_idx, tok_idx)
+                else:
+                    raise ValueError(f"Unknown dependency: {dep_code} for {tok} and {dep_tok}")
+
+        attr_toks = [(idx, tok) for idx, tok in enumerate(normed_toks) if tok in ont_stat["attr_name_set"]]
+        for (tok_idx, tok) in attr_toks:
+            tok_rels.add(f"ont:attr:{ont_stat['name_attr_map'][tok]}", tok_idx, tok_idx)
+            for (dep_tok_idx, dep_tok) in obj_toks:
+                if dep_tok == tok:
+                    continue
+                dep_code = _get_relation(ont_stat, tok, dep_tok, is_attr=True)
+                if dep_code is None:
+                    continue
+                elif dep_code == 1:
+                    tok_rels.add("ont:rel:attr_inst", tok_idx, dep_tok_idx)
+                elif dep_code == -1:
+                    tok_rels.add("ont:rel:attr_inst", dep_tok_idx, tok_idx)
+                else:
+                    raise ValueError(f"Unknown dependency: {dep_code} for {tok} and {dep_tok}")
 
-    return relation_list, toks, sentence_ranges
+    return tok_rels, toks, normed_toks, sentence_ranges
 
 
-def extract_facts(text, ont, ont_stat, morph_an, size_rule):
+def extract_facts(text, ont_stat, morph_an, size_rule, keep_size_info=False):
 
-    def _infer_macro_relations(rel_list, sentence_ranges):
-        macro_rels = []
+    def _infer_macro_relations(tok_rels, sentence_ranges):
+        macro_rels = _MacroRelations()
 
         # same sentence
         for sent_range in sentence_ranges:
@@ -232,13 +426,12 @@ def extract_facts(text, ont, ont_stat, morph_an, size_rule):
             first_type = None
             last_size_info_idx = -1
             for idx in sent_idx_list:
-                idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == idx]
-                if "ont:size" in idx_rels:
+                if tok_rels.is_size[idx]:
                     if tok_type != 'size':  # size info can contain multiple tokens
                         size_info_cnt += 1
                     tok_type = 'size'
                     last_size_info_idx = idx
-                elif any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
+                elif tok_rels.is_obj[idx]:
                     obj_cnt += 1  # object is identified by single token
                     tok_type = 'obj'
                 else:
@@ -247,26 +440,21 @@ def extract_facts(text, ont, ont_stat, morph_an, size_rule):
                     first_type = tok_type
 
             if obj_cnt > 0:
-                obj_tok_idx_list = sorted(
-                    [rel["to"] for rel in rel_list if rel["rel"].startswith("ont:obj:") and rel["to"] in sent_idx_list]
-                )
+                obj_tok_idx_list = [idx for idx in sent_idx_list if tok_rels.is_obj[idx]]
                 if obj_cnt == 1:
                     assert len(obj_tok_idx_list) == 1
                     obj_tok_idx = obj_tok_idx_list[0]
                     for tok_idx in sent_idx_list:
-                        idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                        if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                            macro_rels.append({"rel": "prop", "from": tok_idx, "to": obj_tok_idx})
+                        if tok_rels.is_attr[tok_idx]:
+                            macro_rels.add("prop", tok_idx, obj_tok_idx)
                 else:
                     for tok_idx in range(obj_tok_idx_list[0]):
-                        idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                        if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                            macro_rels.append({"rel": "prop", "from": tok_idx, "to": obj_tok_idx_list[0]})
+                        if tok_rels.is_attr[tok_idx]:
+                            macro_rels.add("prop", tok_idx, obj_tok_idx_list[0])
                     for idx_idx in range(1, len(obj_tok_idx_list)):
                         sep_idx_list = []
                         for tok_idx in range(obj_tok_idx_list[idx_idx - 1] + 1, obj_tok_idx_list[idx_idx]):
-                            idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                            if "syntax:sep" in idx_rels:
+                            if tok_rels.is_sep[tok_idx]:
                                 sep_idx_list.append(tok_idx)
                         if len(sep_idx_list) == 0:
                             sep_idx_list = [obj_tok_idx_list[idx_idx - 1]]
@@ -274,17 +462,14 @@ def extract_facts(text, ont, ont_stat, morph_an, size_rule):
                             sep_idx_list = [obj_tok_idx_list[idx_idx - 1]]
 
                         for tok_idx in range(obj_tok_idx_list[idx_idx - 1] + 1, sep_idx_list[0]):
-                            idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                            if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                                macro_rels.append({"rel": "prop", "from": tok_idx, "to": obj_tok_idx_list[idx_idx - 1]})
+                            if tok_rels.is_attr[tok_idx]:
+                                macro_rels.add("prop", tok_idx, obj_tok_idx_list[idx_idx - 1])
                         for tok_idx in range(sep_idx_list[0] + 1, obj_tok_idx_list[idx_idx]):
-                            idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                            if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                                macro_rels.append({"rel": "prop", "from": tok_idx, "to": obj_tok_idx_list[idx_idx]})
+                            if tok_rels.is_attr[tok_idx]:
+                                macro_rels.add("prop", tok_idx, obj_tok_idx_list[idx_idx])
                     for tok_idx in range(obj_tok_idx_list[-1] + 1, sent_idx_list[-1]):
-                        idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                        if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                            macro_rels.append({"rel": "prop", "from": tok_idx, "to": obj_tok_idx_list[-1]})
+                        if tok_rels.is_attr[tok_idx]:
+                            macro_rels.add("prop", tok_idx, obj_tok_idx_list[-1])
 
             if size_info_cnt > 0 and obj_cnt > 0:
                 last_size_info_start_idx = None
@@ -292,71 +477,61 @@ def extract_facts(text, ont, ont_stat, morph_an, size_rule):
                 is_size_info_continues = False
                 if first_type == 'obj':
                     for idx_idx, idx in enumerate(sent_idx_list):
-                        idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == idx]
-                        if "ont:size" in idx_rels:
+                        if tok_rels.is_size[idx]:
                             if not is_size_info_continues:
                                 last_size_info_start_idx = idx
                             for obj_idx in sent_idx_list[last_assign_tok_idx:idx_idx]:
-                                obj_idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == obj_idx]
-                                if any(rel.startswith("ont:obj:") for rel in obj_idx_rels):  # any() returns False on empty input
-                                    macro_rels.append({"rel": "size", "from": idx, "to": obj_idx})
+                                if tok_rels.is_obj[obj_idx]:
+                                    macro_rels.add("size", idx, obj_idx)
                             is_size_info_continues = True
                         else:
                             if is_size_info_continues:
                                 last_assign_tok_idx = idx_idx
                             is_size_info_continues = False
-                        if idx > last_size_info_idx and any(rel.startswith("ont:obj:") for rel in idx_rels):
+                        if idx > last_size_info_idx and tok_rels.is_obj[idx]:
                             for size_idx in range(last_size_info_start_idx, last_size_info_idx + 1):
-                                macro_rels.append({"rel": "size", "from": size_idx, "to": idx})
+                                macro_rels.add("size", size_idx, idx)
                 else:
                     for idx_idx, idx in enumerate(sent_idx_list):
-                        idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == idx]
-                        if any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
+                        if tok_rels.is_obj[idx]:
                             is_size_info_continues = False
                             for size_idx in sent_idx_list[last_assign_tok_idx:idx_idx]:
-                                size_idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == size_idx]
-                                if "ont:size" in size_idx_rels:
-                                    macro_rels.append({"rel": "size", "from": size_idx, "to": idx})
+                                if tok_rels.is_size[size_idx]:
+                                    macro_rels.add("size", size_idx, idx)
                         else:
-                            if "ont:size" in idx_rels:
+                            if tok_rels.is_size[idx]:
                                 if not is_size_info_continues:
                                     last_assign_tok_idx = idx_idx
                                 is_size_info_continues = True
                         # even if sentence is ended by size info, it is dropped, because all objects were defined by previous size infos
 
         # different sentences
+        tok_sent_idx_list = []
+        for sent_idx, sent_range in enumerate(sentence_ranges):
+            tok_sent_idx_list += [sent_idx] * (sent_range[1] - sent_range[0])
         dangling_prop_idx_list = []
         no_size_sent_list = []
         size_sent_list = []
-        for idx in range(len(toks)):
-            idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == idx]
-            if any(rel.startswith("ont:attr:") for rel in idx_rels):  # any() returns False on empty input
-                if not any(mrel["from"] == idx for mrel in macro_rels if mrel["rel"] == "prop"):
+        for idx in range(tok_rels.tok_count):
+            if tok_rels.is_attr[idx]:
+                if idx not in macro_rels.prop_from_set:
                     dangling_prop_idx_list.append(idx)
-            if any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
-                if not any(mrel["to"] == idx for mrel in macro_rels if mrel["rel"] == "size"):
-                    for sent_idx, sent_range in enumerate(sentence_ranges):
-                        if idx >= sent_range[0] and idx < sent_range[1]:
-                            no_size_sent_list.append(sent_idx)
-                            break
-            if "ont:size" in idx_rels:
-                for sent_idx, sent_range in enumerate(sentence_ranges):
-                    if idx >= sent_range[0] and idx < sent_range[1]:
-                        size_sent_list.append(sent_idx)
-                        break
+            if tok_rels.is_obj[idx]:
+                if idx not in macro_rels.size_to_set:
+                    no_size_sent_list.append(tok_sent_idx_list[idx])
+            if tok_rels.is_size[idx]:
+                size_sent_list.append(tok_sent_idx_list[idx])
         for prop_idx in dangling_prop_idx_list:
             obj_found = False
             for tok_idx in range(prop_idx - 1, -1, -1):
-                idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                if any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
-                    macro_rels.append({"rel": "prop", "from": prop_idx, "to": tok_idx})
+                if tok_rels.is_obj[tok_idx]:
+                    macro_rels.add("prop", prop_idx, tok_idx)
                     obj_found = True
                     break
             if not obj_found:
-                for tok_idx in range(prop_idx + 1, len(toks)):
-                    idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == tok_idx]
-                    if any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
-                        macro_rels.append({"rel": "prop", "from": prop_idx, "to": tok_idx})
+                for tok_idx in range(prop_idx + 1, tok_rels.tok_count):
+                    if tok_rels.is_obj[tok_idx]:
+                        macro_rels.add("prop", prop_idx, tok_idx)
                         break
         if len(size_sent_list) > 0 and len(no_size_sent_list) > 0:
             for no_size_sent_idx in no_size_sent_list:
@@ -364,92 +539,50 @@ def extract_facts(text, ont, ont_stat, morph_an, size_rule):
                     [(abs(size_sent_idx - no_size_sent_idx), size_sent_idx) for size_sent_idx in size_sent_list], key=lambda x: x[0]
                 )[1]
                 size_idx_list = [
-                    idx for idx in list(range(sentence_ranges[closest_size_sent_idx][0], sentence_ranges[closest_size_sent_idx][1]))
-                    if "ont:size" in [rel["rel"] for rel in rel_list if rel["to"] == idx]
+                    idx for idx in range(sentence_ranges[closest_size_sent_idx][0], sentence_ranges[closest_size_sent_idx][1])
+                    if tok_rels.is_size[idx]
                 ]
-                for idx in list(range(sentence_ranges[no_size_sent_idx][0], sentence_ranges[no_size_sent_idx][1])):
-                    idx_rels = [rel["rel"] for rel in rel_list if rel["to"] == idx]
-                    if any(rel.startswith("ont:obj:") for rel in idx_rels):  # any() returns False on empty input
+                for idx in range(sentence_ranges[no_size_sent_idx][0], sentence_ranges[no_size_sent_idx][1]):
+                    if tok_rels.is_obj[idx]:
                         # according to the processing above, all objects in sentence are not connected to size info, so no check is needed
                         for size_idx in size_idx_list:
-                            macro_rels.append({"rel": "size", "from": size_idx, "to": idx})
+                            macro_rels.add("size", size_idx, idx)
 
         return macro_rels
 
-    def _normalize_attr(ont, morph_an, attr_name):
-        norm_attr_name = morph_an.parse(attr_name)[0].normal_form
-        res = ont.query(
-            "SELECT DISTINCT ?attr_obj ?class_obj "
-            "WHERE { "
-            "    VALUES ?class_obj {local:gender local:season local:material} "
-            "    ?attr_obj local:is_included ?class_obj . "
-            "    ?attr_obj local:is_included local:parsed_attributes . "
-            f"    ?attr_obj local:has_name \"{norm_attr_name}\" . "
-            "}"
-        )
-        assert len(res) == 1
-        res = list(res)
-        attr_obj = res[0][0].n3(ont.namespace_manager)
-        attr_type = res[0][1].n3(ont.namespace_manager)
-        if attr_type == "local:gender":
-            key = "gender"
-            if attr_obj == "local:Man":
-                val = cloth_handler.ClothFact.Gender.MAN
-            elif attr_obj == "local:Woman":
-                val = cloth_handler.ClothFact.Gender.WOMAN
-            elif attr_obj == "local:Unisex":
-                val = cloth_handler.ClothFact.Gender.UNISEX
-            else:
-                raise ValueError(f"Unknown gender object: {attr_obj}")
-        elif attr_type == "local:season":
-            key = "season"
-            if attr_obj == "local:DemiSeason":
-                val = cloth_handler.ClothFact.Season.DEMI_SEASON
-            elif attr_obj == "local:Winter":
-                val = cloth_handler.ClothFact.Season.WINTER
-            elif attr_obj == "local:Summer":
-                val = cloth_handler.ClothFact.Season.SUMMER
-            else:
-                raise ValueError(f"Unknown season object: {attr_obj}")
-        elif attr_type == "local:material":
-            key = "material"
-            val = attr_obj
-        else:
-            raise ValueError(f"Unknown attribute type: {attr_type}")
-        return key, val
-
-    relation_list, toks, sentence_ranges = _get_all_word_relations(text, ont, ont_stat, morph_an, size_rule)
-    macro_rel_list = _infer_macro_relations(relation_list, sentence_ranges)
+    tok_rels, toks, normed_toks, sentence_ranges = _get_all_word_relations(text, ont_stat, morph_an, size_rule)
+    with profiling.stage("macro_relations"):
+        macro_rels = _infer_macro_relations(tok_rels, sentence_ranges)
 
     out_obj_list = []
     for idx in range(len(toks)):
-        rels = [rel["rel"] for rel in relation_list if rel["to"] == idx]
-        obj_rel_list = [rel for rel in rels if rel.startswith("ont:obj:")]
-        assert len(obj_rel_list) <= 1
-        if len(obj_rel_list) == 1:
+        if tok_rels.is_obj[idx]:
+            obj_rel_list = tok_rels.get_obj_rels(idx)
+            assert len(obj_rel_list) == 1
             prop_dict = {}
-            for m_rel in macro_rel_list:
-                if m_rel["rel"] == "prop" and m_rel["to"] == idx:
-                    k, v = _normalize_attr(ont, morph_an, toks[m_rel["from"]])
-                    prop_dict[k] = v
+            for from_idx in macro_rels.get_from_list("prop", idx):
+                # attribute token is already lemmatized and is known to be in the table
+                k, v = ont_stat["attr_value_map"][normed_toks[from_idx]]
+                prop_dict[k] = v
 
             size_text = ""
-            for m_rel in macro_rel_list:
-                if m_rel["rel"] == "size" and m_rel["to"] == idx:
-                    tok = toks[m_rel["from"]]
-                    size_text += f" {tok}" if len(size_text) > 0 and not tok.startswith("-") else tok
+            for from_idx in macro_rels.get_from_list("size", idx):
+                tok = toks[from_idx]
+                size_text += f" {tok}" if len(size_text) > 0 and not tok.startswith("-") else tok
             if len(size_text) > 0:
-                parser = YrgParser(size_rule)
-                matched_trees = list(parser.findall(size_text))
-                assert len(matched_trees) > 0
-                # we take only the longest match, from left to right
-                matched_trees = sorted(matched_trees, key=lambda m: (m.span.stop - m.span.start, m.span.start), reverse=True)
-                size_info = matched_trees[0].fact
+                with profiling.stage("size_reparse"):
+                    _, snippet_parser = _get_size_parsers(size_rule)
+                    matched_trees = list(snippet_parser.findall(size_text))
+                    assert len(matched_trees) > 0
+                    # we take only the longest match, from left to right
+                    matched_trees = sorted(matched_trees, key=lambda m: (m.span.stop - m.span.start, m.span.start), reverse=True)
+                    size_info = matched_trees[0].fact
             else:
                 size_info = None
-            out_obj_list.append(
-                cloth_handler.ClothFact(obj_rel_list[0], toks[idx], size_info, prop_dict)
-            )
+            with profiling.stage("fact_construction"):
+                out_obj_list.append(
+                    cloth_handler.ClothFact(obj_rel_list[0], toks[idx], size_info, prop_dict, keep_size_info)
+                )
 
     return out_obj_list
 
@@ -465,16 +598,7 @@ def create_size_info_rule():
             yrg_rp_caseless("на"),
             yrg_rp_caseless("для"),
         ).optional(),
-        yrg_morph_pipeline([
-            "мальчик",
-            "девочка",
-            "мужчина",
-            "женщина",
-            "ребёнок",
-            "взрослый",
-            "школьник",
-            "школьница",
-        ]).interpretation(o_size_indirect_info.keyword.normalized()),
+        yrg_morph_pipeline(SIZE_KEYWORDS).interpretation(o_size_indirect_info.keyword.normalized()),
     )
     r_size_year_info = yrg_r_or(
         yrg_rule(
@@ -533,7 +657,7 @@ def create_size_info_rule():
             yrg_rp_gte(2),
             yrg_rp_lte(cloth_handler.MAX_CLOTHES_SIZE_X_COUNT),
         ).optional(),
-        yrg_rp_custom(lambda tok: cloth_handler.ClothFact._is_size_letters(tok)),
+        yrg_rp_custom(size_decoder.is_size_letters),
     ).interpretation(o_size_letters.letters).interpretation(o_size_letters)
     o_size_letters_list = yrg_fact("size_letters_list", ["from_info", "to_info"])
     r_size_letters_list = yrg_rule(
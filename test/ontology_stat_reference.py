@@ -0,0 +1,91 @@
+def calc_ontology_stat_by_queries(ont):
+    """
+    Previous implementation of text_parser.calc_ontology_stat() with separate SPARQL query for every root and name.
+    It is very slow on large ontologies and is kept only as the reference for test_parser.test_ontology_stat()
+    and benchmarks/bench_ontology_stat.py.
+    """
+    res = ont.query(
+        "SELECT DISTINCT ?main_obj "
+        "WHERE { "
+        "    ?main_obj local:is_included local:parsed_objects . "
+        "    FILTER (NOT EXISTS {?main_obj local:is_subclass ?parent_obj .}) "
+        "}"
+    )
+    obj_root_name_list = [row[0].n3(ont.namespace_manager) for row in res]
+    all_obj_name_set = set()
+    for root_obj_name in obj_root_name_list:
+        res = ont.query(
+            "SELECT DISTINCT ?name "
+            "WHERE { "
+            f"    {root_obj_name} local:has_name ?name . "
+            "}"
+        )
+        all_obj_name_set |= set(row[0].toPython() for row in res)
+        res = ont.query(
+            "SELECT DISTINCT ?name "
+            "WHERE { "
+            "    ?main_obj local:is_included local:parsed_objects . "
+            f"    ?main_obj local:is_subclass+ {root_obj_name} . "
+            "    ?main_obj local:has_name ?name . "
+            "}"
+        )
+        all_obj_name_set |= set(row[0].toPython() for row in res)
+
+    name_obj_map = {}
+    for obj_name in all_obj_name_set:
+        res = ont.query(
+            "SELECT ?main_obj "
+            "WHERE { "
+            "    ?main_obj local:is_included local:parsed_objects . "
+            f"    ?main_obj local:has_name \"{obj_name}\" . "
+            "}"
+        )
+        out_list = [row[0].n3(ont.namespace_manager) for row in res]
+        name_obj_map[obj_name] = out_list
+
+    res = ont.query(
+        "SELECT DISTINCT ?main_obj "
+        "WHERE { "
+        "    ?main_obj local:is_included local:parsed_attributes . "
+        "    FILTER (NOT EXISTS {?main_obj local:is_subclass ?parent_obj .}) "
+        "}"
+    )
+    attr_root_name_list = [row[0].n3(ont.namespace_manager) for row in res]
+    all_attr_name_set = set()
+    for root_attr_name in attr_root_name_list:
+        res = ont.query(
+            "SELECT DISTINCT ?name "
+            "WHERE { "
+            f"    {root_attr_name} local:has_name ?name . "
+            "}"
+        )
+        all_attr_name_set |= set(row[0].toPython() for row in res)
+        res = ont.query(
+            "SELECT DISTINCT ?name "
+            "WHERE { "
+            "    ?main_obj local:is_included local:parsed_attributes . "
+            f"    ?main_obj local:is_subclass+ {root_attr_name} . "
+            "    ?main_obj local:has_name ?name . "
+            "}"
+        )
+        all_attr_name_set |= set(row[0].toPython() for row in res)
+
+    name_attr_map = {}
+    for attr_name in all_attr_name_set:
+        res = ont.query(
+            "SELECT ?main_obj "
+            "WHERE { "
+            "    ?main_obj local:is_included local:parsed_attributes . "
+            f"    ?main_obj local:has_name \"{attr_name}\" . "
+            "}"
+        )
+        out_list = [row[0].n3(ont.namespace_manager) for row in res]
+        assert len(out_list) == 1
+        name_attr_map[attr_name] = out_list[0]
+
+    return {
+        "obj_name_set": all_obj_name_set,
+        "name_obj_map": name_obj_map,
+        "attr_name_set": all_attr_name_set,
+        "name_attr_map": name_attr_map,
+    }
@@ -1,6 +1,10 @@
 from collections import namedtuple
 import sys
+import json
 import os
+import pickle
+import shutil
+import tempfile
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import rdflib
@@ -8,6 +12,9 @@ import pymorphy3
 
 from search_pipeline import text_parser
 from search_pipeline import cloth_handler
+from search_pipeline import ontology_snapshot
+from search_pipeline import lemmatizer
+import ontology_stat_reference
 
 
 ONTOLOGY = rdflib.Graph()
@@ -20,7 +27,7 @@ SizeIndirectInfo = namedtuple('size_indirect_info', ["keyword", "year_info_from_
 
 
 def _show_facts(string):
-    facts = text_parser.extract_facts(string, ONTOLOGY, ONT_STAT, MORPH_AN, SIZE_RULE)
+    facts = text_parser.extract_facts(string, ONT_STAT, MORPH_AN, SIZE_RULE, keep_size_info=True)
     for i, fact in enumerate(facts, start=1):
         print(f"Fact {i}: {str(fact)}")
     s_str = "s" if len(facts) != 1 else ""
@@ -44,7 +51,7 @@ def _ensure_parsed(string, true_info_list):
         res = res and f1.props == f2.props
         return res
 
-    facts = text_parser.extract_facts(string, ONTOLOGY, ONT_STAT, MORPH_AN, SIZE_RULE)
+    facts = text_parser.extract_facts(string, ONT_STAT, MORPH_AN, SIZE_RULE, keep_size_info=True)
     assert len(facts) == len(true_info_list)
     if __debug__:
         handled_facts = set()
@@ -78,6 +85,7 @@ def test_text_parsing():
                 prop_dict={
                     "gender": cloth_handler.ClothFact.Gender.WOMAN,
                 },
+                keep_size_info=True,
             ),
             (18, 43),
         ),
@@ -98,6 +106,7 @@ def test_text_parsing():
                 prop_dict={
                     "gender": cloth_handler.ClothFact.Gender.WOMAN,
                 },
+                keep_size_info=True,
             ),
             (18, 43),
         ),
@@ -119,6 +128,7 @@ def test_text_parsing():
                     "gender": cloth_handler.ClothFact.Gender.WOMAN,
                     "season": cloth_handler.ClothFact.Season.DEMI_SEASON,
                 },
+                keep_size_info=True,
             ),
             (18, 43),
         ),
@@ -139,6 +149,7 @@ def test_text_parsing():
                 prop_dict={
                     "gender": cloth_handler.ClothFact.Gender.WOMAN,
                 },
+                keep_size_info=True,
             ),
             (18, 43),
         ),
@@ -152,5 +163,185 @@ def test_text_parsing():
     print("ALL TESTS HAVE PASSED!")
 
 
+def test_size_token_alignment():
+    # "р" is also a substring of "Продам", and "44" is repeated, so tokens must be aligned by their offsets
+    tok_rels, toks, _, _ = text_parser._get_all_word_relations("Продам р 44, кофта 44 р", ONT_STAT, MORPH_AN, SIZE_RULE)
+    assert [toks[idx] for idx in range(len(toks)) if tok_rels.is_size[idx]] == ["р", "44", "44", "р"]
+    assert [idx for idx in range(len(toks)) if tok_rels.is_size[idx]] == [1, 2, 5, 6]
+
+    # dash after the shortest match is attached to size range
+    tok_rels, toks, _, _ = text_parser._get_all_word_relations("куртка 44 - 46", ONT_STAT, MORPH_AN, SIZE_RULE)
+    assert [toks[idx] for idx in range(len(toks)) if tok_rels.is_size[idx]] == ["44", "-", "46"]
+
+
+def test_size_screen():
+    texts = [
+        "Отдам вещи на девочку р 80-92. Большая юбка, зелёные осенние джинсы и красные кофты",
+        "Продам куртку зимнюю мужскую размер 52, штаны 50-52, ботинки 42, шапку, 3XL, iPhone №5 — 1.5 ₽",
+        "Вещи на ребенка 2 лет, для детей до 6 мес, школьнице, взрослым",
+        "Продам свитер S-M, 10xl, XXXXXXXXXXXXXL, 044 размер, сорок четыре с половиной",
+        "Продаю телевизор и холодильник, 17 и 83 года, 2 шт",
+        "Отдам коляску и кроватку",
+        "",
+    ]
+    ad_db_path = os.path.join(os.path.dirname(__file__), "..", "data", "ads_db.txt")
+    if os.path.isfile(ad_db_path):
+        with open(ad_db_path, "r", encoding="utf-8") as f:
+            texts += [line for _, line in zip(range(1000), f)]
+
+    screen = text_parser._get_size_screen(SIZE_RULE)
+    size_parser, _ = text_parser._get_size_parsers(SIZE_RULE)
+    skipped_cnt = 0
+    for text in texts:
+        if not screen.may_contain_size(text):
+            # skipped texts must have no size matches at all, so the extracted facts do not change
+            assert list(size_parser.findall(text)) == [], text
+            skipped_cnt += 1
+    assert skipped_cnt >= 3
+
+
+def test_cached_lemmatizer():
+    texts = [
+        "Отдам вещи на девочку р 80-92. Большая юбка, зелёные осенние джинсы и красные кофты",
+        "Продам куртку зимнюю мужскую размер 52, штаны 50-52, ботинки 42, шапку, 3XL, iPhone №5 — 1.5 ₽",
+    ]
+    toks = [tok for text in texts for tok in text_parser._tokenize_and_split_by_sentence(text)[0]]
+
+    lemm = lemmatizer.CachedLemmatizer(MORPH_AN, max_size=5)
+    assert lemmatizer.get_normal_forms(lemm, toks) == lemmatizer.get_normal_forms(MORPH_AN, toks)
+    assert lemm.get_stats()["size"] == 5
+    assert lemm.skips > 0  # numbers, punctuation and Latin tokens are not passed to the analyzer
+    assert lemmatizer.get_normal_forms(lemm, toks[-3:]) == lemmatizer.get_normal_forms(MORPH_AN, toks[-3:])
+
+    lemm = lemmatizer.CachedLemmatizer(MORPH_AN)
+    assert lemm.warm_up(texts) > 0
+    assert lemmatizer.get_normal_forms(lemm, toks) == lemmatizer.get_normal_forms(MORPH_AN, toks)
+    assert lemm.misses == 0
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(tmp_dir, "lemmas.json")
+        lemm.save(cache_path)
+        loaded_lemm = lemmatizer.CachedLemmatizer(MORPH_AN)
+        assert loaded_lemm.load(cache_path)
+        assert lemmatizer.get_normal_forms(loaded_lemm, toks) == lemmatizer.get_normal_forms(MORPH_AN, toks)
+        assert loaded_lemm.misses == 0
+
+        # normal forms of another dictionary version are not used
+        with open(cache_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        assert data["morph_version"] == lemmatizer.get_morph_version(MORPH_AN)
+        data["morph_version"] = data["morph_version"].rsplit("/", 1)[0] + "/other dictionary build"
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        assert not lemmatizer.CachedLemmatizer(MORPH_AN).load(cache_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    facts = text_parser.extract_facts(texts[0], ONT_STAT, lemmatizer.CachedLemmatizer(MORPH_AN), SIZE_RULE)
+    assert [str(f) for f in facts] == [str(f) for f in text_parser.extract_facts(texts[0], ONT_STAT, MORPH_AN, SIZE_RULE)]
+
+
+def test_ontology_relations():
+    assert text_parser._get_relation(ONT_STAT, "юбка", "юбка", is_attr=False) == 0
+    assert text_parser._get_relation(ONT_STAT, "одежда", "юбка", is_attr=False) == 1
+    assert text_parser._get_relation(ONT_STAT, "юбка", "одежда", is_attr=False) == -1
+    assert text_parser._get_relation(ONT_STAT, "юбка", "джинсы", is_attr=False) is None
+    assert text_parser._get_relation(ONT_STAT, "натуральный", "шёлк", is_attr=True) == 1
+    assert text_parser._get_relation(ONT_STAT, "одежда", "юбка", is_attr=True) is None
+
+    # closure must coincide with SPARQL property path on the whole ontology
+    for parsed_class_str, ancestor_key in [
+        ("local:parsed_objects", "obj_name_ancestors"),
+        ("local:parsed_attributes", "attr_name_ancestors"),
+    ]:
+        res = ONTOLOGY.query(
+            "SELECT DISTINCT ?main_name ?parent_name "
+            "WHERE { "
+            "    ?main_obj local:is_subclass+ ?parent_obj ."
+            f"    ?main_obj local:is_included {parsed_class_str} . "
+            f"    ?parent_obj local:is_included {parsed_class_str} . "
+            "    ?parent_obj local:has_name ?parent_name . "
+            "    ?main_obj local:has_name ?main_name . "
+            "}"
+        )
+        sparql_pairs = set((row[0].toPython(), row[1].toPython()) for row in res)
+        closure_pairs = set((name, anc_name) for name, anc_names in ONT_STAT[ancestor_key].items() for anc_name in anc_names)
+        assert sparql_pairs == closure_pairs
+
+
+def test_ontology_stat():
+    ref_stat = ontology_stat_reference.calc_ontology_stat_by_queries(ONTOLOGY)
+    for key, ref_value in ref_stat.items():
+        # the order of classes matters, as the first one is used for the found object
+        assert ONT_STAT[key] == ref_value, f"Mismatch in \"{key}\""
+
+    for attr_name, attr_value in ONT_STAT["attr_value_map"].items():
+        res = ONTOLOGY.query(
+            "SELECT DISTINCT ?attr_obj ?class_obj "
+            "WHERE { "
+            "    VALUES ?class_obj {local:gender local:season local:material} "
+            "    ?attr_obj local:is_included ?class_obj . "
+            "    ?attr_obj local:is_included local:parsed_attributes . "
+            f"    ?attr_obj local:has_name \"{attr_name}\" . "
+            "}"
+        )
+        res = list(res)
+        assert len(res) == 1
+        attr_obj = res[0][0].n3(ONTOLOGY.namespace_manager)
+        attr_type = res[0][1].n3(ONTOLOGY.namespace_manager)
+        assert text_parser._attr_node_to_value(attr_obj, attr_type) == attr_value
+    assert ONT_STAT["attr_name_set"] <= set(ONT_STAT["attr_value_map"].keys())
+    assert ONT_STAT["attr_value_map"]["зимний"] == ("season", cloth_handler.ClothFact.Season.WINTER)
+    assert ONT_STAT["attr_value_map"]["женский"] == ("gender", cloth_handler.ClothFact.Gender.WOMAN)
+    assert ONT_STAT["attr_value_map"]["шёлк"] == ("material", "local:Silk")
+
+
+def test_ontology_snapshot():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ttl_path = os.path.join(tmp_dir, "ontology.ttl")
+        shutil.copyfile("search_pipeline/ontology.ttl", ttl_path)
+
+        snapshot = ontology_snapshot.load_snapshot(ttl_path)
+        assert os.path.isfile(os.path.join(tmp_dir, "ontology.snapshot.pkl"))
+        assert snapshot["ont_stat"] == ONT_STAT
+        assert "платье" in snapshot["completion"]["obj_names"]
+        assert snapshot["completion"]["obj_names"] == sorted(snapshot["completion"]["obj_names"])
+        # second load must read the same data from the file
+        assert ontology_snapshot.load_snapshot(ttl_path) == snapshot
+
+        # snapshot of another code version is rebuilt
+        snapshot_path = os.path.join(tmp_dir, "ontology.snapshot.pkl")
+        with open(snapshot_path, "wb") as f:
+            pickle.dump({**snapshot, "code_hash": "old code", "ont_stat": {}}, f)
+        assert ontology_snapshot.load_snapshot(ttl_path) == snapshot
+        assert ontology_snapshot.calc_code_hash() == snapshot["code_hash"]
+        changed_code_path = os.path.join(tmp_dir, "text_parser.py")
+        with open(changed_code_path, "w", encoding="utf-8") as f:
+            f.write("# changed code\n")
+        assert ontology_snapshot.calc_code_hash([changed_code_path]) != snapshot["code_hash"]
+
+        # any change of TTL file leads to rebuild
+        with open(ttl_path, "a", encoding="utf-8") as f:
+            f.write(
+                "\nlocal:objTestN local:has_name \"тестовая вещь\" ;\n"
+                "    local:is_subclass local:obj1256N ;\n"
+                "    local:is_included local:parsed_objects .\n"
+            )
+        new_snapshot = ontology_snapshot.load_snapshot(ttl_path)
+        assert new_snapshot["ttl_hash"] != snapshot["ttl_hash"]
+        assert "тестовая вещь" in new_snapshot["ont_stat"]["obj_name_set"]
+        assert "тестовая вещь" in new_snapshot["completion"]["obj_child_names"]["local:obj1256N"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
     test_text_parsing()
+    test_size_token_alignment()
+    test_size_screen()
+    test_cached_lemmatizer()
+    test_ontology_relations()
+    test_ontology_stat()
+    test_ontology_snapshot()
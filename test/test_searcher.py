@@ -0,0 +1,449 @@
+import sys
+import os
+import concurrent.futures
+import gc
+import random
+import shutil
+import tempfile
+import weakref
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from search_pipeline import searcher
+from search_pipeline import profiling
+
+
+ADS = [
+    "Отдам вещи на девочку р 80-92. Большая юбка, зелёные осенние джинсы и красные кофты",
+    "Продам куртку зимнюю мужскую размер 52, штаны 50-52, ботинки 42, шапку",
+    "продам куртку, штаны, ботинки 42, шапку, шарф, варежки, перчатки размер L",
+    "Пуховик женский XL, состояние отличное",
+    "Платье шёлковое 44 р., туфли 37",
+    "Детская куртка на мальчика 5-6 лет, демисезонная",
+    "Отдам коляску и кроватку",
+    "Пальто кашемировое женское 46-48 размер, сапоги зимние 38",
+    "Футболки 3XL 2 шт, рубашка мужская 54",
+    "джинсы 30, джинсы 32, джинсы 34",
+    "Вещи для школьницы 10 лет: юбка, блузка, пиджак",
+    "Продам свитер шерстяной унисекс размер S-M",
+    "Сапоги кожаные женские 39 размер. Куртка демисезонная 46",
+    "Продаю телевизор и холодильник",
+    "Шорты джинсовые на девочку 8-9 лет, футболка хлопковая",
+    "Трикотажный костюм 44.5, кардиган",
+]
+REQUESTS = [
+    "ищу одежду для девочки",
+    "ищу платье 44",
+    "нужны джинсы 32",
+    "ищу шапку",
+    "ищу пуховик XL",
+    "нужен свитер M",
+    "нужна коляска",
+]
+
+
+def _fact_key(fact):
+    return (fact.class_name, fact.parsed_name, fact.parsed_size_info, sorted(fact.props.items()))
+
+
+def test_parallel_encoding():
+    serial_facts = searcher.encode_strings(ADS)
+    parallel_facts = searcher.encode_strings(ADS, workers=2, chunk_size=3)
+    assert len(parallel_facts) == len(ADS)
+    assert [[_fact_key(f) for f in facts] for facts in parallel_facts] == [[_fact_key(f) for f in facts] for facts in serial_facts]
+
+
+def test_streaming_encoding():
+    serial_keys = [[_fact_key(f) for f in facts] for facts in searcher.encode_strings(ADS)]
+
+    for workers in [1, 2]:
+        stream_res = list(searcher.iter_encoded_strings(iter(ADS), workers=workers, chunk_size=4))
+        assert [ad_id for ad_id, _ in stream_res] == list(range(1, len(ADS) + 1))
+        assert [[_fact_key(f) for f in facts] for _, facts in stream_res] == serial_keys
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        checkpoint_path = os.path.join(tmp_dir, "checkpoint.json")
+        stream = searcher.iter_encoded_strings(ADS, chunk_size=4, checkpoint_path=checkpoint_path)
+        first_res = [next(stream) for _ in range(6)]
+        stream.close()
+        # only the first full chunk is confirmed as consumed, so the second chunk will be encoded again
+        resumed_res = list(searcher.iter_encoded_strings(ADS, chunk_size=4, checkpoint_path=checkpoint_path))
+        assert [ad_id for ad_id, _ in resumed_res] == list(range(5, len(ADS) + 1))
+        assert [[_fact_key(f) for f in facts] for _, facts in first_res[:4] + resumed_res] == serial_keys
+        assert list(searcher.iter_encoded_strings(ADS, checkpoint_path=checkpoint_path)) == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_encoding_dedup():
+    serial_keys = [[_fact_key(f) for f in facts] for facts in searcher.encode_strings(ADS)]
+
+    # spaces and tabs do not change facts, so such copies are encoded only once
+    spaced_ads = [" " + ad.replace(" ", " \t  ") + "  " for ad in ADS]
+    for workers in [1, 2]:
+        stats = {}
+        res = searcher.encode_strings(ADS + spaced_ads + ADS, workers=workers, chunk_size=4, stats=stats)
+        assert [[_fact_key(f) for f in facts] for facts in res] == serial_keys * 3
+        assert stats["texts"] == 3 * len(ADS)
+        assert stats["unique_texts"] == len(set(ADS))
+        assert res[0] is res[len(ADS)]
+
+    # facts of only the last unique texts are kept, so texts, which are repeated after many other texts, are encoded again
+    for workers in [1, 2]:
+        stats = {}
+        res = [
+            facts for _, facts in searcher.iter_encoded_strings(
+                ADS + ADS[:1] + ADS, workers=workers, chunk_size=4, stats=stats, dedup_cache_size=2
+            )
+        ]
+        assert [[_fact_key(f) for f in facts] for facts in res] == serial_keys + serial_keys[:1] + serial_keys
+        # texts of chunks, which are taken ahead by the pool, are deduplicated too
+        if workers == 1:
+            assert stats["unique_texts"] == 2 * len(set(ADS))
+        else:
+            assert len(set(ADS)) < stats["unique_texts"] <= 2 * len(set(ADS))
+        assert res[0] is not res[len(ADS) + 1]
+
+
+def test_profiling():
+    profiling.reset()
+    searcher.encode_strings(ADS)
+    assert profiling.get_stats() == {}  # disabled by default
+
+    profiling.enable()
+    try:
+        for workers in [1, 2]:
+            profiling.reset()
+            searcher.encode_strings(ADS, workers=workers, chunk_size=4)
+            stats = profiling.get_stats()
+            assert stats["extract_facts"]["calls"] == len(set(ADS))
+            assert stats["tokenization"]["calls"] == len(set(ADS))
+            assert stats["fact_construction"]["calls"] > 0
+    finally:
+        profiling.enable(False)
+        profiling.reset()
+
+
+def test_ad_index():
+    enc_ads = searcher.encode_strings(ADS + ["", "Продаю телевизор"])
+    # requests with descendant names (e.g. "одежда") and ads themselves as requests
+    enc_requests = searcher.encode_strings(REQUESTS + ["нужна одежда", "ищу вещи на девочку 8 лет"]) + enc_ads
+    for backend in searcher.AD_INDEX_BACKENDS:
+        index = searcher.build_ad_index(enc_ads, backend)
+        for enc_req in enc_requests:
+            assert searcher.search_index(enc_req, index) == searcher.search(enc_req, enc_ads)
+        assert len(searcher.search_index(searcher.encode_strings(["нужна одежда"])[0], index)) > 1
+
+
+def _make_random_facts(rnd, count):
+    # facts of a few related classes with random sizes and attributes, so all branches of index search are visited
+    class_names = [("ont:obj:local:obj1256N", "одежда"), ("ont:obj:local:obj1256N", "вещи"), ("ont:obj:local:obj108048N", "куртка")]
+    facts = []
+    for _ in range(count):
+        class_name, parsed_name = rnd.choice(class_names)
+        size_range = None
+        if rnd.random() < 0.7:
+            size_from = rnd.choice([rnd.randint(18, 82), rnd.randint(18, 82) + 0.5])
+            size_range = [size_from, size_from + rnd.choice([0, 0, 2, 4, 20])]
+        props = {}
+        if rnd.random() < 0.5:
+            props["gender"] = rnd.choice([1, 2, 3])
+        if rnd.random() < 0.3:
+            props["season"] = rnd.choice([1, 2, 3])
+        if rnd.random() < 0.2:
+            props["material"] = rnd.choice(["local:Silk", "local:Wool"])
+        facts.append(searcher.cloth_handler.ClothFact.from_dict(
+            {"class_name": class_name, "parsed_name": parsed_name, "parsed_size_info": size_range, "props": props}
+        ))
+    return facts
+
+
+def test_ad_index_random():
+    rnd = random.Random(0)
+    enc_ads = [_make_random_facts(rnd, rnd.randint(0, 3)) for _ in range(300)]
+    enc_requests = [_make_random_facts(rnd, rnd.randint(1, 2)) for _ in range(200)]
+    for backend in searcher.AD_INDEX_BACKENDS:
+        index = searcher.build_ad_index(enc_ads[:150], backend)
+        for enc_req in enc_requests[:20]:
+            assert searcher.search_index(enc_req, index) == searcher.search(enc_req, enc_ads[:150])
+        for ad_facts in enc_ads[150:]:
+            index.add_ad(ad_facts)  # lazy structures are rebuilt after additions
+        for enc_req in enc_requests:
+            assert searcher.search_index(enc_req, index) == searcher.search(enc_req, enc_ads)
+
+
+def test_search_many():
+    rnd = random.Random(1)
+    enc_ads = [_make_random_facts(rnd, rnd.randint(0, 3)) for _ in range(200)]
+    # repeated requests and requests without facts are present too
+    enc_requests = [_make_random_facts(rnd, rnd.randint(0, 2)) for _ in range(100)]
+    enc_requests += enc_requests[:10]
+    for backend in searcher.AD_INDEX_BACKENDS:
+        index = searcher.build_ad_index(enc_ads, backend)
+        match_matrix = searcher.search_many(enc_requests, index)
+        assert match_matrix.shape == (len(enc_requests), len(enc_ads))
+        for req_idx, enc_req in enumerate(enc_requests):
+            assert match_matrix.get_row(req_idx) == searcher.search(enc_req, enc_ads)
+        assert match_matrix.to_dense().sum() == match_matrix.nnz
+        assert searcher.search_many([], index).shape == (0, len(enc_ads))
+        assert searcher.search_many(enc_requests, searcher.build_ad_index([], backend)).nnz == 0
+
+
+def test_search_top_k():
+    rnd = random.Random(2)
+    enc_ads = [_make_random_facts(rnd, rnd.randint(0, 3)) for _ in range(300)]
+    enc_requests = [_make_random_facts(rnd, rnd.randint(1, 2)) for _ in range(50)]
+    for enc_req in enc_requests:
+        scores = searcher.get_probs(enc_req, enc_ads, graded=True)
+        # graded scores keep the same matches
+        assert [idx for idx, score in enumerate(scores) if score > 0] == searcher.search(enc_req, enc_ads)
+        assert all(0 <= score <= 1 for score in scores)
+        expected = sorted(((idx, score) for idx, score in enumerate(scores) if score > 0), key=lambda x: (-x[1], x[0]))
+        for backend in searcher.AD_INDEX_BACKENDS:
+            index = searcher.build_ad_index(enc_ads, backend)
+            for k in [1, 5, 1000]:
+                assert searcher.search_top_k(enc_req, index, k) == expected[:k]
+            assert searcher.search_top_k(enc_req, index, 1000, min_score=0.7) == [
+                (idx, score) for idx, score in expected if score >= 0.7
+            ]
+    # ad of the same class is better than ad of descendant class, and ad with the same size is better than ad without it
+    enc_ads = searcher.encode_strings(["блузка", "блузка 44", "Продам одежду 44", "блузка 42"])
+    enc_req = searcher.encode_strings(["нужна одежда 44"])[0]
+    index = searcher.build_ad_index(enc_ads)
+    assert [idx for idx, _ in searcher.search_top_k(enc_req, index, 10)] == [2, 1, 0]
+    assert [idx for idx, _ in searcher.search_top_k(enc_req, index, 1)] == [2]
+
+
+def test_ad_index_updates():
+    rnd = random.Random(3)
+    enc_requests = [_make_random_facts(rnd, rnd.randint(1, 2)) for _ in range(30)]
+    for backend in searcher.AD_INDEX_BACKENDS:
+        enc_ads = [_make_random_facts(rnd, rnd.randint(0, 3)) for _ in range(100)]
+        index = searcher.build_ad_index(enc_ads, backend)
+        removed_idx_set = set()
+        for step in range(300):
+            action = rnd.random()
+            if action < 0.3:
+                enc_ads.append(_make_random_facts(rnd, rnd.randint(0, 3)))
+                assert index.add_ad(enc_ads[-1]) == len(enc_ads) - 1
+            elif action < 0.6:
+                ad_idx = rnd.randrange(len(enc_ads))
+                enc_ads[ad_idx] = _make_random_facts(rnd, rnd.randint(1, 3))
+                index.replace_ad(ad_idx, enc_ads[ad_idx])
+                removed_idx_set.discard(ad_idx)
+            else:
+                # removed ads are never found, as ads without facts
+                ad_idx = rnd.randrange(len(enc_ads))
+                assert index.remove_ad(ad_idx) == (ad_idx not in removed_idx_set)
+                assert index.get_ad_facts(ad_idx) is None
+                removed_idx_set.add(ad_idx)
+                enc_ads[ad_idx] = []
+            if step % 10 == 0:
+                for enc_req in enc_requests:
+                    assert searcher.search_index(enc_req, index) == searcher.search(enc_req, enc_ads)
+                scores = searcher.get_probs(enc_requests[0], enc_ads, graded=True)
+                expected = sorted(((idx, score) for idx, score in enumerate(scores) if score > 0), key=lambda x: (-x[1], x[0]))
+                assert searcher.search_top_k(enc_requests[0], index, 5) == expected[:5]
+        index.compact()
+        match_matrix = searcher.search_many(enc_requests, index)
+        for req_idx, enc_req in enumerate(enc_requests):
+            assert match_matrix.get_row(req_idx) == searcher.search(enc_req, enc_ads)
+
+
+def _get_shallow_state(index):
+    # identities of index attributes and of items of dictionary attributes
+    return {
+        name: (id(value), {key: id(item) for key, item in value.items()} if isinstance(value, dict) else None)
+        for name, value in vars(index).items()
+    }
+
+
+def test_versioned_index():
+    rnd = random.Random(4)
+    enc_requests = [_make_random_facts(rnd, rnd.randint(1, 2)) for _ in range(20)]
+    for backend in searcher.AD_INDEX_BACKENDS:
+        versioned_index = searcher.build_versioned_ad_index(
+            [_make_random_facts(rnd, rnd.randint(0, 3)) for _ in range(100)], backend
+        )
+        old_snapshot = versioned_index.get_snapshot()
+        # published snapshot is not changed by searches
+        old_state = _get_shallow_state(old_snapshot)
+        old_results = [searcher.search_index(enc_req, old_snapshot) for enc_req in enc_requests]
+        assert _get_shallow_state(old_snapshot) == old_state
+        old_stats = old_snapshot.get_stats()
+        is_writing = [True]
+
+        def _read():
+            # results of a pinned snapshot match its ads, while new snapshots are published
+            check_cnt = 0
+            while is_writing[0] or check_cnt == 0:
+                snapshot = versioned_index.get_snapshot()
+                enc_ads = [snapshot.get_ad_facts(ad_idx) or [] for ad_idx in range(snapshot.ad_count)]
+                for enc_req in enc_requests:
+                    assert searcher.search_index(enc_req, snapshot) == searcher.search(enc_req, enc_ads)
+                check_cnt += 1
+            return check_cnt
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(_read) for _ in range(3)]
+            try:
+                for step in range(100):
+                    ad_idx = rnd.randrange(100)
+                    if step % 3 == 0:
+                        versioned_index.add_ad(_make_random_facts(rnd, rnd.randint(1, 3)))
+                    elif step % 3 == 1:
+                        versioned_index.replace_ad(ad_idx, _make_random_facts(rnd, rnd.randint(1, 3)))
+                    else:
+                        versioned_index.remove_ad(ad_idx)
+            finally:
+                is_writing[0] = False
+            assert all(future.result() > 0 for future in futures)
+
+        # the old snapshot is not changed by updates and is freed after its last reader drops it
+        assert [searcher.search_index(enc_req, old_snapshot) for enc_req in enc_requests] == old_results
+        assert old_snapshot.get_stats() == old_stats
+        assert versioned_index.get_stats()["published"] == 101
+        old_snapshot_ref = weakref.ref(old_snapshot)
+        del old_snapshot
+        gc.collect()
+        assert old_snapshot_ref() is None
+
+        # names of new ads are added only to the new snapshot
+        enc_ads = searcher.encode_strings(ADS)
+        versioned_index = searcher.build_versioned_ad_index(enc_ads[:4], backend)
+        old_snapshot = versioned_index.get_snapshot()
+        old_stats = old_snapshot.get_stats()
+        for ad_facts in enc_ads[4:]:
+            versioned_index.add_ad(ad_facts)
+        assert old_snapshot.get_stats() == old_stats
+        assert versioned_index.get_stats()["names"] > old_stats["names"]
+        for enc_req in enc_ads:
+            assert searcher.search_index(enc_req, old_snapshot) == searcher.search(enc_req, enc_ads[:4])
+            assert searcher.search_index(enc_req, versioned_index.get_snapshot()) == searcher.search(enc_req, enc_ads)
+
+        # copies of the same index and the index itself add different names independently
+        index = searcher.build_ad_index(enc_ads[:4], backend)
+        index.prepare()
+        copy_ads = [enc_ads[:4] + [enc_ads[ad_idx]] for ad_idx in (4, 5, 7)]
+        for index_copy, ad_list in zip([index.copy(), index.copy(), index], copy_ads):
+            index_copy.add_ad(ad_list[-1])
+            assert index_copy.get_stats()["names"] > old_stats["names"]
+            for enc_req in enc_ads:
+                assert searcher.search_index(enc_req, index_copy) == searcher.search(enc_req, ad_list)
+
+
+def test_result_cache():
+    enc_ads = searcher.encode_strings(ADS)
+    enc_requests = searcher.encode_strings(["ищу куртку 44", "куплю куртку размер 44", "ищу куртку 46"])
+    for backend in searcher.AD_INDEX_BACKENDS:
+        index = searcher.build_ad_index(enc_ads, backend)
+        cache = searcher.result_cache.SearchResultCache(max_size=2)
+        # requests with the same facts share results
+        for enc_req in enc_requests[:2]:
+            assert searcher.search_index(enc_req, index, cache) == searcher.search(enc_req, enc_ads)
+        assert cache.hits == 1 and cache.misses == 1
+        assert searcher.search_index(list(reversed(enc_ads[0])), index, cache) == searcher.search(enc_ads[0], enc_ads)
+        # top-k results are cached apart from search results
+        top_k = searcher.search_top_k(enc_requests[0], index, 3, cache=cache)
+        assert searcher.search_top_k(enc_requests[1], index, 3, cache=cache) == top_k
+        assert len(cache) == 2
+
+        # the least recently used result is evicted
+        searcher.search_index(enc_requests[2], index, cache)
+        hit_cnt = cache.hits
+        searcher.search_index(enc_requests[0], index, cache)
+        assert cache.hits == hit_cnt
+
+        # results are not taken from the cache after the index is changed
+        index.add_ad(enc_requests[0])
+        assert searcher.search_index(enc_requests[1], index, cache) == searcher.search(enc_requests[1], enc_ads + enc_requests[:1])
+        assert cache.hits == hit_cnt and cache.invalidations == 1
+
+        # the cache does not keep the searched index in memory
+        index_ref = weakref.ref(index)
+        del index
+        gc.collect()
+        assert index_ref() is None
+
+    # threads share the cache, while new snapshots are published
+    versioned_index = searcher.build_versioned_ad_index(enc_ads)
+    cache = searcher.result_cache.SearchResultCache()
+
+    def _read(enc_req):
+        snapshot = versioned_index.get_snapshot()
+        return searcher.search_index(enc_req, snapshot, cache) == searcher.search_index(enc_req, snapshot)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(_read, enc_req) for enc_req in enc_requests * 50]
+        for enc_ad in enc_ads:
+            versioned_index.add_ad(enc_ad)
+        assert all(future.result() for future in futures)
+
+
+def test_encoded_store():
+    serial_keys = [[_fact_key(f) for f in facts] for facts in searcher.encode_strings(ADS)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_path = os.path.join(tmp_dir, "encoded.json")
+        store = searcher.load_encoded_store(store_path)
+        assert [[_fact_key(f) for f in facts] for facts in searcher.encode_strings(ADS, store=store)] == serial_keys
+        assert store.hits == 0
+        store.save()
+
+        # unchanged lines are taken from the store, changed and new lines are encoded again
+        changed_ads = ADS[:5] + ["Пуховик мужской 50 размер"] + ADS[6:]
+        changed_keys = [[_fact_key(f) for f in facts] for facts in searcher.encode_strings(changed_ads)]
+        store = searcher.load_encoded_store(store_path)
+        assert len(store) == len(set(ADS))
+        for workers in [1, 2]:
+            res = searcher.encode_strings(changed_ads, workers=workers, chunk_size=4, store=store)
+            assert [[_fact_key(f) for f in facts] for facts in res] == changed_keys
+        assert store.misses == 1
+        # the removed line is evicted on saving
+        store.save()
+        assert store.evicted == 1
+        assert len(searcher.load_encoded_store(store_path)) == len(set(changed_ads))
+
+        # facts of another encoder version are not used
+        other_store = searcher.encoded_store.EncodedStore(store_path, "other version")
+        assert not other_store.load()
+        assert len(other_store) == 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_encoder_version():
+    assert searcher._calc_encoder_version() == searcher.ENCODER_VERSION
+
+    # changed size table changes the version, so stored facts with old sizes are not used
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        module_paths = list(searcher._ENCODER_MODULE_PATHS)
+        decoder_pos = module_paths.index(searcher.size_decoder.__file__)
+        with open(module_paths[decoder_pos], encoding="utf-8") as f:
+            decoder_code = f.read()
+        changed_code = decoder_code.replace('"xs": (40, 44)', '"xs": (40, 46)', 1)
+        assert changed_code != decoder_code
+        module_paths[decoder_pos] = os.path.join(tmp_dir, "size_decoder.py")
+        with open(module_paths[decoder_pos], "w", encoding="utf-8") as f:
+            f.write(changed_code)
+        assert searcher._calc_encoder_version(module_paths) != searcher.ENCODER_VERSION
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_parallel_encoding()
+    test_streaming_encoding()
+    test_encoding_dedup()
+    test_profiling()
+    test_ad_index()
+    test_ad_index_random()
+    test_search_many()
+    test_search_top_k()
+    test_ad_index_updates()
+    test_versioned_index()
+    test_result_cache()
+    test_encoded_store()
+    test_encoder_version()
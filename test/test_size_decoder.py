@@ -0,0 +1,309 @@
+import itertools
+import sys
+import os
+from types import SimpleNamespace
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from search_pipeline import cloth_handler
+from search_pipeline import size_decoder
+
+
+# === previous implementation of size decoding, which is the reference for the lookup tables ===
+
+
+def _legacy_is_size_letters(token):
+    res = True
+    first_digits = []
+    letters_started = False
+    end_letter_reached = False
+    x_count = 0
+    for c in token:
+        if end_letter_reached:
+            res = False
+            break
+        if c.isdigit():
+            if letters_started:
+                res = False
+                break
+            first_digits.append(c)
+            continue
+        if not letters_started:
+            if len(first_digits) > 0:
+                if c.lower() != "x":
+                    res = False
+                    break
+                digit_val = int("".join(first_digits))
+                if digit_val < 1 or digit_val > size_decoder.MAX_CLOTHES_SIZE_X_COUNT:
+                    res = False
+                    break
+            if c.lower() not in ["x", "s", "m", "l"]:
+                res = False
+                break
+            if c.lower() in ["s", "m", "l"]:
+                end_letter_reached = True
+            first_digits = []
+            letters_started = True
+            continue
+        if c.lower() == "x":
+            x_count += 1
+            if len(first_digits) > 0 or x_count > size_decoder.MAX_CLOTHES_SIZE_X_COUNT:
+                res = False
+                break
+            continue
+        if c.lower() not in ["s", "m", "l"]:
+            res = False
+            break
+        end_letter_reached = True
+    if not letters_started or not end_letter_reached:
+        res = False
+    return res
+
+
+def _legacy_size_letter_toks_to_value(size_letters, gender, max_x_count):
+
+    def lead_number_to_x(size_info, max_x_count):
+        first_digits = []
+        res = []
+        for pos, c in enumerate(size_info):
+            if c.isdigit():
+                first_digits.append(c)
+                continue
+            if len(first_digits) > 0:
+                digit_val = max(1, min(int("".join(first_digits)), max_x_count))
+                res = "".join(["x"] * digit_val)
+                if c.lower() != "x":
+                    res += size_info[pos:]
+                else:
+                    res += size_info[pos + 1:]
+            else:
+                res = size_info
+            break
+        return res.lower()
+
+    def letters_to_range(letters, gender_code):
+        m_letters_to_size_map = {
+            "xs": (40, 44),
+            "s": (42, 48),
+            "m": (44, 50),
+            "l": (48, 52),
+            "xl": (50, 56),
+            "xxl": (52, 60),
+            "xxxl": (54, 64),
+            "xxxxl": (56, 66),
+            "xxxxxl": (58, 70),
+            "xxxxxxl": (60, 72),
+            "xxxxxxxl": (62, 74),
+            "xxxxxxxxl": (64, 76),
+            "xxxxxxxxxl": (66, 78),
+            "xxxxxxxxxxl": (68, 80),
+        }
+        w_letters_to_size_map = {
+            "xxxs": (36, 36),
+            "xxs": (38, 38),
+            "xs": (38, 44),
+            "s": (42, 46),
+            "m": (44, 48),
+            "l": (46, 50),
+            "xl": (48, 54),
+            "xxl": (50, 58),
+            "xxxl": (52, 64),
+            "xxxxl": (54, 66),
+            "xxxxxl": (56, 70),
+            "xxxxxxl": (58, 74),
+            "xxxxxxxl": (56, 78),
+            "xxxxxxxxl": (58, 82),
+        }
+
+        if gender_code == "m":
+            mapper = m_letters_to_size_map
+        else:
+            mapper = w_letters_to_size_map
+
+        if letters not in mapper:
+            if letters[-1] == "l":
+                res_range = (max(max(v) for v in mapper.values()), size_decoder.MAX_CLOTHES_SIZE_INT)
+            else:
+                res_range = (size_decoder.MIN_CLOTHES_SIZE_INT, min(min(v) for v in mapper.values()))
+        else:
+            res_range = mapper[letters]
+
+        assert res_range[0] <= res_range[1]
+        return res_range
+
+    size_letters = lead_number_to_x(size_letters, max_x_count)
+
+    if gender is None or gender == cloth_handler.ClothFact.Gender.UNISEX:
+        m_range = letters_to_range(size_letters, "m")
+        w_range = letters_to_range(size_letters, "w")
+        size_range = (min(m_range[0], w_range[0]), max(m_range[1], w_range[1]))
+    elif gender == cloth_handler.ClothFact.Gender.MAN:
+        size_range = letters_to_range(size_letters, "m")
+    elif gender == cloth_handler.ClothFact.Gender.WOMAN:
+        size_range = letters_to_range(size_letters, "w")
+    else:
+        raise ValueError(f"Unknown gender value: {gender}")
+
+    return size_range
+
+
+def _legacy_indirect_info_to_range(size_info, self):
+    if size_info.keyword == "мальчик":
+        self.gender = cloth_handler.ClothFact.Gender.MAN
+        size_range = (size_decoder.MIN_CHILD_CLOTHES_SIZE_INT, size_decoder.MAX_CHILD_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "девочка":
+        self.gender = cloth_handler.ClothFact.Gender.WOMAN
+        size_range = (size_decoder.MIN_CHILD_CLOTHES_SIZE_INT, size_decoder.MAX_CHILD_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "мужчина":
+        self.gender = cloth_handler.ClothFact.Gender.MAN
+        size_range = (size_decoder.MAX_CHILD_CLOTHES_SIZE_INT, size_decoder.MAX_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "женщина":
+        self.gender = cloth_handler.ClothFact.Gender.WOMAN
+        size_range = (size_decoder.MAX_CHILD_CLOTHES_SIZE_INT, size_decoder.MAX_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "ребёнок":
+        size_range = (size_decoder.MIN_CLOTHES_SIZE_INT, size_decoder.MAX_CHILD_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "взрослый":
+        size_range = (size_decoder.MAX_CHILD_CLOTHES_SIZE_INT, size_decoder.MAX_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "школьник":
+        # in some cases this word can also be applicable to women
+        if self.gender is None:
+            self.gender = cloth_handler.ClothFact.Gender.MAN
+        size_range = (size_decoder.MIN_M_SCHOOL_CLOTHES_SIZE_INT, size_decoder.MAX_M_SCHOOL_CLOTHES_SIZE_INT)
+    elif size_info.keyword == "школьница":
+        self.gender = cloth_handler.ClothFact.Gender.WOMAN
+        size_range = (size_decoder.MIN_W_SCHOOL_CLOTHES_SIZE_INT, size_decoder.MAX_W_SCHOOL_CLOTHES_SIZE_INT)
+    else:
+        raise ValueError(f"Unknown keyword: {size_info.keyword}")
+
+    if size_info.year_info_from_y is not None:
+        year_to_size_map = {
+            0: (18, 26),
+            1: (26, 28),
+            2: (28, 30),
+            3: (28, 30),
+            4: (30, 30),
+            5: (30, 32),
+            6: (32, 34),
+            7: (34, 36),
+            8: (34, 36),
+            9: (36, 36),
+            10: (36, 36),
+            11: (36, 38),
+            12: (36, 38),
+            13: (38, 40),
+            14: (38, 40),
+        }
+        if size_info.year_info_to_y is None:
+            size_info.year_info_to_y = size_info.year_info_from_y
+        from_y = int(size_info.year_info_from_y)
+        to_y = int(size_info.year_info_to_y)
+
+        size_from = year_to_size_map.get(from_y, (size_decoder.MAX_CHILD_CLOTHES_SIZE_INT, size_range[1]))
+        size_to = year_to_size_map.get(to_y, (size_range[0], size_decoder.MAX_CLOTHES_SIZE_INT))
+        size_range = (min(size_from), max(size_to))
+    elif size_info.year_info_from_m is not None:
+        month_to_size_map = {
+            0: (18, 18),
+            1: (18, 20),
+            2: (18, 20),
+            3: (18, 22),
+            4: (20, 22),
+            5: (20, 22),
+            6: (20, 24),
+            7: (22, 24),
+            8: (22, 24),
+            9: (22, 26),
+            10: (24, 26),
+            11: (24, 26),
+            12: (24, 26),
+        }
+        if size_info.year_info_to_m is None:
+            size_info.year_info_to_m = size_info.year_info_from_m
+        from_m = int(size_info.year_info_from_m)
+        to_m = int(size_info.year_info_to_m)
+
+        size_from = month_to_size_map.get(from_m, (size_decoder.MAX_CHILD_CLOTHES_SIZE_INT, size_range[1]))
+        size_to = month_to_size_map.get(to_m, (size_range[0], size_decoder.MAX_CLOTHES_SIZE_INT))
+        size_range = (min(size_from), max(size_to))
+    else:
+        # no info is present
+        pass
+
+    return size_range
+
+
+# === tests ===
+
+GENDERS = [None, cloth_handler.ClothFact.Gender.MAN, cloth_handler.ClothFact.Gender.WOMAN, cloth_handler.ClothFact.Gender.UNISEX]
+
+
+def _iter_letter_tokens():
+    # all short tokens over the relevant alphabet and long "x" runs around the limit of "x" count
+    alphabet = "019xXsSmMlLa-"
+    for length in range(1, 5):
+        for chars in itertools.product(alphabet, repeat=length):
+            yield "".join(chars)
+    for x_cnt in range(size_decoder.MAX_CLOTHES_SIZE_X_COUNT + 4):
+        for prefix in ["", "0", "1", "2", "12", "13", "012", "x"]:
+            for end in ["", "s", "M", "l", "L", "lx", "a"]:
+                for x_char in ["x", "X"]:
+                    yield prefix + x_char * x_cnt + end
+
+
+def test_size_letters():
+    size_letters = []
+    for token in _iter_letter_tokens():
+        is_letters = size_decoder.is_size_letters(token)
+        assert is_letters == _legacy_is_size_letters(token), token
+        if is_letters:
+            size_letters.append(token)
+    assert len(size_letters) > 100
+    # spellings of the parser (except for numbers with leading zeros) are decoded by one lookup
+    raw_letters = {letters.lower() for letters in size_letters if not letters.startswith("0")}
+    assert raw_letters <= set(size_decoder._RAW_LETTERS_TABLE[None])
+
+    # grammar joins the optional number token with letters, so such texts (e.g. "10 XL") are decoded too
+    joined_letters = [f"{x_cnt} {letters}" for letters in size_letters for x_cnt in range(2, size_decoder.MAX_CLOTHES_SIZE_X_COUNT + 1)]
+    for letters in size_letters + joined_letters:
+        for gender in GENDERS:
+            assert size_decoder.letters_to_size_range(letters, gender) == \
+                _legacy_size_letter_toks_to_value(letters, gender, size_decoder.MAX_CLOTHES_SIZE_X_COUNT), (letters, gender)
+
+
+class SizeInfo(SimpleNamespace):
+    pass
+
+
+SizeInfo.__name__ = "size_info"  # decoding dispatches on the class name of yargy facts
+
+
+def test_age_ranges():
+    ages = [None] + [str(age) for age in range(20)]
+    for keyword in size_decoder.INDIRECT_KEYWORD_MAP:
+        for unit in ["y", "m", None]:
+            for from_age, to_age in itertools.product(ages, repeat=2):
+                if (from_age is None or unit is None) and to_age is not None:
+                    continue
+                indirect_info = dict(
+                    keyword=keyword,
+                    year_info_from_y=from_age if unit == "y" else None,
+                    year_info_to_y=to_age if unit == "y" else None,
+                    year_info_from_m=from_age if unit == "m" else None,
+                    year_info_to_m=to_age if unit == "m" else None,
+                )
+                for gender in GENDERS:
+                    legacy_fact = SimpleNamespace(gender=gender)
+                    legacy_range = _legacy_indirect_info_to_range(SimpleNamespace(**indirect_info), legacy_fact)
+                    fact = cloth_handler.ClothFact(
+                        class_name="ont:obj:local:obj1256N",
+                        parsed_name="вещи",
+                        size_info=SizeInfo(direct_values=None, indirect_values=SimpleNamespace(**indirect_info)),
+                        prop_dict={"gender": gender} if gender is not None else {},
+                    )
+                    # reversed ranges are swapped after decoding
+                    assert fact.parsed_size_info == (min(legacy_range), max(legacy_range)), (indirect_info, gender)
+                    assert fact.gender == legacy_fact.gender
+
+
+if __name__ == "__main__":
+    test_size_letters()
+    test_age_ranges()
@@ -149,6 +149,48 @@ def calc_confusion_matrix(true_markup, pred_markup, n_ads, n_requests):
     return metrics
 
 
+def calc_sparse_confusion_matrix(true_markup, match_matrix):
+    """
+    The same as calc_confusion_matrix(), but predictions are given by sparse match matrix, so only matched
+    and marked up pairs are visited instead of all request × ad pairs.
+    :param true_markup: result of dataset_utils.load_matching_data
+    :param match_matrix: sparse request × ad matrix in CSR form (result of searcher.search_many()
+        or scipy.sparse.csr_matrix), where row and column indices are 0-based
+    :return: dict of metrics
+    """
+    n_requests, n_ads = match_matrix.shape
+    assert len(true_markup) <= n_requests
+    assert all(isinstance(k, str) and all(isinstance(vv, str) for vv in v) for k, v in true_markup.items())
+    assert all(
+        int(k) > 0 and int(k) <= n_requests and all(int(vv) > 0 and int(vv) <= n_ads for vv in v)
+        for k, v in true_markup.items()
+    )
+
+    metrics = {"TP": 0,
+               "FP": 0,
+               "TN": 0,
+               "FN": 0
+               }
+
+    for request_idx in range(n_requests):
+        true_ad_ids = true_markup.get(str(request_idx + 1), [])
+        true_ad_idx_set = {int(ad_id) - 1 for ad_id in true_ad_ids}
+        pred_ad_idx_list = match_matrix.indices[match_matrix.indptr[request_idx]:match_matrix.indptr[request_idx + 1]]
+        TP = len(true_ad_idx_set.intersection(pred_ad_idx_list.tolist()))
+        FP = len(pred_ad_idx_list) - TP
+        if len(pred_ad_idx_list) == 0:
+            # duplicated ids of markup are counted here, as calc_confusion_matrix() does, so metrics are comparable
+            FN = len(true_ad_ids)
+        else:
+            FN = len(true_ad_idx_set) - TP
+        metrics["TP"] += TP
+        metrics["FP"] += FP
+        metrics["TN"] += n_ads - TP - FP - FN
+        metrics["FN"] += FN
+
+    return metrics
+
+
 def calc_all_stats(confusion_matrix):
     """
     Counts confusion matrix-based metrics from accuracy to F-score.